@@ -6,7 +6,10 @@ from fastapi.middleware.cors import CORSMiddleware
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 
+from utils.durable_queue import liberar_arriendos
+from utils.http_session import cerrar_sesiones_http
 from utils.rate_limit import limiter
+from utils.render_pool import pool_render
 
 app_logger = logging.getLogger("app_logger")
 
@@ -75,6 +78,17 @@ def create_app(*, title: str, description: str, routers, extra_workers=None) ->
                 for _ in range(5):
                     asyncio.create_task(orchestrator.worker())
 
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        # Cierra las sesiones HTTP pooled de los orquestadores (ver
+        # utils/http_session.py) en vez de dejar conexiones TLS colgadas.
+        await cerrar_sesiones_http()
+        # Y el pool de render compartido (ver utils/render_pool.py).
+        pool_render.cerrar()
+        # Los trabajos en curso vuelven a la cola sin gastar un intento (ver
+        # utils/durable_queue.py); el próximo arranque los retoma.
+        liberar_arriendos()
+
     @app.get("/health", tags=["General"])
     async def health():
         return {"status": "ok"}
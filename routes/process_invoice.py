@@ -10,24 +10,43 @@ import shutil
 import json
 import base64
 import asyncio
-import ssl
 import mimetypes
-from pathlib import Path
 from typing import Dict, Optional, Union, TypedDict
 from dotenv import load_dotenv
 
 # Third-party imports
-import aiohttp
-import certifi
 import filetype
 import requests
 import zipfile
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 
 # Local imports
 from tools import tools
+from utils.adaptive_concurrency import estado_limitadores, limitador_para
+from utils.durable_queue import ColaDurable, pasos_hechos
+from utils.extraction_cache import campos_item, extraction_cache, respuestas_desde_cache
+from utils.file_encoders import file_to_base64
+from utils.file_refs import FILES_API_BETA, archivos_anthropic
+from utils.http_session import SharedHttpSession
+from utils.image_prep import nota_tramos, preparar_imagen
+from utils.model_cascade import (
+    ModelCascade,
+    cascada_desde_env,
+    chequear_consistencia,
+    modelos_por_seccion,
+)
+from utils.rate_budget import metricas_presupuestos, presupuesto_para
+from utils.render_pool import pool_render
+from utils.retry_policy import UpstreamUnavailableError, politica_llm
+from utils.schema_repair import (
+    MAX_TURNOS_REPARACION,
+    reparar_localmente,
+    turno_reparacion_anthropic,
+)
+from utils.schema_validators import schema_de_tool, validar
+from utils.toolchain import ejecutar_tools_en_paralelo
 
 load_dotenv()
 
@@ -97,6 +116,12 @@ def formatear_impuestos(impuestos):
     return "\n".join(resultado)
 
 
+# Lo que un item de task_queue ya hizo y no se repite si se vuelve a entregar
+# después de un restart (ver ColaDurable.anotar_pasos): la factura procesada
+# (ya con su fila en Sheets) y el webhook.
+PASOS_DURABLES = ("factura", "webhook_enviado")
+
+
 # Definición de tipo para elementos en cola que contienen información del archivo
 class QueueItem(TypedDict):
     file_name: str
@@ -123,24 +148,42 @@ class InvoiceOrchestrator:
         self.api_key = api_key
         self.active_comparisons = {}
 
-        self.task_queue = asyncio.Queue()  # Cola async para procesar facturas
+        # Cola durable (SQLite): sobrevive a un restart (ver utils/durable_queue.py)
+        self.task_queue = ColaDurable("claude")
         self.semaphore = asyncio.Semaphore(semaphore)  # Control de concurrencia
+        self._http = SharedHttpSession()  # Sesión HTTP pooled para la API de Claude
 
         self.model = model
         self.tool_with_prompts = tools  # Herramientas para procesar facturas
+        # Cascada de modelos por tool (ver utils/model_cascade.py). El default
+        # es el salto a claude-3-7-sonnet que ya hacían los handlers.
+        self.cascada = cascada_desde_env(
+            "CLAUDE_MODEL_CASCADE", [model, "claude-3-7-sonnet-20250219"]
+        )
 
     # Worker que procesa items de la cola continuamente
     async def worker(self):
         while True:
-            item = await self.task_queue.get()
+            trabajo = await self.task_queue.tomar()
+            item = trabajo["payload"]
+            hechos = pasos_hechos(trabajo, "item")
             app_logger.info(f"Procesando item {item}")
             try:
                 self.active_comparisons[item["process_id"]] = item
                 app_logger.info(f"Procesando item: {item['process_id']}")
-                # Procesa la factura y notifica resultado
-                factura = await self.process_item(item)
-                app_logger.info("Factura procesada")
-                webhook_response = await self.fire_webhook(factura)
+                # Procesa la factura y notifica resultado. Si el item se
+                # vuelve a entregar, no repite la fila de Sheets ni el webhook.
+                if not hechos.get("factura"):
+                    hechos["factura"] = await self.process_item(item)
+                    await self.task_queue.anotar_pasos(trabajo, "item", hechos, PASOS_DURABLES)
+                    app_logger.info("Factura procesada")
+                if hechos.get("webhook_enviado"):
+                    app_logger.info("Webhook ya enviado antes de un restart, se saltea")
+                    continue
+                # Se anota antes de mandarlo: el webhook sale una sola vez.
+                hechos["webhook_enviado"] = True
+                await self.task_queue.anotar_pasos(trabajo, "item", hechos, PASOS_DURABLES)
+                webhook_response = await self.fire_webhook(hechos["factura"])
                 if webhook_response:
                     app_logger.info("Webhook delivered successfully")
                 else:
@@ -163,7 +206,7 @@ class InvoiceOrchestrator:
                     os.remove(item["file_path"])
                 except OSError as e:
                     app_logger.error(f"Error deleting file {file_path}: {e}")
-                self.task_queue.task_done()
+                await self.task_queue.confirmar(trabajo)
 
     # Envía resultados vía webhook
     async def fire_webhook(self, data):
@@ -213,64 +256,69 @@ class InvoiceOrchestrator:
     async def make_api_request(
         self, url: str, headers: Dict, data: Dict, process_id: str, retries: int = 5
     ) -> Optional[Dict]:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            for i in range(retries):
-                try:
-                    async with session.post(
-                        url, headers=headers, json=data
-                    ) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status in [429, 529, 503]:
-                            sleep_time = 15 * (i + 1)  # Espera incremental en segundos
-                            await asyncio.sleep(sleep_time)
-                        else:
-                            app_logger.error(
-                                f"Error: {response.status} - {await response.text()}"
-                            )
-                            raise ValueError(
-                                f"Request failed with status {response.status}"
-                            )
-                except aiohttp.ClientError as e:
-                    raise ValueError(f"Request error: {str(e)}")
-        raise ValueError("Max retries exceeded.")
+        # Sesión pooled del orquestador (ver utils/http_session.py) -- no
+        # abre una conexión TLS nueva por cada request. Reintentos, Retry-After,
+        # deadline y circuit breaker: ver utils/retry_policy.py.
+        session = await self._http.get()
+        return await politica_llm.post_json(
+            session,
+            url,
+            headers,
+            data,
+            process_id=process_id,
+            max_intentos=retries,
+            # Presupuesto RPM/TPM del proveedor compartido por todo el
+            # proceso (ver utils/rate_budget.py): post_json lo pide antes de
+            # cada intento en vez de comerse un 429.
+            presupuesto=presupuesto_para(url),
+            # Concurrencia adaptativa (AIMD) hacia el proveedor, un lugar por
+            # intento HTTP -- ver utils/adaptive_concurrency.py.
+            limitador=limitador_para(url),
+        )
 
     # Procesa imágenes con Claude Vision
     async def run_image_toolchain(
         self,
         item: QueueItem,
     ):
-        # Convierte imagen a base64
-        image_file = Path(item["file_path"])
-        base64_string = base64.b64encode(image_file.read_bytes()).decode()
-
-        # Procesa con primera herramienta
-        response = await self.vision_tool_handler(
-            tools=[tool["data"] for tool in self.tool_with_prompts],
-            encoded_img=base64_string,
-            type=item["media_type"],
-            prompt=self.tool_with_prompts[0]["prompt"],
-            tool_name=self.tool_with_prompts[0]["data"]["name"],
-            process_id=item["process_id"],
-        )
-
-        # Procesa con resto de herramientas en paralelo
-        tasks = []
-        for tool in self.tool_with_prompts[1:]:
-            tool_res = self.vision_tool_handler(
-                tools=[tool["data"] for tool in self.tool_with_prompts],
-                encoded_img=base64_string,
-                type=item["media_type"],
-                prompt=tool["prompt"],
-                tool_name=tool["data"]["name"],
+        # Cache por contenido + single-flight (ver utils/extraction_cache.py):
+        # un archivo que ya se extrajo no vuelve a pasar por el LLM.
+        clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, self.tool_with_prompts)
+        async with extraction_cache.reservar(clave) as cacheado:
+            if cacheado is not None:
+                item["data"] = respuestas_desde_cache(cacheado)
+                item.update(campos_item(cacheado))
+                item["tool_timings"] = {"cache": True}
+                return item
+
+            # Preprocesada (orientación, recorte de márgenes, reducción, tramos
+            # para tickets largos -- ver utils/image_prep.py) y encodeada en el
+            # pool de render, fuera del event loop (ver utils/render_pool.py).
+            imagenes = await pool_render.ejecutar(
+                preparar_imagen, item["file_path"], item["media_type"], item["process_id"],
                 process_id=item["process_id"],
             )
-            tasks.append(tool_res)
-        results = await asyncio.gather(*tasks)
-        respuestas = [response] + results
+
+            # Las 3 tools se lanzan juntas (ver utils/toolchain.py). Antes la
+            # primera iba sola y "calentaba" el cache_control de la imagen para
+            # las otras dos; ahora las tres pueden pagar cache_creation, a cambio
+            # de sacar una vuelta completa a Claude del camino crítico.
+            llamadas = {
+                tool["data"]["name"]: self.vision_tool_handler(
+                    tools=[tool["data"] for tool in self.tool_with_prompts],
+                    imagenes=imagenes,
+                    prompt=tool["prompt"],
+                    tool_name=tool["data"]["name"],
+                    process_id=item["process_id"],
+                )
+                for tool in self.tool_with_prompts
+            }
+            respuestas, tiempos = await ejecutar_tools_en_paralelo(
+                llamadas, item["process_id"]
+            )
+            extraction_cache.guardar(clave, self.formatear_factura(respuestas)["data"], item)
         item["data"] = respuestas
+        item["tool_timings"] = tiempos
         return item
 
     # Procesa PDFs con Claude
@@ -278,79 +326,103 @@ class InvoiceOrchestrator:
         self,
         item: QueueItem,
     ):
-        # Convierte PDF a base64
-        static_content = pdf_to_base64(item["file_path"])
-
-        # Procesa con primera herramienta
-        response = await self.pdf_tool_handler(
-            tools=[tool["data"] for tool in self.tool_with_prompts],
-            static_content=static_content,
-            prompt=self.tool_with_prompts[0]["prompt"],
-            tool_name=self.tool_with_prompts[0]["data"]["name"],
-            process_id=item["process_id"],
-        )
-
-        # Procesa con resto de herramientas en paralelo
-        tasks = []
-        for tool in self.tool_with_prompts[1:]:
-            tool_res = self.pdf_tool_handler(
-                tools=[tool["data"] for tool in self.tool_with_prompts],
-                static_content=static_content,
-                prompt=tool["prompt"],
-                tool_name=tool["data"]["name"],
-                process_id=item["process_id"],
+        # Cache antes de leer el PDF -- ver run_image_toolchain.
+        clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, self.tool_with_prompts)
+        async with extraction_cache.reservar(clave) as cacheado:
+            if cacheado is not None:
+                item["data"] = respuestas_desde_cache(cacheado)
+                item.update(campos_item(cacheado))
+                item["tool_timings"] = {"cache": True}
+                return item
+
+            # Convierte PDF a base64 (pool de render -- ver run_image_toolchain)
+            static_content = await pool_render.ejecutar(
+                file_to_base64, item["file_path"], process_id=item["process_id"]
             )
-            tasks.append(tool_res)
-        results = await asyncio.gather(*tasks)
-        respuestas = [response] + results
+
+            # Con LLM_FILE_REFS el PDF se sube una vez y las 3 tools (y sus
+            # reintentos) lo referencian por id; se borra al salir (ver
+            # utils/file_refs.py). file_id None = inline como siempre.
+            async with archivos_anthropic.referencia(
+                item["file_path"], "application/pdf", item["process_id"]
+            ) as file_id:
+                # Las 3 tools se lanzan juntas -- ver run_image_toolchain.
+                llamadas = {
+                    tool["data"]["name"]: self.pdf_tool_handler(
+                        tools=[tool["data"] for tool in self.tool_with_prompts],
+                        static_content=static_content,
+                        prompt=tool["prompt"],
+                        tool_name=tool["data"]["name"],
+                        process_id=item["process_id"],
+                        file_id=file_id,
+                    )
+                    for tool in self.tool_with_prompts
+                }
+                respuestas, tiempos = await ejecutar_tools_en_paralelo(
+                    llamadas, item["process_id"]
+                )
+            extraction_cache.guardar(clave, self.formatear_factura(respuestas)["data"], item)
         item["data"] = respuestas
+        item["tool_timings"] = tiempos
         return item
 
     # Maneja el procesamiento de imágenes con Claude Vision
     async def vision_tool_handler(
         self,
         tools: list,
-        encoded_img: str,
-        type: str,
+        imagenes: list,
         prompt: str,
         tool_name: str,
         process_id: str,
-        model: str = "claude-sonnet-4-20250514",
+        model: Optional[str] = None,
         max_retries: int = 6,
     ):
         api_key = os.getenv("ANTHROPIC_API_KEY")
-        schema = next(
-            (tool["input_schema"] for tool in tools if tool["name"] == tool_name), None
-        )
+        # Validador compilado y cacheado (ver utils/schema_validators.py).
+        schema = schema_de_tool(tools, tool_name)
         headers = {
             "Content-Type": "application/json",
             "x-api-key": api_key,
             "anthropic-version": "2023-06-01",
         }
 
+        # imagenes: [(media type, base64)] de utils/image_prep.preparar_imagen
+        # -- más de una si es un ticket largo partido en tramos. El
+        # cache_control va en la última: cachea el prefijo con todas.
+        contenido_imagen = [
+            {
+                "type": "image",
+                "source": {"type": "base64", "media_type": media_type, "data": datos},
+            }
+            for media_type, datos in imagenes
+        ]
+        contenido_imagen[-1]["cache_control"] = {"type": "ephemeral"}
+        nota = nota_tramos(len(imagenes))
+        if nota:
+            contenido_imagen.insert(0, {"type": "text", "text": nota})
+
+        # Turno de reparación pendiente (ver except ValidationError)
+        turno_reparacion = []
+        turnos_reparacion = 0
+        # Cascada de modelos (ver utils/model_cascade.py); un model explícito
+        # la reemplaza por ese único modelo.
+        cascada = ModelCascade([model]) if model else self.cascada
+        fallas = 0
+
         # Intenta procesar con reintentos
         for attempt in range(0, max_retries):
             try:
+                nivel, modelo = cascada.modelo(fallas)
                 data = {
-                    "model": model if attempt < 3 else "claude-3-7-sonnet-20250219",
+                    "model": modelo,
                     "tools": tools,
                     "max_tokens": 8192,
                     "messages": [
                         {
                             "role": "user",
-                            "content": [
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": type,
-                                        "data": encoded_img,
-                                    },
-                                    "cache_control": {"type": "ephemeral"},
-                                },
-                                {"type": "text", "text": prompt},
-                            ],
+                            "content": [*contenido_imagen, {"type": "text", "text": prompt}],
                         },
+                        *turno_reparacion,
                     ],
                     "tool_choice": {
                         "type": "tool",
@@ -370,12 +442,49 @@ class InvoiceOrchestrator:
                     (c for c in content if c.get("type") == "tool_use"), None
                 )
                 tool_output = tool_msg["input"]
-                validate(instance=tool_output, schema=schema)
+                try:
+                    validar(schema, tool_output)
+                except ValidationError:
+                    # Primero, reparación local sin request extra (ver
+                    # utils/schema_repair.py).
+                    reparado, cambios = reparar_localmente(schema, tool_output)
+                    if reparado is None:
+                        raise
+                    app_logger.info(f"🩹 '{tool_name}' reparado localmente: {cambios}")
+                    tool_msg["input"] = reparado
                 app_logger.info("✅ Validation passed.")
+
+                # Válida pero inconsistente (montos, CUIT): escala de una al
+                # siguiente modelo; en el último nivel se acepta igual.
+                problemas = chequear_consistencia(tool_name, tool_msg["input"])
+                if problemas:
+                    if nivel < cascada.ultimo_nivel and attempt < max_retries - 1:
+                        app_logger.warning(
+                            f"⚖️ '{tool_name}' inconsistente con {modelo}, escala a {cascada.modelos[nivel + 1]}: {problemas}"
+                        )
+                        fallas = cascada.fallas_para_nivel(nivel + 1)
+                        turno_reparacion = []
+                        continue
+                    app_logger.warning(
+                        f"⚖️ '{tool_name}' inconsistente con {modelo} (se acepta): {problemas}"
+                    )
+                response["tier"] = nivel
                 return response
             except ValidationError as e:
                 # Notifica error de validación
                 app_logger.error(f"❌ Validation error for '{tool_name}': {e.message}")
+                fallas += 1
+                # Próximo intento: un turno de reparación con la respuesta
+                # previa y los errores concretos; si ese turno ya se usó,
+                # vuelve a la re-extracción completa con el request original.
+                if turnos_reparacion < MAX_TURNOS_REPARACION:
+                    turnos_reparacion += 1
+                    turno_reparacion = turno_reparacion_anthropic(
+                        content, tool_msg["id"], getattr(e, "errores", [e.message])
+                    )
+                else:
+                    turnos_reparacion = 0
+                    turno_reparacion = []
                 # error_message = {
                 #     "tool_name": tool_name,
                 #     "tool_output": tool_output,
@@ -390,7 +499,11 @@ class InvoiceOrchestrator:
                 #     timeout=10,
                 # )
                 # app_logger.info(f"Webhook Status Code: {error_response.status_code}")
-                if attempt < max_retries:
+                # max_retries - 1: con "< max_retries" (siempre cierto) el
+                # último intento caía al final del for y devolvía None, y
+                # formatear_factura reventaba con un error críptico (mismo
+                # fix que en routes/process_invoice_google_2.py).
+                if attempt < max_retries - 1:
                     app_logger.warning("🔄 Retrying...")
                     continue
                 else:
@@ -398,6 +511,12 @@ class InvoiceOrchestrator:
                     raise ValueError(
                         f"Max retries exceeded for '{tool_name}'. Last error: {e.message}"
                     )
+            except UpstreamUnavailableError as e:
+                # Los reintentos de transporte (con backoff y deadline) ya se
+                # hicieron en utils/retry_policy.py -- volver a reintentar acá
+                # multiplicaba la espera con el proveedor caído.
+                app_logger.error(f"❌ Upstream no disponible para '{tool_name}': {e}")
+                raise
             except Exception as e:
                 # Notifica error general
                 app_logger.error(f"❌ Unexpected error: {e}")
@@ -415,13 +534,14 @@ class InvoiceOrchestrator:
                 #     timeout=10,
                 # )
                 # app_logger.info(f"Webhook Status Code: {error_response.status_code}")
-                if attempt < max_retries:
+                # Mismo off-by-one que en el except de ValidationError.
+                if attempt < max_retries - 1:
                     app_logger.warning("🔄 Retrying...")
                     continue
                 else:
                     app_logger.error("❌ Max retries exceeded.")
                     raise ValueError(
-                        f"Max retries exceeded for '{tool_name}'. Last error: {e.message}"
+                        f"Max retries exceeded for '{tool_name}'. Last error: {str(e)}"
                     )
 
     # Maneja el procesamiento de PDFs con Claude
@@ -432,8 +552,9 @@ class InvoiceOrchestrator:
         prompt: str,
         tool_name: str,
         process_id: str,
-        model: str = "claude-sonnet-4-20250514",
+        model: Optional[str] = None,
         max_retries: int = 6,
+        file_id: Optional[str] = None,
     ):
         api_key = os.getenv("ANTHROPIC_API_KEY")
 
@@ -442,21 +563,31 @@ class InvoiceOrchestrator:
                 "ANTHROPIC_API_KEY is not set in the environment variables."
             )
 
-        schema = next(
-            (tool["input_schema"] for tool in tools if tool["name"] == tool_name), None
-        )
+        # Validador compilado y cacheado (ver utils/schema_validators.py).
+        schema = schema_de_tool(tools, tool_name)
 
         headers = {
             "Content-Type": "application/json",
             "x-api-key": api_key,
             "anthropic-version": "2023-06-01",
         }
+        # El bloque {"type": "file"} necesita el header beta del Files API.
+        headers_archivo = {**headers, "anthropic-beta": FILES_API_BETA}
+
+        # Turno de reparación pendiente (ver except ValidationError)
+        turno_reparacion = []
+        turnos_reparacion = 0
+        # Cascada de modelos (ver utils/model_cascade.py); un model explícito
+        # la reemplaza por ese único modelo.
+        cascada = ModelCascade([model]) if model else self.cascada
+        fallas = 0
 
         # Intenta procesar con reintentos
         for attempt in range(0, max_retries):
             try:
+                nivel, modelo = cascada.modelo(fallas)
                 data = {
-                    "model": model if attempt < 3 else "claude-3-7-sonnet-20250219",
+                    "model": modelo,
                     "tools": tools,
                     "max_tokens": 8192,
                     "messages": [
@@ -465,16 +596,23 @@ class InvoiceOrchestrator:
                             "content": [
                                 {
                                     "type": "document",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": "application/pdf",
-                                        "data": static_content,
-                                    },
+                                    # Por referencia si el PDF ya se subió
+                                    # (ver run_pdf_toolchain).
+                                    "source": (
+                                        {"type": "file", "file_id": file_id}
+                                        if file_id
+                                        else {
+                                            "type": "base64",
+                                            "media_type": "application/pdf",
+                                            "data": static_content,
+                                        }
+                                    ),
                                     "cache_control": {"type": "ephemeral"},
                                 },
                                 {"type": "text", "text": prompt},
                             ],
                         },
+                        *turno_reparacion,
                     ],
                     "tool_choice": {
                         "type": "tool",
@@ -485,7 +623,7 @@ class InvoiceOrchestrator:
 
                 response = await self.make_api_request(
                     url="https://api.anthropic.com/v1/messages",
-                    headers=headers,
+                    headers=headers_archivo if file_id else headers,
                     data=data,
                     process_id=process_id,
                 )
@@ -494,12 +632,49 @@ class InvoiceOrchestrator:
                     (c for c in content if c.get("type") == "tool_use"), None
                 )
                 tool_output = tool_msg["input"]
-                validate(instance=tool_output, schema=schema)
+                try:
+                    validar(schema, tool_output)
+                except ValidationError:
+                    # Primero, reparación local sin request extra (ver
+                    # utils/schema_repair.py).
+                    reparado, cambios = reparar_localmente(schema, tool_output)
+                    if reparado is None:
+                        raise
+                    app_logger.info(f"🩹 '{tool_name}' reparado localmente: {cambios}")
+                    tool_msg["input"] = reparado
+
+                # Válida pero inconsistente (montos, CUIT): escala de una al
+                # siguiente modelo; en el último nivel se acepta igual.
+                problemas = chequear_consistencia(tool_name, tool_msg["input"])
+                if problemas:
+                    if nivel < cascada.ultimo_nivel and attempt < max_retries - 1:
+                        app_logger.warning(
+                            f"⚖️ '{tool_name}' inconsistente con {modelo}, escala a {cascada.modelos[nivel + 1]}: {problemas}"
+                        )
+                        fallas = cascada.fallas_para_nivel(nivel + 1)
+                        turno_reparacion = []
+                        continue
+                    app_logger.warning(
+                        f"⚖️ '{tool_name}' inconsistente con {modelo} (se acepta): {problemas}"
+                    )
+                response["tier"] = nivel
                 return response
 
             except ValidationError as e:
                 # Notifica error de validación
                 app_logger.error(f"❌ Validation error for '{tool_name}': {e.message}")
+                fallas += 1
+                # Próximo intento: un turno de reparación con la respuesta
+                # previa y los errores concretos; si ese turno ya se usó,
+                # vuelve a la re-extracción completa con el request original.
+                if turnos_reparacion < MAX_TURNOS_REPARACION:
+                    turnos_reparacion += 1
+                    turno_reparacion = turno_reparacion_anthropic(
+                        content, tool_msg["id"], getattr(e, "errores", [e.message])
+                    )
+                else:
+                    turnos_reparacion = 0
+                    turno_reparacion = []
                 # error_message = {
                 #     "tool_name": tool_name,
                 #     "tool_output": tool_output,
@@ -514,7 +689,11 @@ class InvoiceOrchestrator:
                 #     timeout=10,
                 # )
                 # app_logger.info(f"Webhook Status Code: {error_response.status_code}")
-                if attempt < max_retries:
+                # max_retries - 1: con "< max_retries" (siempre cierto) el
+                # último intento caía al final del for y devolvía None, y
+                # formatear_factura reventaba con un error críptico (mismo
+                # fix que en routes/process_invoice_google_2.py).
+                if attempt < max_retries - 1:
                     app_logger.warning("🔄 Retrying...")
                     continue
                 else:
@@ -522,9 +701,20 @@ class InvoiceOrchestrator:
                     raise ValueError(
                         f"Max retries exceeded for '{tool_name}'. Last error: {e.message}"
                     )
+            except UpstreamUnavailableError as e:
+                # Los reintentos de transporte (con backoff y deadline) ya se
+                # hicieron en utils/retry_policy.py -- volver a reintentar acá
+                # multiplicaba la espera con el proveedor caído.
+                app_logger.error(f"❌ Upstream no disponible para '{tool_name}': {e}")
+                raise
             except Exception as e:
                 # Notifica error general
                 app_logger.error(f"❌ Unexpected error: {e}")
+                if file_id:
+                    # La referencia puede ser el problema (archivo vencido o
+                    # borrado): los reintentos que quedan van inline.
+                    app_logger.warning(f"📎 '{tool_name}' falló con el PDF por referencia, se sigue inline")
+                    file_id = None
                 # error_message = {
                 #     "tool_name": tool_name,
                 #     "tool_output": tool_output,
@@ -539,13 +729,14 @@ class InvoiceOrchestrator:
                 #     timeout=10,
                 # )
                 # app_logger.info(f"Webhook Status Code: {error_response.status_code}")
-                if attempt < max_retries:
+                # Mismo off-by-one que en el except de ValidationError.
+                if attempt < max_retries - 1:
                     app_logger.warning("🔄 Retrying...")
                     continue
                 else:
                     app_logger.error("❌ Max retries exceeded.")
                     raise ValueError(
-                        f"Max retries exceeded for '{tool_name}'. Last error: {e.message}"
+                        f"Max retries exceeded for '{tool_name}'. Last error: {str(e)}"
                     )
 
     # Guarda los datos de la factura en Google Sheets
@@ -707,9 +898,14 @@ class InvoiceOrchestrator:
                     tool_content.get("name") == "impuestos_y_retenciones_de_la_factura"
                 ):
                     datos_factura["impuestos"] = tool_content.get("input", {})
+        # Qué modelo/nivel de la cascada produjo cada sección (ver
+        # utils/model_cascade.py) -- para ajustar los umbrales con datos reales.
+        modelos = modelos_por_seccion(factura_completa)
+        app_logger.info(f"📊 Modelos por sección: {modelos}")
         return {
             "data": datos_factura,
             "tokens": total_tokens,
+            "modelos": modelos,
         }
 
 
@@ -937,7 +1133,7 @@ async def process_invoice(
                             "media_type": media_type,
                             "process_id": f"{id}/{file_name_in_zip}",
                         }
-                        await orchestrator.task_queue.put(item)
+                        orchestrator.task_queue.encolar(item)
 
                     # Notifica y elimina si no es compatible
                     else:
@@ -981,7 +1177,15 @@ async def get_queue_status():
 
     Returns:
         dict: Contains 'queue_size' key with a dictionary of active processing tasks,
-              where each key is a process ID and value contains file processing details
+              where each key is a process ID and value contains file processing details,
+              'rate_budget' with the per-provider RPM/TPM budget and queue wait
+              metrics (see utils/rate_budget.py), and 'concurrency' with the
+              current adaptive concurrency limit per provider and its history
+              (see utils/adaptive_concurrency.py), 'render_pool' with the
+              render pool size and its queue wait metrics (see
+              utils/render_pool.py), 'file_refs' with the upload-once
+              counters (see utils/file_refs.py), and 'cola' with the durable
+              queue's job counts by state (see utils/durable_queue.py)
 
     Example response:
         {
@@ -993,7 +1197,41 @@ async def get_queue_status():
                     "media_type": "application/pdf",
                     "process_id": "process_123"
                 }
+            },
+            "rate_budget": {
+                "generativelanguage.googleapis.com": {
+                    "rpm": 150, "tpm": 1000000, "en_cola": 0, "llamadas": 42,
+                    "esperas": 3, "espera_total_s": 7.5, "espera_max_s": 4.1,
+                    "espera_ultima_s": 0.0
+                }
+            },
+            "concurrency": {
+                "generativelanguage.googleapis.com": {
+                    "limite": 7, "en_vuelo": 3, "p95_s": 12.4,
+                    "historial": [
+                        {"ts": 1760000000.0, "limite": 9, "motivo": "inicio"},
+                        {"ts": 1760000120.5, "limite": 4, "motivo": "status 429"},
+                        {"ts": 1760000300.2, "limite": 7, "motivo": "sube"}
+                    ]
+                }
+            },
+            "render_pool": {
+                "workers": 2, "tipo": "thread", "tareas": 57, "en_cola": 0,
+                "espera_total_s": 3.2, "espera_max_s": 1.4,
+                "espera_ultima_s": 0.0, "trabajo_total_s": 41.7
+            },
+            "file_refs": {"activo": true, "subidos": 12, "bytes_subidos": 48234112},
+            "cola": {
+                "cola": "claude", "pendiente": 3, "en_curso": 5, "hecho": 140,
+                "fallido": 1, "espera_max_s": 42.7, "max_intentos": 3
             }
         }
     """
-    return {"queue_size": orchestrator.active_comparisons}
+    return {
+        "queue_size": orchestrator.active_comparisons,
+        "rate_budget": metricas_presupuestos(),
+        "concurrency": estado_limitadores(),
+        "render_pool": pool_render.estado(),
+        "file_refs": archivos_anthropic.estado(),
+        "cola": orchestrator.task_queue.estado(),
+    }
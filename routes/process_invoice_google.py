@@ -13,30 +13,53 @@ import shutil
 import json
 import base64
 import asyncio
-import ssl
 import mimetypes
 import uuid
 import datetime
-from pathlib import Path
 from typing import Dict, Optional, Union, TypedDict
-import fitz  # PyMuPDF
-from PIL import Image
-import io
 from dotenv import load_dotenv
 
 # Third-party imports
-import aiohttp
-import certifi
 import filetype
 import requests
 import zipfile
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 
 # Local imports
 from tools import tools
 from tools_standard import tools as tools_standard
+from utils.adaptive_concurrency import estado_limitadores, limitador_para
+from utils.afip_qr import aplicar_qr, preparar_qr, resumen_qr
+from utils.durable_queue import ColaDurable, pasos_hechos
+from utils.extraction_cache import campos_item, extraction_cache, respuestas_desde_cache
+from utils.hedging import cobertura_llm
+from utils.http_session import SharedHttpSession
+from utils.image_prep import mensajes_imagen_openai, preparar_imagen
+from utils.memoria import MedidorMemoria
+from utils.model_cascade import (
+    ModelCascade,
+    cascada_desde_env,
+    chequear_consistencia,
+    modelos_por_seccion,
+)
+from utils.pdf_text import mensajes_pdf, seleccionar_paginas
+from utils.rate_budget import metricas_presupuestos, presupuesto_para
+from utils.render_pool import pool_render
+from utils.retry_policy import UpstreamUnavailableError, politica_llm
+from utils.schema_repair import (
+    MAX_TURNOS_REPARACION,
+    reparar_localmente,
+    turno_reparacion_openai,
+)
+from utils.schema_validators import schema_de_tool, validar
+from utils.toolchain import (
+    bloques_de_paginas,
+    ejecutar_tools_en_paralelo,
+    extraer_con_schema_combinado,
+    extraer_items_por_bloques,
+)
 
 load_dotenv()
 
@@ -113,6 +136,11 @@ def formatear_impuestos(impuestos):
     return "\n".join(resultado)
 
 
+# Lo que cada factura de un job de email ya hizo y no se repite si el job se
+# vuelve a entregar después de un restart (ver ColaDurable.anotar_pasos).
+PASOS_DURABLES = ("saved_sheet", "email_enviado", "webhook_enviado", "terminado")
+
+
 # Definición de tipo para elementos en cola que contienen información del archivo
 class QueueItem(TypedDict):
     file_name: str
@@ -132,6 +160,7 @@ class InvoiceOrchestrator:
         queue_check_cooldown: int,
         model: str,
         semaphore: int,
+        combined_schema: bool = False,
     ):
         self.secret = secret
         self.webhook_url = webhook_url
@@ -139,17 +168,25 @@ class InvoiceOrchestrator:
         self.recharge_cooldown = recharge_cooldown
         self.queue_check_cooldown = queue_check_cooldown
         self.model = model
+        # Modelos del más barato al más fuerte (ver utils/model_cascade.py).
+        self.cascada = cascada_desde_env("GEMINI_MODEL_CASCADE", [model])
+        # Opt-in: 1 request por factura con las 3 secciones juntas en vez de
+        # 3 requests (ver utils/toolchain.extraer_con_schema_combinado).
+        self.combined_schema = combined_schema
         self.semaphore = asyncio.Semaphore(semaphore)
         self.queue = asyncio.Queue()
         self.active_comparisons = {}
         self.processed_jobs = set()  # Para idempotencia
-        self.job_queue = asyncio.Queue()  # Cola para jobs
+        # Cola durable (SQLite): sobrevive a un restart (ver utils/durable_queue.py)
+        self.job_queue = ColaDurable("gemini_email")
+        self._http = SharedHttpSession()  # Sesión HTTP pooled para la API de Gemini
         asyncio.create_task(self.worker())
 
     async def worker(self):
         app_logger.info("Iniciando worker")
         while True:
-            job = await self.job_queue.get()
+            trabajo = await self.job_queue.tomar()
+            job = trabajo["payload"]
             from_email = job["from_email"]
             subject = job["subject"]
             temp_dir = job["temp_dir"]
@@ -166,7 +203,7 @@ class InvoiceOrchestrator:
 
             if process_id in self.processed_jobs:
                 app_logger.info(f"Job {process_id} ya procesado, skipping")
-                self.job_queue.task_done()
+                await self.job_queue.confirmar(trabajo)
                 continue
             self.processed_jobs.add(process_id)
 
@@ -183,6 +220,17 @@ class InvoiceOrchestrator:
                 for i, item in enumerate(items_to_process, 1):
                     file_name = item["file_name"]
                     media_type = item["media_type"]
+                    # Si el job se vuelve a entregar (restart a la mitad), el
+                    # item retoma con lo que ya hizo: Sheets, email y webhook
+                    # no se repiten (ver PASOS_DURABLES).
+                    clave = f"item-{i}"
+                    hechos = pasos_hechos(trabajo, clave)
+                    if hechos.get("terminado"):
+                        processed_count += 1
+                        app_logger.info(
+                            f"[{process_id}] Archivo {i}/{total_items}: {file_name} ya procesado antes de un restart, se saltea"
+                        )
+                        continue
                     app_logger.info(
                         f"[{process_id}] Procesando archivo {i}/{total_items}: {file_name} (tipo: {media_type})"
                     )
@@ -227,32 +275,47 @@ class InvoiceOrchestrator:
                         #         f"[{process_id}] Error guardando JSON para {file_name}: {e}"
                         #     )
 
-                        app_logger.info(
-                            f"[{process_id}] Guardando factura en sheets para {file_name}"
-                        )
-                        saved = self.guardar_factura_completa_en_sheets(factura["data"])
-                        app_logger.info(
-                            f"[{process_id}] Factura guardada en sheets para {file_name}"
-                        )
+                        if not hechos.get("saved_sheet"):
+                            app_logger.info(
+                                f"[{process_id}] Guardando factura en sheets para {file_name}"
+                            )
+                            hechos["saved_sheet"] = self.guardar_factura_completa_en_sheets(
+                                factura["data"]
+                            )
+                            await self.job_queue.anotar_pasos(trabajo, clave, hechos, PASOS_DURABLES)
+                            app_logger.info(
+                                f"[{process_id}] Factura guardada en sheets para {file_name}"
+                            )
 
-                        html_body = self.generar_html_factura(factura["data"])
+                        if not hechos.get("email_enviado"):
+                            html_body = self.generar_html_factura(factura["data"])
 
-                        self.enviar_email(from_email, subject_for_file, html_body)
+                            hechos["email_enviado"] = self.enviar_email(
+                                from_email, subject_for_file, html_body
+                            )
+                            await self.job_queue.anotar_pasos(trabajo, clave, hechos, PASOS_DURABLES)
 
-                        result = {
-                            "id": process_id,
-                            "file_name": item["file_name"],
-                            "factura": factura,
-                            "saved": saved,
-                            "status": "procesada",
-                            "success": True,
-                        }
+                        # El webhook sale una sola vez: se anota antes de
+                        # mandarlo, como en routes/process_invoice_google_2.py.
+                        if not hechos.get("webhook_enviado"):
+                            result = {
+                                "id": process_id,
+                                "file_name": item["file_name"],
+                                "factura": factura,
+                                "saved": hechos["saved_sheet"],
+                                "status": "procesada",
+                                "success": True,
+                            }
 
-                        app_logger.info(
-                            f"[{process_id}] Enviando webhook para {file_name}"
-                        )
-                        await self.fire_webhook(result)
+                            hechos["webhook_enviado"] = True
+                            await self.job_queue.anotar_pasos(trabajo, clave, hechos, PASOS_DURABLES)
+                            app_logger.info(
+                                f"[{process_id}] Enviando webhook para {file_name}"
+                            )
+                            await self.fire_webhook(result)
 
+                        hechos["terminado"] = True
+                        await self.job_queue.anotar_pasos(trabajo, clave, hechos, PASOS_DURABLES)
                         processed_count += 1
                         app_logger.info(
                             f"[{process_id}] ✅ Archivo {file_name} procesado exitosamente ({processed_count}/{total_items})"
@@ -286,7 +349,7 @@ class InvoiceOrchestrator:
             finally:
                 if process_id in self.active_comparisons:
                     del self.active_comparisons[process_id]
-                self.job_queue.task_done()
+                await self.job_queue.confirmar(trabajo)
 
     # Envía resultados vía webhook
     async def fire_webhook(self, data):
@@ -338,34 +401,28 @@ class InvoiceOrchestrator:
 
     # Hace requests a la API con reintentos
     async def make_api_request(
-        self, url: str, headers: Dict, data: Dict, process_id: str, retries: int = 5
+        self, url: str, headers: Dict, data: Dict, process_id: str, retries: int = 5, medir=None
     ) -> Optional[Dict]:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            for i in range(retries):
-                try:
-                    async with session.post(
-                        url, headers=headers, json=data
-                    ) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status in [429, 529, 503]:
-                            sleep_time = 15 * (i + 1)  # Espera incremental en segundos
-                            app_logger.warning(
-                                f"API request failed with status {response.status}. Retrying in {sleep_time} seconds..."
-                            )
-                            await asyncio.sleep(sleep_time)
-                        else:
-                            app_logger.error(
-                                f"API request failed with status {response.status} - {await response.text()}"
-                            )
-                            raise ValueError(
-                                f"Request failed with status {response.status}"
-                            )
-                except aiohttp.ClientError as e:
-                    raise ValueError(f"Request error: {str(e)}")
-        raise ValueError("Max retries exceeded.")
+        # Sesión pooled del orquestador (ver utils/http_session.py) -- no
+        # abre una conexión TLS nueva por cada request. Reintentos, Retry-After,
+        # deadline y circuit breaker: ver utils/retry_policy.py.
+        session = await self._http.get()
+        return await politica_llm.post_json(
+            session,
+            url,
+            headers,
+            data,
+            process_id=process_id,
+            max_intentos=retries,
+            # Presupuesto RPM/TPM del proveedor compartido por todo el
+            # proceso (ver utils/rate_budget.py): post_json lo pide antes de
+            # cada intento en vez de comerse un 429.
+            presupuesto=presupuesto_para(url),
+            # Concurrencia adaptativa (AIMD) hacia el proveedor, un lugar por
+            # intento HTTP -- ver utils/adaptive_concurrency.py.
+            limitador=limitador_para(url),
+            medir=medir,
+        )
 
     async def tool_handler(
         self,
@@ -373,8 +430,11 @@ class InvoiceOrchestrator:
         messages: list,
         tool_name: str,
         process_id: str,
-        model: str = "gemini-3.5-flash",
+        model: Optional[str] = None,
         max_retries: int = 6,
+        validar_schema: bool = True,
+        mensajes_completos: Optional[list] = None,
+        parcial: bool = False,
     ):
         url = "https://generativelanguage.googleapis.com/v1beta/openai/chat/completions"
         headers = {
@@ -390,21 +450,29 @@ class InvoiceOrchestrator:
                 "function": {"name": tool_name},
             },
         }
-        schema = next(
-            (
-                tool["function"]["parameters"]
-                for tool in tools
-                if tool["function"]["name"] == tool_name
-            ),
-            None,
-        )
+        # Validador compilado y cacheado (ver utils/schema_validators.py).
+        schema = schema_de_tool(tools, tool_name)
         tool_output = None
+        turnos_reparacion = 0
+        # Cascada de modelos (ver utils/model_cascade.py); un model explícito
+        # la reemplaza por ese único modelo.
+        cascada = ModelCascade([model]) if model else self.cascada
+        fallas = 0
         for attempt in range(0, max_retries):
             try:
-                response = await self.make_api_request(
-                    url=url,
-                    headers=headers,
-                    data=data,
+                nivel, modelo = cascada.modelo(fallas)
+                data["model"] = modelo
+                # Con LLM_HEDGING, si tarda más que el p90 de la tool se
+                # dispara una request idéntica (ver utils/hedging.py).
+                response = await cobertura_llm.ejecutar(
+                    f"{tool_name}:{modelo}",
+                    lambda medir: self.make_api_request(
+                        url=url,
+                        headers=headers,
+                        data=data,
+                        process_id=process_id,
+                        medir=medir,
+                    ),
                     process_id=process_id,
                 )
 
@@ -420,9 +488,44 @@ class InvoiceOrchestrator:
                     raise ValueError("No tool output")
 
                 usage = response["usage"]
+                tool_call_id = (
+                    response["choices"][0]["message"]["tool_calls"][0].get("id")
+                    or f"call_{attempt}"
+                )
 
-                validate(instance=tool_output, schema=schema)
-                app_logger.info("✅ Validation passed.")
+                # validar_schema=False solo para la llamada combinada, que
+                # se valida por sección (ver extraer_con_schema_combinado).
+                if validar_schema:
+                    try:
+                        validar(schema, tool_output)
+                    except ValidationError:
+                        # Primero, reparación local sin request extra (enum,
+                        # número como string, propiedades de más -- ver
+                        # utils/schema_repair.py).
+                        reparado, cambios = reparar_localmente(schema, tool_output)
+                        if reparado is None:
+                            raise
+                        app_logger.info(f"🩹 '{tool_name}' reparado localmente: {cambios}")
+                        tool_output = reparado
+                    app_logger.info("✅ Validation passed.")
+
+                    # Válida pero inconsistente (montos, CUIT): escala de una
+                    # al siguiente modelo; en el último nivel se acepta igual.
+                    # parcial = un bloque de páginas de los ítems: las sumas se
+                    # chequean sobre el resultado unido (ver
+                    # utils/toolchain.extraer_items_por_bloques).
+                    problemas = [] if parcial else chequear_consistencia(tool_name, tool_output)
+                    if problemas:
+                        if nivel < cascada.ultimo_nivel and attempt < max_retries - 1:
+                            app_logger.warning(
+                                f"⚖️ '{tool_name}' inconsistente con {modelo}, escala a {cascada.modelos[nivel + 1]}: {problemas}"
+                            )
+                            fallas = cascada.fallas_para_nivel(nivel + 1)
+                            data["messages"] = messages
+                            continue
+                        app_logger.warning(
+                            f"⚖️ '{tool_name}' inconsistente con {modelo} (se acepta): {problemas}"
+                        )
                 return {
                     "content": [
                         {
@@ -437,11 +540,37 @@ class InvoiceOrchestrator:
                         "output_tokens": usage["completion_tokens"],
                         "service_tier": "standard",
                     },
+                    "model": modelo,
+                    "tier": nivel,
                 }
                 # return {"content": tool_output, "usage": usage, "tool_name": tool_name}
             except ValidationError as e:
                 # Notifica error de validación
                 app_logger.error(f"❌ Validation error for '{tool_name}': {e.message}")
+                fallas += 1
+                # Próximo intento: si a esta tool se le mandaron solo algunas
+                # páginas del PDF, primero se reintenta con todas (el dato
+                # que falta puede estar en otra página). Si no, un turno de
+                # reparación con la salida previa y los errores concretos; si
+                # ese turno ya se usó, vuelve a la re-extracción completa con
+                # el request original.
+                if mensajes_completos is not None and mensajes_completos != messages:
+                    app_logger.warning(
+                        f"📄 '{tool_name}' no validó con las páginas ruteadas, se reintenta con todas"
+                    )
+                    messages = mensajes_completos
+                    data["messages"] = messages
+                elif turnos_reparacion < MAX_TURNOS_REPARACION:
+                    turnos_reparacion += 1
+                    data["messages"] = messages + turno_reparacion_openai(
+                        tool_call_id,
+                        tool_name,
+                        tool_output,
+                        getattr(e, "errores", [e.message]),
+                    )
+                else:
+                    turnos_reparacion = 0
+                    data["messages"] = messages
                 # error_message = {
                 #     "tool_name": tool_name,
                 #     "tool_output": tool_output,
@@ -456,7 +585,11 @@ class InvoiceOrchestrator:
                 #     timeout=10,
                 # )
                 # app_logger.error(f"Webhook Status Code: {error_response.status_code}")
-                if attempt < max_retries:
+                # max_retries - 1: con "< max_retries" (siempre cierto) el
+                # último intento caía al final del for y devolvía None, y
+                # formatear_factura reventaba con un error críptico (mismo
+                # fix que en routes/process_invoice_google_2.py).
+                if attempt < max_retries - 1:
                     app_logger.warning("🔄 Retrying...")
                     continue
                 else:
@@ -464,6 +597,12 @@ class InvoiceOrchestrator:
                     raise ValueError(
                         f"Max retries exceeded for '{tool_name}'. Last error: {e.message}"
                     )
+            except UpstreamUnavailableError as e:
+                # Los reintentos de transporte (con backoff y deadline) ya se
+                # hicieron en utils/retry_policy.py -- volver a reintentar acá
+                # multiplicaba la espera con el proveedor caído.
+                app_logger.error(f"❌ Upstream no disponible para '{tool_name}': {e}")
+                raise
             except Exception as e:
                 # Notifica error general
                 app_logger.error(f"❌ Unexpected error: {e}")
@@ -481,70 +620,104 @@ class InvoiceOrchestrator:
                 #     timeout=10,
                 # )
                 # app_logger.error(f"Webhook Status Code: {error_response.status_code}")
-                if attempt < max_retries:
+                # Mismo off-by-one que en el except de ValidationError.
+                if attempt < max_retries - 1:
                     app_logger.warning("🔄 Retrying...")
                     continue
                 else:
                     app_logger.error("❌ Max retries exceeded.")
                     raise ValueError(
-                        f"Max retries exceeded for '{tool_name}'. Last error: {e.message}"
+                        f"Max retries exceeded for '{tool_name}'. Last error: {str(e)}"
                     )
 
-    # Procesa imágenes con Claude Vision
-    async def run_image_toolchain(
-        self,
-        item: QueueItem,
-    ):
-        # Convierte imagen a base64
-        image_file = Path(item["file_path"])
-        base64_string = base64.b64encode(image_file.read_bytes()).decode()
-
-        response = await self.tool_handler(
-            tools=[tool["data"] for tool in tools_standard],
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": tools_standard[0]["prompt"]},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{item['media_type']};base64,{base64_string}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            tool_name=tools_standard[0]["data"]["function"]["name"],
-            process_id=item["process_id"],
-        )
-
-        # Procesa con resto de herramientas en paralelo
-        tasks = []
-        for tool in tools_standard[1:]:
-            tool_res = self.tool_handler(
-                tools=[tool["data"] for tool in tools_standard],
+    async def _extraer(self, tools_standard, armar_contenido, process_id, paginas=1):
+        """
+        Corre la extracción de una factura y devuelve (respuestas, tiempos).
+        armar_contenido(prompt, idx) arma el "content" del mensaje según el
+        toolchain (imagen o páginas del PDF).
+
+        Modo normal: las 3 tools se lanzan juntas (ver utils/toolchain.py) --
+        ninguna depende de la salida de otra. Con combined_schema, una sola
+        request con las 3 secciones y fallback por sección. En PDFs de más
+        de ITEMS_PAGINAS_POR_BLOQUE páginas (`paginas`), los ítems se piden
+        por bloques de páginas en paralelo (extraer_items_por_bloques).
+        """
+        if self.combined_schema:
+            return await extraer_con_schema_combinado(
+                self.tool_handler, tools_standard, armar_contenido, process_id, self.cascada
+            )
+        definiciones = [tool["data"] for tool in tools_standard]
+        bloques = bloques_de_paginas(paginas)
+        llamadas = {}
+        for idx, tool in enumerate(tools_standard):
+            tool_name = tool["data"]["function"]["name"]
+            if bloques and tool_name == "detalle_de_items_facturados":
+                llamadas[tool_name] = extraer_items_por_bloques(
+                    self.tool_handler, definiciones, tool, idx, armar_contenido, bloques, process_id
+                )
+                continue
+            # En PDFs cada tool recibe solo sus páginas; mensajes_completos
+            # (todas) queda para reintentar si la salida no valida.
+            llamadas[tool_name] = self.tool_handler(
+                tools=definiciones,
                 messages=[
                     {
                         "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{item['media_type']};base64,{base64_string}"
-                                },
-                            },
-                            {"type": "text", "text": tool["prompt"]},
-                        ],
+                        "content": armar_contenido(tool["prompt"], idx, tool_name),
                     }
                 ],
-                tool_name=tool["data"]["function"]["name"],
+                tool_name=tool_name,
+                process_id=process_id,
+                mensajes_completos=[
+                    {"role": "user", "content": armar_contenido(tool["prompt"], idx)}
+                ],
+            )
+        return await ejecutar_tools_en_paralelo(llamadas, process_id)
+
+    # Procesa imágenes con Claude Vision
+    async def run_image_toolchain(
+        self,
+        item: QueueItem,
+    ):
+        # Cache por contenido + single-flight (ver utils/extraction_cache.py):
+        # un archivo que ya se extrajo no vuelve a pasar por el LLM.
+        clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, tools_standard)
+        async with extraction_cache.reservar(clave) as cacheado:
+            if cacheado is not None:
+                item["data"] = respuestas_desde_cache(cacheado)
+                item.update(campos_item(cacheado))
+                item["tool_timings"] = {"cache": True}
+                return item
+
+            # Preprocesada (orientación, recorte de márgenes, reducción, tramos
+            # para tickets largos -- ver utils/image_prep.py) y encodeada en el
+            # pool de render, fuera del event loop (ver utils/render_pool.py).
+            imagenes = await pool_render.ejecutar(
+                preparar_imagen, item["file_path"], item["media_type"], item["process_id"],
                 process_id=item["process_id"],
             )
-            tasks.append(tool_res)
-        results = await asyncio.gather(*tasks)
-        respuestas = [response] + results
+            image_messages = mensajes_imagen_openai(imagenes)
+
+            # La primera tool conserva el orden texto-imagen de siempre.
+            def armar_contenido(prompt, idx, tool_name=None, paginas=None):
+                text_message = {"type": "text", "text": prompt}
+                if idx == 0:
+                    return [text_message, *image_messages]
+                return [*image_messages, text_message]
+
+            # QR de AFIP leído localmente (ver utils/afip_qr.py): va como
+            # pista en el prompt de emisor/receptor y después corrige y
+            # verifica esa salida.
+            qr, tools_con_qr = await preparar_qr(item, tools_standard)
+            respuestas, tiempos = await self._extraer(
+                tools_con_qr, armar_contenido, item["process_id"]
+            )
+            item["qr_afip"] = resumen_qr(
+                qr, aplicar_qr(respuestas, qr, item["process_id"])
+            )
+            extraction_cache.guardar(clave, self.formatear_factura(respuestas)["data"], item)
         item["data"] = respuestas
+        item["tool_timings"] = tiempos
         return item
 
     # Procesa PDFs con Claude
@@ -552,65 +725,55 @@ class InvoiceOrchestrator:
         self,
         item: QueueItem,
     ):
-        doc = fitz.open(item["file_path"])
-        base64_images = []
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap(dpi=150)  # convertimos a imagen
-
-            # Convertimos el pixmap a imagen PIL
-            img = Image.open(io.BytesIO(pix.tobytes("png")))
-
-            # Guardamos en memoria y convertimos a base64
-            buffer = io.BytesIO()
-            img.save(buffer, format="PNG")
-            img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            base64_images.append(img_base64)
-
-        image_messages = [
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{img_b64}"},
-            }
-            for img_b64 in base64_images
-        ]
-
-        response = await self.tool_handler(
-            tools=[tool["data"] for tool in tools_standard],
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        *image_messages,
-                        {"type": "text", "text": tools_standard[0]["prompt"]},
-                    ],
-                }
-            ],
-            tool_name=tools_standard[0]["data"]["function"]["name"],
-            process_id=item["process_id"],
-        )
-
-        # Procesa con resto de herramientas en paralelo
-        tasks = []
-        for tool in tools_standard[1:]:
-            tool_res = self.tool_handler(
-                tools=[tool["data"] for tool in tools_standard],
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            *image_messages,
-                            {"type": "text", "text": tool["prompt"]},
-                        ],
-                    }
-                ],
-                tool_name=tool["data"]["function"]["name"],
-                process_id=item["process_id"],
+        # Cache antes de renderizar -- ver run_image_toolchain.
+        clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, tools_standard)
+        async with extraction_cache.reservar(clave) as cacheado:
+            if cacheado is not None:
+                item["data"] = respuestas_desde_cache(cacheado)
+                item.update(campos_item(cacheado))
+                item["tool_timings"] = {"cache": True}
+                return item
+
+            # Páginas con capa de texto van como texto con layout; las escaneadas,
+            # rasterizadas como siempre (ver utils/pdf_text.py). En el pool de
+            # render: un PDF grande no bloquea el event loop.
+            # Pico de RSS del render + extracción (ver utils/memoria.py).
+            async with MedidorMemoria() as memoria:
+                pdf = await pool_render.ejecutar(
+                    mensajes_pdf, item["file_path"], item["process_id"],
+                    process_id=item["process_id"],
+                )
+                image_messages = pdf["mensajes"]
+
+                def armar_contenido(prompt, idx, tool_name=None, paginas=None):
+                    # Con tool_name, solo las páginas que esa tool necesita; con
+                    # paginas, esas (un bloque de ítems -- ver _extraer).
+                    # (ver utils/pdf_text.seleccionar_paginas).
+                    return [
+                        *seleccionar_paginas(
+                            image_messages, tool_name, paginas, pdf["numeros"], pdf["total"]
+                        ),
+                        {"type": "text", "text": prompt},
+                    ]
+
+                # QR de AFIP leído localmente (ver utils/afip_qr.py): va como
+                # pista en el prompt de emisor/receptor y después corrige y
+                # verifica esa salida.
+                qr, tools_con_qr = await preparar_qr(item, tools_standard)
+                respuestas, tiempos = await self._extraer(
+                    tools_con_qr, armar_contenido, item["process_id"], len(image_messages)
+                )
+            item["memoria"] = memoria.resumen(item["process_id"], paginas=len(image_messages))
+            # PDF cortado por PDF_MAX_PAGINAS / PDF_PRESUPUESTO_MB: que se vea
+            # en la factura, no solo en el log (ver utils/pdf_text.py).
+            if pdf["omitidas"]:
+                item["paginas_omitidas"] = pdf["omitidas"]
+            item["qr_afip"] = resumen_qr(
+                qr, aplicar_qr(respuestas, qr, item["process_id"])
             )
-            tasks.append(tool_res)
-        results = await asyncio.gather(*tasks)
-        respuestas = [response] + results
+            extraction_cache.guardar(clave, self.formatear_factura(respuestas)["data"], item)
         item["data"] = respuestas
+        item["tool_timings"] = tiempos
         return item
 
     # Guarda los datos de la factura en Google Sheets
@@ -799,9 +962,14 @@ class InvoiceOrchestrator:
                     datos_factura["impuestos"] = tool_content.get("input", {})
 
         app_logger.info("Formateo completado.")
+        # Qué modelo/nivel de la cascada produjo cada sección (ver
+        # utils/model_cascade.py) -- para ajustar los umbrales con datos reales.
+        modelos = modelos_por_seccion(factura_completa)
+        app_logger.info(f"📊 Modelos por sección: {modelos}")
         return {
             "data": datos_factura,
             "tokens": total_tokens,
+            "modelos": modelos,
         }
 
     def get_file_type_from_url(self, url: str) -> str:
@@ -964,6 +1132,8 @@ orchestrator = InvoiceOrchestrator(
     queue_check_cooldown=20,
     model="gemini-3.5-flash",
     semaphore=3,
+    combined_schema=os.getenv("GEMINI_COMBINED_SCHEMA", "false").lower()
+    in ("1", "true"),
 )
 
 
@@ -1218,7 +1388,16 @@ async def get_queue_status():
 
     Returns:
         dict: Contains 'queue_size' key with a dictionary of active processing tasks,
-              where each key is a process ID and value contains file processing details
+              where each key is a process ID and value contains file processing details,
+              'rate_budget' with the per-provider RPM/TPM budget and queue wait
+              metrics (see utils/rate_budget.py), and 'concurrency' with the
+              current adaptive concurrency limit per provider and its history
+              (see utils/adaptive_concurrency.py), and 'hedging' with the
+              hedged-request counters and current thresholds per tool
+              (see utils/hedging.py), 'render_pool' with the PDF render
+              pool size and its queue wait metrics (see utils/render_pool.py),
+              and 'cola' with the durable queue's job counts by state (see
+              utils/durable_queue.py)
 
     Example response:
         {
@@ -1230,10 +1409,48 @@ async def get_queue_status():
                     "media_type": "application/pdf",
                     "process_id": "process_123"
                 }
+            },
+            "rate_budget": {
+                "generativelanguage.googleapis.com": {
+                    "rpm": 150, "tpm": 1000000, "en_cola": 0, "llamadas": 42,
+                    "esperas": 3, "espera_total_s": 7.5, "espera_max_s": 4.1,
+                    "espera_ultima_s": 0.0
+                }
+            },
+            "concurrency": {
+                "generativelanguage.googleapis.com": {
+                    "limite": 7, "en_vuelo": 3, "p95_s": 12.4,
+                    "historial": [
+                        {"ts": 1760000000.0, "limite": 9, "motivo": "inicio"},
+                        {"ts": 1760000120.5, "limite": 4, "motivo": "status 429"},
+                        {"ts": 1760000300.2, "limite": 7, "motivo": "sube"}
+                    ]
+                }
+            },
+            "hedging": {
+                "activa": true, "coberturas": 12, "ganadas": 9,
+                "descartadas_por_tope": 0,
+                "umbrales_s": {"detalle_de_items_facturados:gemini-3.5-flash": 18.2}
+            },
+            "render_pool": {
+                "workers": 2, "tipo": "thread", "tareas": 57, "en_cola": 0,
+                "espera_total_s": 3.2, "espera_max_s": 1.4,
+                "espera_ultima_s": 0.0, "trabajo_total_s": 41.7
+            },
+            "cola": {
+                "cola": "gemini_email", "pendiente": 1, "en_curso": 1, "hecho": 37,
+                "fallido": 0, "espera_max_s": 12.3, "max_intentos": 3
             }
         }
     """
-    return {"queue_size": orchestrator.active_comparisons}
+    return {
+        "queue_size": orchestrator.active_comparisons,
+        "rate_budget": metricas_presupuestos(),
+        "concurrency": estado_limitadores(),
+        "hedging": cobertura_llm.estado(),
+        "render_pool": pool_render.estado(),
+        "cola": orchestrator.job_queue.estado(),
+    }
 
 
 @router.post(
@@ -1415,7 +1632,7 @@ async def webhook_endpoint(request: Request):
         app_logger.info(
             f"📤 Encolando job {process_id} con {len(items_to_process)} items"
         )
-        await orchestrator.job_queue.put(job)
+        orchestrator.job_queue.encolar(job)
         app_logger.info(f"✅ Job {process_id} encolado exitosamente")
 
         # Respuesta inmediata
@@ -15,25 +15,18 @@ import shutil
 import json
 import base64
 import asyncio
-import ssl
 import mimetypes
 import uuid
 import datetime
 import unicodedata
-from pathlib import Path
 from typing import Dict, Optional, Union, TypedDict
-import fitz  # PyMuPDF
-from PIL import Image
-import io
 from dotenv import load_dotenv
 
 # Third-party imports
-import aiohttp
-import certifi
 import filetype
 import requests
 import zipfile
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
@@ -42,6 +35,45 @@ from googleapiclient.http import MediaFileUpload
 from tools import tools
 from tools_standard import build_tools
 from utils.bas import BasClient, BasApiError
+from utils.adaptive_concurrency import estado_limitadores, limitador_para
+from utils.afip_qr import aplicar_qr, preparar_qr, resumen_qr
+from utils.batch_lane import (
+    BULK_LANE_ACTIVO,
+    MAX_JOBS as BULK_MAX_JOBS,
+    GeminiBatchClient,
+    armar_request_nativa,
+)
+from utils.durable_queue import WORKERS as COLA_WORKERS, ColaDurable, pasos_hechos
+from utils.extraction_cache import campos_item, extraction_cache, respuestas_desde_cache
+from utils.hedging import cobertura_llm
+from utils.http_session import SharedHttpSession
+from utils.image_prep import mensajes_imagen_openai, preparar_imagen
+from utils.memoria import MedidorMemoria
+from utils.model_cascade import (
+    ModelCascade,
+    cascada_desde_env,
+    chequear_consistencia,
+    modelos_por_seccion,
+)
+from utils.near_duplicates import campos_pocketbase, huella, id_documento, indice_duplicados
+from utils.pdf_split import CONCURRENCIA as CONCURRENCIA_DIVISION, dividir_pdf
+from utils.pdf_text import mensajes_pdf, seleccionar_paginas
+from utils.pipeline import Etapa, EtapaIncompleta, Pipeline
+from utils.rate_budget import metricas_presupuestos, presupuesto_para
+from utils.render_pool import pool_render
+from utils.retry_policy import UpstreamUnavailableError, politica_llm
+from utils.schema_repair import (
+    MAX_TURNOS_REPARACION,
+    reparar_localmente,
+    turno_reparacion_openai,
+)
+from utils.schema_validators import schema_de_tool, validar
+from utils.toolchain import (
+    bloques_de_paginas,
+    ejecutar_tools_en_paralelo,
+    extraer_con_schema_combinado,
+    extraer_items_por_bloques,
+)
 from utils.pocketbase_client import PocketBaseClient
 from utils.rate_limit import limiter
 from utils.bas_config import (
@@ -196,6 +228,24 @@ def formatear_impuestos(impuestos):
     return "\n".join(resultado)
 
 
+# Lo que cada factura de un job de email ya hizo y no se repite si el job se
+# vuelve a entregar después de un restart (ver _anotar / ColaDurable.anotar):
+# filas de Sheets, altas en PocketBase y BAS, Drive, email y webhook.
+PASOS_DURABLES = (
+    "saved_sheet",
+    "saved_items",
+    "pb_invoice",
+    "pb_items",
+    "pb_lineas",
+    "pb_items_parcial",
+    "bas",
+    "drive_file_id",
+    "email_enviado",
+    "webhook_enviado",
+    "terminado",
+)
+
+
 # Definición de tipo para elementos en cola que contienen información del archivo
 class QueueItem(TypedDict):
     file_name: str
@@ -215,6 +265,7 @@ class InvoiceOrchestrator:
         queue_check_cooldown: int,
         model: str,
         semaphore: int,
+        combined_schema: bool = False,
     ):
         self.secret = secret
         self.webhook_url = webhook_url
@@ -222,6 +273,16 @@ class InvoiceOrchestrator:
         self.recharge_cooldown = recharge_cooldown
         self.queue_check_cooldown = queue_check_cooldown
         self.model = model
+        # Modelos del más barato al más fuerte (ver utils/model_cascade.py).
+        self.cascada = cascada_desde_env("GEMINI_MODEL_CASCADE", [model])
+        # Opt-in: 1 request por factura con las 3 secciones juntas en vez de
+        # 3 requests (ver utils/toolchain.extraer_con_schema_combinado).
+        self.combined_schema = combined_schema
+        # Carril bulk para ZIPs y jobs de email (ver utils/batch_lane.py).
+        self.bulk_lane = BULK_LANE_ACTIVO
+        self._batch = GeminiBatchClient(api_key)
+        self._jobs_en_lote = set()  # jobs de email esperando su batch (ver worker)
+        self._cupo_lote = asyncio.Semaphore(BULK_MAX_JOBS)
         self.semaphore = asyncio.Semaphore(semaphore)
         self.queue = asyncio.Queue()
         self.active_comparisons = {}
@@ -230,373 +291,596 @@ class InvoiceOrchestrator:
         self._bas_client = BasClient()
         self._proveedores_bas_cache = {}  # Cache de proveedores BAS ya verificados/creados (key: CUIT normalizado)
         self._pb_client = PocketBaseClient()  # Persistencia (facturas/items/jobs/estado BAS); ver utils/pocketbase_client.py
-        self.job_queue = asyncio.Queue()  # Cola para jobs
+        # Cola durable (SQLite): sobrevive a un restart (ver utils/durable_queue.py)
+        self.job_queue = ColaDurable("gemini2_email")
+        # Archivos sueltos y ZIPs de /process-invoice, /website-upload y el
+        # reintento -- antes eran asyncio.create_task sueltos que un restart
+        # perdía (ver worker_archivos).
+        self.cola_archivos = ColaDurable("gemini2_archivos")
+        self._http = SharedHttpSession()  # Sesión HTTP pooled para la API de Gemini
+        # Lo que pasa con cada factura, por etapas con su cola, sus workers y
+        # sus reintentos (ver utils/pipeline.py). ERP con 1 worker: la
+        # búsqueda/alta de proveedores en BAS no es segura en paralelo (dos
+        # facturas del mismo CUIT darían de alta el proveedor dos veces).
+        self.pipeline = Pipeline(
+            "gemini2",
+            [
+                Etapa("extraer", self._etapa_extraer, workers=2, capacidad=4, obligatoria=True),
+                Etapa("persistir", self._etapa_persistir, workers=2, intentos=3),
+                Etapa("erp", self._etapa_erp, workers=1, capacidad=16),
+                Etapa("archivar", self._etapa_archivar, workers=2, intentos=3),
+                Etapa("notificar", self._etapa_notificar, workers=2, intentos=2),
+            ],
+        )
         asyncio.create_task(self.worker())
+        for _ in range(COLA_WORKERS):
+            asyncio.create_task(self.worker_archivos())
 
     async def worker(self):
         app_logger.info("Iniciando worker")
         while True:
-            job = await self.job_queue.get()
-            from_email = job["from_email"]
-            subject = job["subject"]
-            temp_dir = job["temp_dir"]
-            process_id = job["process_id"]
-
-            app_logger.info(f"From email: {from_email}")
-            app_logger.info(f"Subject: {subject}")
+            if self.bulk_lane and extraction_cache.habilitado:
+                # Carril bulk: el job espera su batch (hasta BULK_TIMEOUT_MIN)
+                # en su propia tarea y el worker sigue con el próximo, en vez
+                # de frenar todos los jobs de email detrás de un batch. El
+                # lease del trabajo lo mantiene su heartbeat mientras tanto
+                # (ver utils/durable_queue.py). El cupo se pide ANTES de
+                # tomar: con BULK_MAX_JOBS en vuelo, el resto sigue
+                # pendiente en la cola en vez de quedar arrendado.
+                await self._cupo_lote.acquire()
+                trabajo = await self.job_queue.tomar()
+                tarea = asyncio.create_task(self._procesar_job(trabajo))
+                self._jobs_en_lote.add(tarea)
+                tarea.add_done_callback(self._jobs_en_lote.discard)
+                tarea.add_done_callback(lambda _: self._cupo_lote.release())
+                continue
+            trabajo = await self.job_queue.tomar()
+            await self._procesar_job(trabajo)
+
+    async def _procesar_job(self, trabajo: dict):
+        """Un job de email de job_queue: sus archivos pasan por el pipeline
+        y el trabajo se confirma al final (ver worker)."""
+        job = trabajo["payload"]
+        from_email = job["from_email"]
+        subject = job["subject"]
+        temp_dir = job["temp_dir"]
+        process_id = job["process_id"]
+
+        app_logger.info(f"From email: {from_email}")
+        app_logger.info(f"Subject: {subject}")
+
+        file_name = temp_dir.split("/")[-1]
+        app_logger.info(f"File name: {file_name}")
+
+        subject_for_file = f"{subject} terminamos con el archivo {file_name}"
+        app_logger.info(f"Subject for file: {subject_for_file}")
+
+        if process_id in self.processed_jobs:
+            app_logger.info(f"Job {process_id} ya procesado, skipping")
+            await self.job_queue.confirmar(trabajo)
+            return
+
+        # Respaldo de idempotencia que sobrevive un restart (self.processed_jobs
+        # es en memoria y se pierde). Fail open: si PocketBase no responde, no
+        # bloqueamos el procesamiento -- solo logueamos y seguimos con el
+        # chequeo en memoria de arriba.
+        try:
+            job_previo = self._pb_client.get_processing_job(process_id)
+            if job_previo is not None and job_previo.get("status") == "done":
+                app_logger.info(
+                    f"Job {process_id} ya marcado 'done' en PocketBase (restart), skipping"
+                )
+                self.processed_jobs.add(process_id)
+                await self.job_queue.confirmar(trabajo)
+                return
+        except Exception as e:
+            app_logger.warning(
+                f"PocketBase: error chequeando idempotencia de {process_id}: {e}"
+            )
 
-            file_name = temp_dir.split("/")[-1]
-            app_logger.info(f"File name: {file_name}")
+        self.processed_jobs.add(process_id)
 
-            subject_for_file = f"{subject} terminamos con el archivo {file_name}"
-            app_logger.info(f"Subject for file: {subject_for_file}")
+        items_to_process = await self._dividir_items(trabajo, process_id)
+        total_items = len(items_to_process)
+        app_logger.info(
+            f"Iniciando procesamiento del job {process_id} - {total_items} archivos en cola"
+        )
 
-            if process_id in self.processed_jobs:
-                app_logger.info(f"Job {process_id} ya procesado, skipping")
-                self.job_queue.task_done()
-                continue
+        # Best-effort: registra el arranque del job. Aislado -- un fallo acá
+        # no debe impedir el procesamiento.
+        try:
+            # total_items no es un campo del schema de processing_jobs (ver
+            # contrato) -- se omite para no mandar un campo que PocketBase
+            # ignora silenciosamente. from_email/subject/file_name sí lo son
+            # y ya están disponibles acá -- se envían para no perder
+            # trazabilidad de origen del job.
+            self._pb_client.update_processing_job(
+                process_id,
+                status="processing",
+                from_email=from_email,
+                subject=subject,
+                file_name=file_name,
+            )
+        except Exception as e:
+            app_logger.warning(f"PocketBase: error creando/actualizando processing_job {process_id}: {e}")
 
-            # Respaldo de idempotencia que sobrevive un restart (self.processed_jobs
-            # es en memoria y se pierde). Fail open: si PocketBase no responde, no
-            # bloqueamos el procesamiento -- solo logueamos y seguimos con el
-            # chequeo en memoria de arriba.
-            try:
-                job_previo = self._pb_client.get_processing_job(process_id)
-                if job_previo is not None and job_previo.get("status") == "done":
+        try:
+            self.active_comparisons[process_id] = job
+
+            # Carril bulk (opt-in): las extracciones del job van juntas por
+            # el endpoint de batch y quedan en el cache; la etapa de
+            # extracción de abajo las encuentra ahí (ver precargar_lote /
+            # utils/batch_lane.py).
+            await self.precargar_lote(items_to_process, nombre=process_id)
+
+            async def _procesar_item(i, item):
+                file_name = item["file_name"]
+                # Si el job se vuelve a entregar (restart a la mitad), cada
+                # item retoma con lo que ya hizo: las etapas no repiten los
+                # pasos que figuran en su progreso (ver _anotar).
+                clave = f"item-{i}"
+                hechos = pasos_hechos(trabajo, clave)
+                if hechos.get("terminado"):
                     app_logger.info(
-                        f"Job {process_id} ya marcado 'done' en PocketBase (restart), skipping"
+                        f"[{process_id}] Archivo {i}/{total_items}: {file_name} ya procesado antes de un restart, se saltea"
                     )
-                    self.processed_jobs.add(process_id)
-                    self.job_queue.task_done()
-                    continue
-            except Exception as e:
-                app_logger.warning(
-                    f"PocketBase: error chequeando idempotencia de {process_id}: {e}"
+                    return 1
+                app_logger.info(
+                    f"[{process_id}] Procesando archivo {i}/{total_items}: {file_name} (tipo: {item['media_type']})"
                 )
+                try:
+                    # Extracción, Sheets, PocketBase, BAS, Drive, email y
+                    # webhook: etapas del pipeline (ver utils/pipeline.py).
+                    ctx = await self.pipeline.procesar(
+                        {
+                            **hechos,
+                            "canal": "email",
+                            # Las partes de un PDF dividido traen su propio
+                            # process_id (ver _facturas_del_pdf).
+                            "process_id": item.get("process_id") or process_id,
+                            "item": item,
+                            "from_email": from_email,
+                            "subject_for_file": subject_for_file,
+                            "trabajo": trabajo,
+                            "clave_progreso": clave,
+                        }
+                    )
+                    ctx["terminado"] = True
+                    await self._anotar(ctx)
+                    app_logger.info(
+                        f"[{process_id}] ✅ Archivo {file_name} procesado exitosamente"
+                    )
+                    return 1
+                except Exception as e:
+                    app_logger.error(
+                        f"[{process_id}] ❌ Error procesando {file_name}: {e}"
+                    )
+                    await self.fire_webhook(
+                        {
+                            "process_id": process_id,
+                            "file_name": item["file_name"],
+                            "error": str(e),
+                            "status": "error",
+                            "success": False,
+                        }
+                    )
+                    return 0
+
+            # Todos los items del job entran juntos al pipeline, así la
+            # extracción de uno se solapa con el BAS/Drive del anterior. Los
+            # que comparten process_id (el mismo registro en PocketBase) no
+            # se pisan al crearlo: el upsert está serializado por clave (ver
+            # PocketBaseClient._upsert).
+            processed_count = sum(
+                await asyncio.gather(
+                    *(
+                        _procesar_item(i, item)
+                        for i, item in enumerate(items_to_process, 1)
+                    )
+                )
+            )
 
-            self.processed_jobs.add(process_id)
-
-            items_to_process = job["items_to_process"]
-            total_items = len(items_to_process)
+            # Cleanup
             app_logger.info(
-                f"Iniciando procesamiento del job {process_id} - {total_items} archivos en cola"
+                f"[{process_id}] Limpiando directorio temporal: {os.path.dirname(job['temp_dir'])}"
+            )
+            shutil.rmtree(os.path.dirname(job["temp_dir"]))
+            app_logger.info(
+                f"[{process_id}] 🎉 Job completado - {processed_count}/{total_items} archivos procesados exitosamente"
             )
 
-            # Best-effort: registra el arranque del job. Aislado -- un fallo acá
-            # no debe impedir el procesamiento.
             try:
-                # total_items no es un campo del schema de processing_jobs (ver
-                # contrato) -- se omite para no mandar un campo que PocketBase
-                # ignora silenciosamente. from_email/subject/file_name sí lo son
-                # y ya están disponibles acá -- se envían para no perder
-                # trazabilidad de origen del job.
+                # processed_count no es un campo del schema de processing_jobs
+                # (ver contrato) -- se omite, mismo criterio que arriba.
                 self._pb_client.update_processing_job(
                     process_id,
-                    status="processing",
+                    status="done",
                     from_email=from_email,
                     subject=subject,
                     file_name=file_name,
                 )
             except Exception as e:
-                app_logger.warning(f"PocketBase: error creando/actualizando processing_job {process_id}: {e}")
+                app_logger.warning(
+                    f"[{process_id}] PocketBase: error marcando processing_job done: {e}"
+                )
 
+        except Exception as e:
+            app_logger.error(f"[{process_id}] ❌ Error crítico en job: {e}")
             try:
-                self.active_comparisons[process_id] = job
-                processed_count = 0
-
-                for i, item in enumerate(items_to_process, 1):
-                    file_name = item["file_name"]
-                    media_type = item["media_type"]
-                    app_logger.info(
-                        f"[{process_id}] Procesando archivo {i}/{total_items}: {file_name} (tipo: {media_type})"
-                    )
-
-                    try:
-                        # Procesamiento según tipo de archivo
-                        if item["media_type"].startswith("image/"):
-                            app_logger.info(
-                                f"[{process_id}] Ejecutando toolchain de imagen para {file_name}"
-                            )
-                            respuestas = await self.run_image_toolchain(item)
-                        else:
-                            app_logger.info(
-                                f"[{process_id}] Ejecutando toolchain de PDF para {file_name}"
-                            )
-                            respuestas = await self.run_pdf_toolchain(item)
-
-                        app_logger.info(
-                            f"[{process_id}] Toolchain completado para {file_name}, formateando factura"
-                        )
-                        factura = self.formatear_factura(respuestas["data"])
-
-                        # Guardar factura como JSON en el directorio temporal
-                        # temp_dir = job["temp_dir"]
-                        # json_filename = (
-                        #     f"factura_{process_id}.json"
-                        # )
-                        # json_path = os.path.join(temp_dir, json_filename)
-                        # try:
-                        #     with open(json_filename, "w", encoding="utf-8") as f:
-                        #         json.dump(
-                        #             {"factura": factura},
-                        #             f,
-                        #             ensure_ascii=False,
-                        #             indent=2,
-                        #         )
-                        #     app_logger.info(
-                        #         f"[{process_id}] Factura guardada como JSON: {json_path}"
-                        #     )
-                        # except Exception as e:
-                        #     app_logger.error(
-                        #         f"[{process_id}] Error guardando JSON para {file_name}: {e}"
-                        #     )
-
-                        app_logger.info(
-                            f"[{process_id}] Guardando factura en sheets para {file_name}"
-                        )
-                        saved = self.guardar_factura_completa_en_sheets(factura["data"])
-                        app_logger.info(
-                            f"[{process_id}] Factura guardada en sheets para {file_name}"
-                        )
-
-                        # Guardar los ítems (una fila por ítem) en su pestaña.
-                        # Aislado: si falla, no rompe el resto del procesamiento.
-                        saved_items = self.guardar_items_en_sheets(
-                            factura["data"], process_id
-                        )
-                        app_logger.info(
-                            f"[{process_id}] Ítems guardados en sheets: {saved_items}"
-                        )
-
-                        # Persistencia en PocketBase (invoice + items). Aislado a
-                        # propósito, mismo criterio que guardar_items_en_sheets: un
-                        # fallo acá NO debe afectar Sheets/BAS/Drive/email.
-                        #
-                        # Nombres de campo alineados EXACTO con el schema real de
-                        # ticket-ai-infra/pocketbase/pb_migrations/ (no improvisar
-                        # nombres nuevos -- "status" es requerido y "invoice" en
-                        # invoice_items/bas_processing_status es una relation
-                        # requerida al id del record de "invoices", no al process_id).
-                        _pb_invoice_record = None
-                        try:
-                            _er = factura["data"].get("emisor_receptor", {})
-                            _cmp = _er.get("comprobante", {})
-                            _emisor = _er.get("emisor", {})
-                            _receptor = _er.get("receptor", {})
-                            _otros = _er.get("otros", {})
-                            _items_info = factura["data"].get("items", {})
-                            _detalles = _items_info.get("detalles", []) or []
-
-                            _pb_invoice_record = self._pb_client.upsert_invoice(
-                                {
-                                    "process_id": process_id,
-                                    "numero_comprobante": _cmp.get("numero"),
-                                    "fecha_emision": _cmp.get("fecha_emision"),
-                                    "tipo_comprobante": _cmp.get("tipo"),
-                                    "subtipo_comprobante": _cmp.get("subtipo"),
-                                    "moneda": _cmp.get("moneda"),
-                                    "emisor_nombre": _emisor.get("nombre"),
-                                    "emisor_cuit": _emisor.get("id_fiscal"),
-                                    "receptor_nombre": _receptor.get("nombre"),
-                                    "receptor_cuit": _receptor.get("id_fiscal"),
-                                    "subtotal": _items_info.get("subtotal"),
-                                    "total": _items_info.get("total"),
-                                    "cae": _otros.get("CAE"),
-                                    "cae_vencimiento": _otros.get("vencimiento_CAE"),
-                                    "forma_pago": _otros.get("forma_pago"),
-                                    "sheets_saved": bool(saved),
-                                    "status": "processing",
-                                }
-                            )
-                            if _pb_invoice_record and _pb_invoice_record.get("id"):
-                                self._pb_client.bulk_create_invoice_items(
-                                    _pb_invoice_record["id"],
-                                    [
-                                        {
-                                            "process_id": process_id,
-                                            "linea": idx,
-                                            "descripcion": d.get("descripcion"),
-                                            "cantidad": d.get("cantidad"),
-                                            "precio_unitario": d.get("precio_unitario"),
-                                            "precio_total": d.get("precio_total"),
-                                            "categoria": d.get("categoria"),
-                                            "bas_codigo_item": codigo_item_de_categoria(
-                                                d.get("categoria", "")
-                                            ),
-                                        }
-                                        for idx, d in enumerate(_detalles, 1)
-                                    ],
-                                )
-                            else:
-                                app_logger.warning(
-                                    f"[{process_id}] PocketBase: upsert_invoice no devolvió "
-                                    "un record válido, se omiten los ítems y el estado BAS."
-                                )
-                        except Exception as e:
-                            app_logger.warning(
-                                f"[{process_id}] PocketBase: error persistiendo invoice/items: {e}"
-                            )
-
-                        # Integración con BAS (ERP): registra la factura de compra y
-                        # best-effort intenta la orden de pago. Aislado a propósito:
-                        # un fallo acá (incluido el bloqueador conocido de OrdenesPago)
-                        # NO debe impedir que se suba a Drive ni se mande el email.
-                        resultado_bas = self.procesar_factura_en_bas(
-                            factura["data"], process_id
-                        )
-                        app_logger.info(
-                            f"[{process_id}] Resultado integración BAS: {resultado_bas}"
-                        )
-
-                        # Persistencia en PocketBase del resultado de BAS. Aislado,
-                        # mismo criterio que el resto de las llamadas a PocketBase.
-                        # Requiere el id del record de "invoices" (relation
-                        # requerida) -- si el paso anterior no lo consiguió, no hay
-                        # forma de crear este record (PocketBase lo rechazaría de
-                        # todos modos), así que se omite entero.
-                        try:
-                            if _pb_invoice_record and _pb_invoice_record.get("id"):
-                                _cmp_bas = factura["data"].get("emisor_receptor", {}).get("comprobante", {})
-                                _prefijo_ext, _numero_ext = _extraer_prefijo_numero_comprobante_externo(_cmp_bas)
-                                _proveedor_info = resultado_bas.get("proveedor") or {}
-                                _orden_pago_info = resultado_bas.get("orden_pago")
-                                if _orden_pago_info is None:
-                                    # Schema solo acepta pending/success/failed -- "no
-                                    # intentado todavía" mapea a "pending".
-                                    _orden_pago_status = "pending"
-                                elif isinstance(_orden_pago_info, dict) and _orden_pago_info.get("_error"):
-                                    _orden_pago_status = "failed"
-                                else:
-                                    _orden_pago_status = "success"
-                                self._pb_client.upsert_bas_processing_status(
-                                    process_id,
-                                    invoice=_pb_invoice_record["id"],
-                                    proveedor_resuelto=bool(resultado_bas.get("proveedor")),
-                                    proveedor_codigo=_proveedor_info.get("codigo"),
-                                    comprobante_prefijo=_prefijo_ext,
-                                    comprobante_numero=_numero_ext,
-                                    comprobante_registrado=bool(resultado_bas.get("comprobante")),
-                                    orden_pago_status=_orden_pago_status,
-                                    orden_pago_error=resultado_bas.get("error"),
-                                )
-                        except Exception as e:
-                            app_logger.warning(
-                                f"[{process_id}] PocketBase: error persistiendo bas_processing_status: {e}"
-                            )
-
-                        # Subir archivo a Google Drive
-                        app_logger.info(f"[{process_id}] Iniciando subida a Google Drive para el archivo: {file_name}")
-                        drive_file_id = self.subir_archivo_a_drive(
-                            file_path=item["file_path"],
-                            file_name=file_name,
-                            mime_type=media_type
-                        )
-                        
-                        if drive_file_id:
-                            app_logger.info(f"[{process_id}] ✅ Archivo subido exitosamente a Drive. ID: {drive_file_id}")
-                        else:
-                            app_logger.error(f"[{process_id}] ❌ Falló la subida del archivo a Google Drive.")
-
-                        # Cierra el ciclo de vida del record en PocketBase: recién acá
-                        # se conoce drive_file_id, así que el upsert inicial (arriba)
-                        # no podía incluirlo. Mismo aislamiento try/except de siempre.
-                        try:
-                            if _pb_invoice_record and _pb_invoice_record.get("id"):
-                                self._pb_client.upsert_invoice(
-                                    {
-                                        "process_id": process_id,
-                                        "drive_file_id": drive_file_id,
-                                        "status": "completed",
-                                    }
-                                )
-                        except Exception as e:
-                            app_logger.warning(
-                                f"[{process_id}] PocketBase: error actualizando drive_file_id/status: {e}"
-                            )
-
-                        html_body = self.generar_html_factura(factura["data"])
-
-                        self.enviar_email(from_email, subject_for_file, html_body)
-
-                        result = {
-                            "id": process_id,
-                            "file_name": item["file_name"],
-                            "factura": factura,
-                            "saved": saved,
-                            "saved_items": saved_items,
-                            "bas": resultado_bas,
-                            "drive_file_id": drive_file_id,
-                            "status": "procesada",
-                            "success": True,
-                        }
-
-                        app_logger.info(
-                            f"[{process_id}] Enviando webhook para {file_name}"
-                        )
-                        await self.fire_webhook(result)
-
-                        processed_count += 1
-                        app_logger.info(
-                            f"[{process_id}] ✅ Archivo {file_name} procesado exitosamente ({processed_count}/{total_items})"
-                        )
-
-                    except Exception as e:
-                        app_logger.error(
-                            f"[{process_id}] ❌ Error procesando {file_name}: {e}"
-                        )
-                        await self.fire_webhook(
-                            {
-                                "process_id": process_id,
-                                "file_name": item["file_name"],
-                                "error": str(e),
-                                "status": "error",
-                                "success": False,
-                            }
-                        )
-
-                # Cleanup
-                app_logger.info(
-                    f"[{process_id}] Limpiando directorio temporal: {os.path.dirname(job['temp_dir'])}"
+                self._pb_client.update_processing_job(
+                    process_id,
+                    status="error",
+                    error_message=str(e),
+                    from_email=from_email,
+                    subject=subject,
+                    file_name=file_name,
                 )
-                shutil.rmtree(os.path.dirname(job["temp_dir"]))
-                app_logger.info(
-                    f"[{process_id}] 🎉 Job completado - {processed_count}/{total_items} archivos procesados exitosamente"
+            except Exception as pb_e:
+                app_logger.warning(
+                    f"[{process_id}] PocketBase: error marcando processing_job error: {pb_e}"
                 )
-
+        finally:
+            if process_id in self.active_comparisons:
+                del self.active_comparisons[process_id]
+            await self.job_queue.confirmar(trabajo)
+
+    async def worker_archivos(self):
+        """Consume cola_archivos: cada trabajo es {"archivos": [kwargs de
+        _procesar_en_background, ...], "lote": id del ZIP o None,
+        "concurrencia": tope o None} (ver _procesar_lote)."""
+        while True:
+            trabajo = await self.cola_archivos.tomar()
+            try:
+                await _procesar_lote(
+                    trabajo["payload"]["archivos"],
+                    trabajo["payload"].get("lote"),
+                    trabajo["payload"].get("concurrencia"),
+                )
+            except Exception as e:
+                app_logger.error(f"Error procesando el trabajo {trabajo['id']}: {e}")
+            finally:
+                await self.cola_archivos.confirmar(trabajo)
+
+    async def _dividir_items(self, trabajo: dict, process_id: str) -> list:
+        """Items del job de email con los PDFs de varias facturas ya partidos
+        en un item por factura (ver _facturas_del_pdf / utils/pdf_split.py).
+        Se hace acá y no en webhook_endpoint: la detección de texto/QR corre
+        en el pool de render y no puede demorar la respuesta del webhook.
+
+        La lista resultante se anota en el progreso del trabajo ("division")
+        y recién entonces se borran los PDFs originales: una nueva entrega
+        usa esa lista (las claves "item-N" siguen apuntando a las mismas
+        partes) en vez de volver a dividir. Si no se pudo anotar, el
+        original queda y la próxima entrega lo divide de nuevo."""
+        division = trabajo.get("progreso", {}).get("division")
+        if division is not None:
+            return division
+        items = []
+        divididos = []
+        for item in trabajo["payload"]["items_to_process"]:
+            partes = await _facturas_del_pdf(
+                item["file_path"],
+                item["file_name"],
+                item["file_extension"].lstrip("."),
+                item["media_type"],
+                item.get("process_id") or process_id,
+            )
+            if not partes:
+                items.append(item)
+                continue
+            app_logger.info(
+                f"[{process_id}] ✂️ {item['file_name']} dividido en {len(partes)} facturas"
+            )
+            divididos.append(item["file_path"])
+            items.extend(
+                {
+                    **item,
+                    "file_name": parte["file_name"],
+                    "file_path": parte["file_location"],
+                    "process_id": parte["process_id"],
+                }
+                for parte in partes
+            )
+        if divididos and await self.job_queue.anotar(trabajo, "division", items):
+            for path in divididos:
                 try:
-                    # processed_count no es un campo del schema de processing_jobs
-                    # (ver contrato) -- se omite, mismo criterio que arriba.
-                    self._pb_client.update_processing_job(
-                        process_id,
-                        status="done",
-                        from_email=from_email,
-                        subject=subject,
-                        file_name=file_name,
-                    )
-                except Exception as e:
-                    app_logger.warning(
-                        f"[{process_id}] PocketBase: error marcando processing_job done: {e}"
+                    os.remove(path)
+                except OSError as e:
+                    app_logger.warning(f"[{process_id}] No se pudo borrar {path}: {e}")
+        return items
+
+    async def _anotar(self, ctx: dict) -> None:
+        """Canal email: guarda en el trabajo de job_queue los PASOS_DURABLES
+        que la factura ya completó, así una nueva entrega del job no los
+        repite (ver ColaDurable.anotar_pasos)."""
+        trabajo = ctx.get("trabajo")
+        if trabajo is None:
+            return
+        await self.job_queue.anotar_pasos(
+            trabajo, ctx["clave_progreso"], ctx, PASOS_DURABLES
+        )
+
+    # Etapas del pipeline (ver utils/pipeline.py). Cada una recibe el
+    # contexto de la factura: {"canal": "email" | "archivo", "process_id",
+    # "item", y en el canal email "from_email"/"subject_for_file"}, y le deja
+    # sus resultados. Lo sincrónico (Sheets, PocketBase, BAS, Drive, SMTP) va
+    # en asyncio.to_thread para no frenar el event loop.
+
+    async def _etapa_extraer(self, ctx: dict) -> None:
+        item = ctx["item"]
+        if item["media_type"].startswith("image"):
+            app_logger.info(f"[{ctx['process_id']}] Ejecutando toolchain de imagen para {item['file_name']}")
+            ctx["respuestas"] = await self.run_image_toolchain(item)
+        else:
+            app_logger.info(f"[{ctx['process_id']}] Ejecutando toolchain de PDF para {item['file_name']}")
+            ctx["respuestas"] = await self.run_pdf_toolchain(item)
+        ctx["factura"] = self.formatear_factura(ctx["respuestas"]["data"])
+
+    async def _etapa_persistir(self, ctx: dict) -> None:
+        """Sheets (factura + pestaña de ítems) y PocketBase (invoice + ítems).
+        Lo que ya se guardó queda en ctx y un reintento no lo repite."""
+        process_id = ctx["process_id"]
+        data = ctx["factura"]["data"]
+        if not ctx.get("saved_sheet"):
+            ctx["saved_sheet"] = await asyncio.to_thread(
+                self.guardar_factura_completa_en_sheets, data
+            )
+            await self._anotar(ctx)
+        if not ctx.get("saved_items"):
+            ctx["saved_items"] = await asyncio.to_thread(
+                self.guardar_items_en_sheets, data, process_id
+            )
+            await self._anotar(ctx)
+        if not ctx.get("pb_items"):
+            await asyncio.to_thread(self._persistir_en_pocketbase, ctx)
+            await self._anotar(ctx)
+        # None = sin configurar (SHEET_ID_2 vacío; ver los guardar_* de
+        # Sheets): no tiene sentido reintentar. False = falló.
+        pendientes = [
+            paso for paso in ("saved_sheet", "saved_items", "pb_items") if ctx.get(paso) is False
+        ]
+        if pendientes:
+            raise EtapaIncompleta(f"no se pudo guardar: {', '.join(pendientes)}")
+
+    def _persistir_en_pocketbase(self, ctx: dict) -> None:
+        """Invoice + ítems en PocketBase. Nombres de campo alineados EXACTO con
+        el schema real de ticket-ai-infra/pocketbase/pb_migrations/ (no
+        improvisar nombres nuevos -- "status" es requerido y "invoice" en
+        invoice_items/bas_processing_status es una relation requerida al id
+        del record de "invoices", no al process_id).
+
+        En el canal email el record queda "processing" hasta que se conoce el
+        drive_file_id (ver _etapa_archivar); el canal archivo no sube a Drive
+        ni manda email, así que se marca "completed" directo.
+
+        Los ítems van todos en un solo bulk_create_invoice_items y las líneas
+        que entraron quedan en ctx["pb_lineas"] (lista ordenada, para que
+        _anotar la pueda guardar). Si el bulk falla, no se sabe cuáles
+        entraron (ctx["pb_items_parcial"]): el reintento lee las que ya están
+        en PocketBase y crea el resto de a una, en vez de duplicarlas."""
+        process_id = ctx["process_id"]
+        factura = ctx["factura"]
+        try:
+            _er = factura["data"].get("emisor_receptor", {})
+            _cmp = _er.get("comprobante", {})
+            _emisor = _er.get("emisor", {})
+            _receptor = _er.get("receptor", {})
+            _otros = _er.get("otros", {})
+            _items_info = factura["data"].get("items", {})
+            _detalles = _items_info.get("detalles", []) or []
+
+            if not ctx.get("pb_invoice"):
+                ctx["pb_invoice"] = self._pb_client.upsert_invoice(
+                    {
+                        "process_id": process_id,
+                        "numero_comprobante": _cmp.get("numero"),
+                        "fecha_emision": _cmp.get("fecha_emision"),
+                        "tipo_comprobante": _cmp.get("tipo"),
+                        "subtipo_comprobante": _cmp.get("subtipo"),
+                        "moneda": _cmp.get("moneda"),
+                        "emisor_nombre": _emisor.get("nombre"),
+                        "emisor_cuit": _emisor.get("id_fiscal"),
+                        "receptor_nombre": _receptor.get("nombre"),
+                        "receptor_cuit": _receptor.get("id_fiscal"),
+                        "subtotal": _items_info.get("subtotal"),
+                        "total": _items_info.get("total"),
+                        "cae": _otros.get("CAE"),
+                        "cae_vencimiento": _otros.get("vencimiento_CAE"),
+                        "forma_pago": _otros.get("forma_pago"),
+                        "sheets_saved": bool(ctx.get("saved_sheet")),
+                        "status": "processing" if ctx["canal"] == "email" else "completed",
+                        **campos_pocketbase(ctx["respuestas"].get("duplicado")),
+                        # Opcional, solo si el PDF se cortó (ver
+                        # utils/pdf_text.mensajes_pdf).
+                        **(
+                            {"paginas_omitidas": ctx["respuestas"]["paginas_omitidas"]}
+                            if ctx["respuestas"].get("paginas_omitidas")
+                            else {}
+                        ),
+                    }
+                )
+            if ctx["pb_invoice"] and ctx["pb_invoice"].get("id"):
+                items = [
+                    {
+                        "process_id": process_id,
+                        "linea": idx,
+                        "descripcion": d.get("descripcion"),
+                        "cantidad": d.get("cantidad"),
+                        "precio_unitario": d.get("precio_unitario"),
+                        "precio_total": d.get("precio_total"),
+                        "categoria": d.get("categoria"),
+                        "bas_codigo_item": codigo_item_de_categoria(
+                            d.get("categoria", "")
+                        ),
+                    }
+                    for idx, d in enumerate(_detalles, 1)
+                ]
+                invoice_id = ctx["pb_invoice"]["id"]
+                lineas = set(ctx.get("pb_lineas", []))
+                if ctx.get("pb_items_parcial"):
+                    lineas.update(
+                        r.get("linea") for r in self._pb_client.get_invoice_items(invoice_id)
                     )
+                    for item in items:
+                        if item["linea"] not in lineas and self._pb_client.bulk_create_invoice_items(
+                            invoice_id, [item]
+                        ):
+                            lineas.add(item["linea"])
+                else:
+                    faltan = [item for item in items if item["linea"] not in lineas]
+                    if self._pb_client.bulk_create_invoice_items(invoice_id, faltan):
+                        lineas.update(item["linea"] for item in faltan)
+                    else:
+                        ctx["pb_items_parcial"] = True
+                ctx["pb_lineas"] = sorted(linea for linea in lineas if linea is not None)
+                ctx["pb_items"] = all(item["linea"] in lineas for item in items)
+            else:
+                app_logger.warning(
+                    f"[{process_id}] PocketBase: upsert_invoice no devolvió "
+                    "un record válido, se omiten los ítems y el estado BAS."
+                )
+                ctx["pb_items"] = False
+        except Exception as e:
+            app_logger.warning(
+                f"[{process_id}] PocketBase: error persistiendo invoice/items: {e}"
+            )
+            ctx["pb_items"] = False
+
+    async def _etapa_erp(self, ctx: dict) -> None:
+        """Integración con BAS: registra la factura de compra y best-effort
+        intenta la orden de pago (ver procesar_factura_en_bas), y persiste el
+        resultado en PocketBase. Sin reintentos por default: el alta en BAS no
+        es idempotente (por lo mismo, si el job de email se vuelve a entregar
+        no se repite: ver _anotar)."""
+        process_id = ctx["process_id"]
+        resultado_bas = ctx.get("bas")
+        if resultado_bas is None:
+            resultado_bas = await asyncio.to_thread(
+                self.procesar_factura_en_bas, ctx["factura"]["data"], process_id
+            )
+            ctx["bas"] = resultado_bas
+            await self._anotar(ctx)
+        app_logger.info(f"[{process_id}] Resultado integración BAS: {resultado_bas}")
+
+        # Requiere el id del record de "invoices" (relation requerida) -- si
+        # la etapa anterior no lo consiguió, PocketBase lo rechazaría de
+        # todos modos, así que se omite entero.
+        pb_invoice = ctx.get("pb_invoice")
+        if not (pb_invoice and pb_invoice.get("id")):
+            return
+        try:
+            _cmp_bas = ctx["factura"]["data"].get("emisor_receptor", {}).get("comprobante", {})
+            _prefijo_ext, _numero_ext = _extraer_prefijo_numero_comprobante_externo(_cmp_bas)
+            _proveedor_info = resultado_bas.get("proveedor") or {}
+            _orden_pago_info = resultado_bas.get("orden_pago")
+            if _orden_pago_info is None:
+                # Schema solo acepta pending/success/failed -- "no
+                # intentado todavía" mapea a "pending".
+                _orden_pago_status = "pending"
+            elif isinstance(_orden_pago_info, dict) and _orden_pago_info.get("_error"):
+                _orden_pago_status = "failed"
+            else:
+                _orden_pago_status = "success"
+            await asyncio.to_thread(
+                self._pb_client.upsert_bas_processing_status,
+                process_id,
+                invoice=pb_invoice["id"],
+                proveedor_resuelto=bool(resultado_bas.get("proveedor")),
+                proveedor_codigo=_proveedor_info.get("codigo"),
+                comprobante_prefijo=_prefijo_ext,
+                comprobante_numero=_numero_ext,
+                comprobante_registrado=bool(resultado_bas.get("comprobante")),
+                orden_pago_status=_orden_pago_status,
+                orden_pago_error=resultado_bas.get("error"),
+            )
+        except Exception as e:
+            app_logger.warning(
+                f"[{process_id}] PocketBase: error persistiendo bas_processing_status: {e}"
+            )
+
+    async def _etapa_archivar(self, ctx: dict) -> None:
+        """Canal email: sube el archivo a Drive y cierra el record de
+        PocketBase ("completed" + drive_file_id). El canal archivo ya adjuntó
+        el original a PocketBase al arrancar (ver _procesar_imagen_o_pdf)."""
+        if ctx["canal"] != "email":
+            return
+        process_id = ctx["process_id"]
+        item = ctx["item"]
+        if not ctx.get("drive_file_id"):
+            app_logger.info(f"[{process_id}] Iniciando subida a Google Drive para el archivo: {item['file_name']}")
+            ctx["drive_file_id"] = await asyncio.to_thread(
+                self.subir_archivo_a_drive,
+                file_path=item["file_path"],
+                file_name=item["file_name"],
+                mime_type=item["media_type"],
+            )
+            if ctx["drive_file_id"]:
+                await self._anotar(ctx)
+                app_logger.info(f"[{process_id}] ✅ Archivo subido exitosamente a Drive. ID: {ctx['drive_file_id']}")
+            else:
+                app_logger.error(f"[{process_id}] ❌ Falló la subida del archivo a Google Drive.")
 
+        # Cierra el ciclo de vida del record aunque Drive haya fallado (como
+        # siempre: "completed" con drive_file_id vacío); si un reintento sube
+        # el archivo, se vuelve a actualizar con el id.
+        pb_invoice = ctx.get("pb_invoice")
+        if pb_invoice and pb_invoice.get("id"):
+            try:
+                await asyncio.to_thread(
+                    self._pb_client.upsert_invoice,
+                    {
+                        "process_id": process_id,
+                        "drive_file_id": ctx["drive_file_id"],
+                        "status": "completed",
+                    },
+                )
             except Exception as e:
-                app_logger.error(f"[{process_id}] ❌ Error crítico en job: {e}")
-                try:
-                    self._pb_client.update_processing_job(
-                        process_id,
-                        status="error",
-                        error_message=str(e),
-                        from_email=from_email,
-                        subject=subject,
-                        file_name=file_name,
-                    )
-                except Exception as pb_e:
-                    app_logger.warning(
-                        f"[{process_id}] PocketBase: error marcando processing_job error: {pb_e}"
-                    )
-            finally:
-                if process_id in self.active_comparisons:
-                    del self.active_comparisons[process_id]
-                self.job_queue.task_done()
+                app_logger.warning(
+                    f"[{process_id}] PocketBase: error actualizando drive_file_id/status: {e}"
+                )
+        if not ctx["drive_file_id"]:
+            raise EtapaIncompleta("falló la subida del archivo a Google Drive")
+
+    async def _etapa_notificar(self, ctx: dict) -> None:
+        """Canal email: manda el resumen por email y el webhook del resultado.
+        El canal archivo no notifica (el dashboard lee PocketBase)."""
+        if ctx["canal"] != "email":
+            return
+        process_id = ctx["process_id"]
+        item = ctx["item"]
+        if not ctx.get("email_enviado"):
+            html_body = self.generar_html_factura(ctx["factura"]["data"])
+            ctx["email_enviado"] = await asyncio.to_thread(
+                self.enviar_email, ctx["from_email"], ctx["subject_for_file"], html_body
+            )
+            await self._anotar(ctx)
+
+        # El webhook sale una sola vez, aunque el email se reintente.
+        if not ctx.get("webhook_enviado"):
+            ctx["webhook_enviado"] = True
+            await self._anotar(ctx)
+            respuestas = ctx["respuestas"]
+            app_logger.info(f"[{process_id}] Enviando webhook para {item['file_name']}")
+            await self.fire_webhook(
+                {
+                    "id": process_id,
+                    "file_name": item["file_name"],
+                    "factura": ctx["factura"],
+                    "saved": ctx.get("saved_sheet"),
+                    "saved_items": ctx.get("saved_items"),
+                    "bas": ctx.get("bas"),
+                    "qr_afip": respuestas.get("qr_afip"),
+                    "memoria": respuestas.get("memoria"),
+                    "duplicado": respuestas.get("duplicado"),
+                    "paginas_omitidas": respuestas.get("paginas_omitidas"),
+                    "drive_file_id": ctx.get("drive_file_id"),
+                    "errores": ctx["errores"],
+                    "status": "procesada",
+                    "success": True,
+                }
+            )
+        if not ctx["email_enviado"]:
+            raise EtapaIncompleta("no se pudo mandar el email")
 
     # Envía resultados vía webhook
     async def fire_webhook(self, data):
@@ -701,34 +985,28 @@ class InvoiceOrchestrator:
 
     # Hace requests a la API con reintentos
     async def make_api_request(
-        self, url: str, headers: Dict, data: Dict, process_id: str, retries: int = 5
+        self, url: str, headers: Dict, data: Dict, process_id: str, retries: int = 5, medir=None
     ) -> Optional[Dict]:
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            for i in range(retries):
-                try:
-                    async with session.post(
-                        url, headers=headers, json=data
-                    ) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status in [429, 529, 503]:
-                            sleep_time = 15 * (i + 1)  # Espera incremental en segundos
-                            app_logger.warning(
-                                f"API request failed with status {response.status}. Retrying in {sleep_time} seconds..."
-                            )
-                            await asyncio.sleep(sleep_time)
-                        else:
-                            app_logger.error(
-                                f"API request failed with status {response.status} - {await response.text()}"
-                            )
-                            raise ValueError(
-                                f"Request failed with status {response.status}"
-                            )
-                except aiohttp.ClientError as e:
-                    raise ValueError(f"Request error: {str(e)}")
-        raise ValueError("Max retries exceeded.")
+        # Sesión pooled del orquestador (ver utils/http_session.py) -- no
+        # abre una conexión TLS nueva por cada request. Reintentos, Retry-After,
+        # deadline y circuit breaker: ver utils/retry_policy.py.
+        session = await self._http.get()
+        return await politica_llm.post_json(
+            session,
+            url,
+            headers,
+            data,
+            process_id=process_id,
+            max_intentos=retries,
+            # Presupuesto RPM/TPM del proveedor compartido por todo el
+            # proceso (ver utils/rate_budget.py): post_json lo pide antes de
+            # cada intento en vez de comerse un 429.
+            presupuesto=presupuesto_para(url),
+            # Concurrencia adaptativa (AIMD) hacia el proveedor, un lugar por
+            # intento HTTP -- ver utils/adaptive_concurrency.py.
+            limitador=limitador_para(url),
+            medir=medir,
+        )
 
     async def tool_handler(
         self,
@@ -736,8 +1014,11 @@ class InvoiceOrchestrator:
         messages: list,
         tool_name: str,
         process_id: str,
-        model: str = "gemini-3.5-flash",
+        model: Optional[str] = None,
         max_retries: int = 6,
+        validar_schema: bool = True,
+        mensajes_completos: Optional[list] = None,
+        parcial: bool = False,
     ):
         url = "https://generativelanguage.googleapis.com/v1beta/openai/chat/completions"
         headers = {
@@ -753,21 +1034,29 @@ class InvoiceOrchestrator:
                 "function": {"name": tool_name},
             },
         }
-        schema = next(
-            (
-                tool["function"]["parameters"]
-                for tool in tools
-                if tool["function"]["name"] == tool_name
-            ),
-            None,
-        )
+        # Validador compilado y cacheado (ver utils/schema_validators.py).
+        schema = schema_de_tool(tools, tool_name)
         tool_output = None
+        turnos_reparacion = 0
+        # Cascada de modelos (ver utils/model_cascade.py); un model explícito
+        # la reemplaza por ese único modelo.
+        cascada = ModelCascade([model]) if model else self.cascada
+        fallas = 0
         for attempt in range(0, max_retries):
             try:
-                response = await self.make_api_request(
-                    url=url,
-                    headers=headers,
-                    data=data,
+                nivel, modelo = cascada.modelo(fallas)
+                data["model"] = modelo
+                # Con LLM_HEDGING, si tarda más que el p90 de la tool se
+                # dispara una request idéntica (ver utils/hedging.py).
+                response = await cobertura_llm.ejecutar(
+                    f"{tool_name}:{modelo}",
+                    lambda medir: self.make_api_request(
+                        url=url,
+                        headers=headers,
+                        data=data,
+                        process_id=process_id,
+                        medir=medir,
+                    ),
                     process_id=process_id,
                 )
 
@@ -783,9 +1072,44 @@ class InvoiceOrchestrator:
                     raise ValueError("No tool output")
 
                 usage = response["usage"]
+                tool_call_id = (
+                    response["choices"][0]["message"]["tool_calls"][0].get("id")
+                    or f"call_{attempt}"
+                )
 
-                validate(instance=tool_output, schema=schema)
-                app_logger.info("✅ Validation passed.")
+                # validar_schema=False solo para la llamada combinada, que
+                # se valida por sección (ver extraer_con_schema_combinado).
+                if validar_schema:
+                    try:
+                        validar(schema, tool_output)
+                    except ValidationError:
+                        # Primero, reparación local sin request extra (enum,
+                        # número como string, propiedades de más -- ver
+                        # utils/schema_repair.py).
+                        reparado, cambios = reparar_localmente(schema, tool_output)
+                        if reparado is None:
+                            raise
+                        app_logger.info(f"🩹 '{tool_name}' reparado localmente: {cambios}")
+                        tool_output = reparado
+                    app_logger.info("✅ Validation passed.")
+
+                    # Válida pero inconsistente (montos, CUIT): escala de una
+                    # al siguiente modelo; en el último nivel se acepta igual.
+                    # parcial = un bloque de páginas de los ítems: las sumas se
+                    # chequean sobre el resultado unido (ver
+                    # utils/toolchain.extraer_items_por_bloques).
+                    problemas = [] if parcial else chequear_consistencia(tool_name, tool_output)
+                    if problemas:
+                        if nivel < cascada.ultimo_nivel and attempt < max_retries - 1:
+                            app_logger.warning(
+                                f"⚖️ '{tool_name}' inconsistente con {modelo}, escala a {cascada.modelos[nivel + 1]}: {problemas}"
+                            )
+                            fallas = cascada.fallas_para_nivel(nivel + 1)
+                            data["messages"] = messages
+                            continue
+                        app_logger.warning(
+                            f"⚖️ '{tool_name}' inconsistente con {modelo} (se acepta): {problemas}"
+                        )
                 return {
                     "content": [
                         {
@@ -800,11 +1124,37 @@ class InvoiceOrchestrator:
                         "output_tokens": usage["completion_tokens"],
                         "service_tier": "standard",
                     },
+                    "model": modelo,
+                    "tier": nivel,
                 }
                 # return {"content": tool_output, "usage": usage, "tool_name": tool_name}
             except ValidationError as e:
                 # Notifica error de validación
                 app_logger.error(f"❌ Validation error for '{tool_name}': {e.message}")
+                fallas += 1
+                # Próximo intento: si a esta tool se le mandaron solo algunas
+                # páginas del PDF, primero se reintenta con todas (el dato
+                # que falta puede estar en otra página). Si no, un turno de
+                # reparación con la salida previa y los errores concretos; si
+                # ese turno ya se usó, vuelve a la re-extracción completa con
+                # el request original.
+                if mensajes_completos is not None and mensajes_completos != messages:
+                    app_logger.warning(
+                        f"📄 '{tool_name}' no validó con las páginas ruteadas, se reintenta con todas"
+                    )
+                    messages = mensajes_completos
+                    data["messages"] = messages
+                elif turnos_reparacion < MAX_TURNOS_REPARACION:
+                    turnos_reparacion += 1
+                    data["messages"] = messages + turno_reparacion_openai(
+                        tool_call_id,
+                        tool_name,
+                        tool_output,
+                        getattr(e, "errores", [e.message]),
+                    )
+                else:
+                    turnos_reparacion = 0
+                    data["messages"] = messages
                 # error_message = {
                 #     "tool_name": tool_name,
                 #     "tool_output": tool_output,
@@ -855,6 +1205,12 @@ class InvoiceOrchestrator:
                     raise ValueError(
                         f"Max retries exceeded for '{tool_name}'. Last error: {e.message}"
                     )
+            except UpstreamUnavailableError as e:
+                # Los reintentos de transporte (con backoff y deadline) ya se
+                # hicieron en utils/retry_policy.py -- volver a reintentar acá
+                # multiplicaba la espera con el proveedor caído.
+                app_logger.error(f"❌ Upstream no disponible para '{tool_name}': {e}")
+                raise
             except Exception as e:
                 # Notifica error general
                 app_logger.error(f"❌ Unexpected error: {e}")
@@ -899,6 +1255,238 @@ class InvoiceOrchestrator:
                         f"Max retries exceeded for '{tool_name}'. Last error: {str(e)}"
                     )
 
+    async def _extraer(self, tools_standard, armar_contenido, process_id, paginas=1):
+        """
+        Corre la extracción de una factura y devuelve (respuestas, tiempos).
+        armar_contenido(prompt, idx) arma el "content" del mensaje según el
+        toolchain (imagen o páginas del PDF).
+
+        Modo normal: las 3 tools se lanzan juntas (ver utils/toolchain.py) --
+        ninguna depende de la salida de otra. Con combined_schema, una sola
+        request con las 3 secciones y fallback por sección. En PDFs de más
+        de ITEMS_PAGINAS_POR_BLOQUE páginas (`paginas`), los ítems se piden
+        por bloques de páginas en paralelo (extraer_items_por_bloques).
+        """
+        if self.combined_schema:
+            return await extraer_con_schema_combinado(
+                self.tool_handler, tools_standard, armar_contenido, process_id, self.cascada
+            )
+        definiciones = [tool["data"] for tool in tools_standard]
+        bloques = bloques_de_paginas(paginas)
+        llamadas = {}
+        for idx, tool in enumerate(tools_standard):
+            tool_name = tool["data"]["function"]["name"]
+            if bloques and tool_name == "detalle_de_items_facturados":
+                llamadas[tool_name] = extraer_items_por_bloques(
+                    self.tool_handler, definiciones, tool, idx, armar_contenido, bloques, process_id
+                )
+                continue
+            # En PDFs cada tool recibe solo sus páginas; mensajes_completos
+            # (todas) queda para reintentar si la salida no valida.
+            llamadas[tool_name] = self.tool_handler(
+                tools=definiciones,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": armar_contenido(tool["prompt"], idx, tool_name),
+                    }
+                ],
+                tool_name=tool_name,
+                process_id=process_id,
+                mensajes_completos=[
+                    {"role": "user", "content": armar_contenido(tool["prompt"], idx)}
+                ],
+            )
+        return await ejecutar_tools_en_paralelo(llamadas, process_id)
+
+    async def _contenido_imagen(self, item: QueueItem):
+        """armar_contenido(prompt, idx) para una imagen (ver _extraer).
+        Compartido con el carril bulk (precargar_lote)."""
+        # Preprocesada (orientación, recorte de márgenes, reducción, tramos
+        # para tickets largos -- ver utils/image_prep.py) y encodeada en el
+        # pool de render, fuera del event loop (ver utils/render_pool.py).
+        imagenes = await pool_render.ejecutar(
+            preparar_imagen, item["file_path"], item["media_type"], item["process_id"],
+            process_id=item["process_id"],
+        )
+        image_messages = mensajes_imagen_openai(imagenes)
+
+        # La primera tool conserva el orden texto-imagen de siempre.
+        def armar_contenido(prompt, idx, tool_name=None, paginas=None):
+            text_message = {"type": "text", "text": prompt}
+            if idx == 0:
+                return [text_message, *image_messages]
+            return [*image_messages, text_message]
+
+        return armar_contenido
+
+    async def _contenido_pdf(self, item: QueueItem):
+        """(armar_contenido(prompt, idx), cantidad de páginas) para un PDF:
+        las páginas (como texto o como imagen, ver utils/pdf_text.py) + el
+        prompt. Compartido con el carril bulk (precargar_lote). Si el PDF se
+        cortó (PDF_MAX_PAGINAS / PDF_PRESUPUESTO_MB) deja la cantidad de
+        páginas que no se mandaron en item["paginas_omitidas"]."""
+        # Páginas con capa de texto van como texto con layout; las escaneadas,
+        # rasterizadas como siempre (ver utils/pdf_text.py). En el pool de
+        # render: un PDF grande no bloquea el event loop.
+        pdf = await pool_render.ejecutar(
+            mensajes_pdf, item["file_path"], item["process_id"],
+            process_id=item["process_id"],
+        )
+        image_messages = pdf["mensajes"]
+        if pdf["omitidas"]:
+            item["paginas_omitidas"] = pdf["omitidas"]
+
+        def armar_contenido(prompt, idx, tool_name=None, paginas=None):
+            # Con tool_name, solo las páginas que esa tool necesita; con
+            # paginas, esas (un bloque de ítems -- ver _extraer).
+            # (ver utils/pdf_text.seleccionar_paginas).
+            return [
+                *seleccionar_paginas(
+                    image_messages, tool_name, paginas, pdf["numeros"], pdf["total"]
+                ),
+                {"type": "text", "text": prompt},
+            ]
+
+        return armar_contenido, len(image_messages)
+
+    async def precargar_lote(self, items: list, nombre: str) -> int:
+        """
+        Carril bulk (ver utils/batch_lane.py): extrae `items` por el endpoint
+        de batch de Gemini y deja el resultado en el cache de extracción, así
+        run_image_toolchain / run_pdf_toolchain lo encuentran después sin
+        llamar al LLM. Cada item necesita file_path, media_type y process_id.
+
+        Nunca tira: lo que no se pudo resolver por batch (o no validó) queda
+        fuera del cache y se extrae por el camino síncrono de siempre.
+        Devuelve cuántos archivos quedaron precargados.
+        """
+        if not (self.bulk_lane and extraction_cache.habilitado):
+            return 0
+        try:
+            tools_standard = build_tools()
+            definiciones = [tool["data"] for tool in tools_standard]
+            # De a un archivo: sus requests van al lote (que manda cada batch
+            # apenas se llena) y su contenido se suelta antes de armar el
+            # siguiente -- nunca el ZIP entero en memoria (ver
+            # utils/batch_lane.LoteEnArmado).
+            lote = self._batch.lote(self.model, nombre)
+            claves, qrs = {}, {}
+            for n, item in enumerate(items):
+                clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, tools_standard)
+                if clave is None or extraction_cache.obtener(clave) is not None:
+                    continue
+                try:
+                    if item["media_type"].startswith("image"):
+                        armar_contenido = await self._contenido_imagen(item)
+                    else:
+                        # Sin bloques de ítems en el batch: una salida cortada
+                        # no valida y ese archivo va por el camino síncrono.
+                        armar_contenido, _ = await self._contenido_pdf(item)
+                except Exception as e:
+                    app_logger.warning(f"[{item['process_id']}] 📦 No se pudo preparar para el batch: {e}")
+                    continue
+                claves[n] = clave
+                # Mismo QR de AFIP que en los toolchains (ver utils/afip_qr.py).
+                qrs[n], tools_con_qr = await preparar_qr(item, tools_standard)
+                for idx, tool in enumerate(tools_con_qr):
+                    tool_name = tool["data"]["function"]["name"]
+                    lote.agregar(
+                        f"{n}:{tool_name}",
+                        armar_request_nativa(
+                            definiciones, tool_name, armar_contenido(tool["prompt"], idx, tool_name)
+                        ),
+                    )
+                del armar_contenido
+            if not lote.total:
+                return 0
+
+            salidas = await lote.resultados()
+
+            precargados = 0
+            for n, clave in claves.items():
+                respuestas = []
+                for tool in tools_standard:
+                    tool_name = tool["data"]["function"]["name"]
+                    salida = salidas.get(f"{n}:{tool_name}")
+                    seccion = self._validar_salida_lote(
+                        definiciones, tool_name, salida, items[n]["process_id"]
+                    )
+                    if seccion is None:
+                        break
+                    respuestas.append(
+                        {
+                            "content": [{"name": tool_name, "input": seccion}],
+                            "usage": salida["usage"],
+                        }
+                    )
+                else:
+                    # Mismos campos del item que deja el toolchain (páginas
+                    # omitidas ya las dejó _contenido_pdf), así un hit de este
+                    # archivo los restaura igual.
+                    items[n]["qr_afip"] = resumen_qr(
+                        qrs[n], aplicar_qr(respuestas, qrs[n], items[n]["process_id"])
+                    )
+                    extraction_cache.guardar(
+                        clave, self.formatear_factura(respuestas)["data"], items[n]
+                    )
+                    precargados += 1
+            app_logger.info(f"📦 [{nombre}] {precargados}/{len(items)} archivos precargados por batch")
+            return precargados
+        except Exception as e:
+            app_logger.error(f"📦 [{nombre}] Carril bulk fallido, se sigue por el camino síncrono: {e}")
+            return 0
+
+    def _validar_salida_lote(self, definiciones, tool_name, salida, process_id):
+        """Mismo criterio que tool_handler: schema, reparación local y
+        consistencia. None = esa sección se re-extrae por el camino síncrono."""
+        if salida is None or salida["name"] != tool_name:
+            return None
+        schema = schema_de_tool(definiciones, tool_name)
+        seccion = salida["input"]
+        try:
+            validar(schema, seccion)
+        except ValidationError as e:
+            seccion, _ = reparar_localmente(schema, seccion)
+            if seccion is None:
+                app_logger.warning(f"[{process_id}] 📦 '{tool_name}' del batch inválido: {e.message}")
+                return None
+        problemas = chequear_consistencia(tool_name, seccion)
+        if problemas:
+            app_logger.warning(f"[{process_id}] 📦 '{tool_name}' del batch inconsistente: {problemas}")
+            return None
+        return seccion
+
+    async def _casi_duplicado(self, item: QueueItem):
+        """Huella perceptual del documento contra el índice de
+        casi-duplicados (ver utils/near_duplicates.py). Deja la sospecha en
+        item["duplicado"] y devuelve (huella, datos de la extracción anterior
+        si DUPLICADOS_REUSAR y sigue en el cache, o None)."""
+        if not indice_duplicados.habilitado:
+            return None, None
+        huella_doc = await pool_render.ejecutar(
+            huella, item["file_path"], item["media_type"], item["process_id"],
+            process_id=item["process_id"],
+        )
+        sospecha = indice_duplicados.buscar(
+            huella_doc, id_documento(item["process_id"], item["file_name"]), item["process_id"]
+        )
+        if sospecha is None:
+            return huella_doc, None
+        item["duplicado"] = {
+            "documento": sospecha["documento"],
+            "process_id": sospecha["process_id"],
+            "distancia": sospecha["distancia"],
+        }
+        if not indice_duplicados.reusar:
+            return huella_doc, None
+        datos = extraction_cache.obtener(sospecha["clave_cache"])
+        if datos is not None:
+            app_logger.info(
+                f"[{item['process_id']}] 👯 Se reusa la extracción de {sospecha['documento']}"
+            )
+        return huella_doc, datos
+
     # Procesa imágenes con Claude Vision
     async def run_image_toolchain(
         self,
@@ -909,56 +1497,41 @@ class InvoiceOrchestrator:
         # un cambio de datos en /category-map, no un deploy.
         tools_standard = build_tools()
 
-        # Convierte imagen a base64
-        image_file = Path(item["file_path"])
-        base64_string = base64.b64encode(image_file.read_bytes()).decode()
-
-        response = await self.tool_handler(
-            tools=[tool["data"] for tool in tools_standard],
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": tools_standard[0]["prompt"]},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{item['media_type']};base64,{base64_string}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            tool_name=tools_standard[0]["data"]["function"]["name"],
-            process_id=item["process_id"],
-        )
-
-        # Procesa con resto de herramientas en paralelo
-        tasks = []
-        for tool in tools_standard[1:]:
-            tool_res = self.tool_handler(
-                tools=[tool["data"] for tool in tools_standard],
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{item['media_type']};base64,{base64_string}"
-                                },
-                            },
-                            {"type": "text", "text": tool["prompt"]},
-                        ],
-                    }
-                ],
-                tool_name=tool["data"]["function"]["name"],
-                process_id=item["process_id"],
+        # Cache por contenido + single-flight (ver utils/extraction_cache.py):
+        # un archivo que ya se extrajo no vuelve a pasar por el LLM.
+        clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, tools_standard)
+        async with extraction_cache.reservar(clave) as cacheado:
+            if cacheado is not None:
+                item["data"] = respuestas_desde_cache(cacheado)
+                item.update(campos_item(cacheado))
+                item["tool_timings"] = {"cache": True}
+                return item
+
+            # Otra foto del mismo ticket / el mismo PDF re-guardado: bytes
+            # distintos, el cache de arriba no lo ve (ver
+            # utils/near_duplicates.py).
+            huella_doc, reusado = await self._casi_duplicado(item)
+            if reusado is not None:
+                item["data"] = respuestas_desde_cache(reusado)
+                item["tool_timings"] = {"duplicado": True}
+                return item
+
+            # QR de AFIP leído localmente (ver utils/afip_qr.py): va como
+            # pista en el prompt de emisor/receptor y después corrige y
+            # verifica esa salida.
+            qr, tools_con_qr = await preparar_qr(item, tools_standard)
+            respuestas, tiempos = await self._extraer(
+                tools_con_qr, await self._contenido_imagen(item), item["process_id"]
+            )
+            item["qr_afip"] = resumen_qr(
+                qr, aplicar_qr(respuestas, qr, item["process_id"])
+            )
+            extraction_cache.guardar(clave, self.formatear_factura(respuestas)["data"], item)
+            indice_duplicados.registrar(
+                huella_doc, id_documento(item["process_id"], item["file_name"]), item["process_id"], clave
             )
-            tasks.append(tool_res)
-        results = await asyncio.gather(*tasks)
-        respuestas = [response] + results
         item["data"] = respuestas
+        item["tool_timings"] = tiempos
         return item
 
     # Procesa PDFs con Claude
@@ -969,65 +1542,42 @@ class InvoiceOrchestrator:
         # Ver comentario equivalente en run_image_toolchain.
         tools_standard = build_tools()
 
-        doc = fitz.open(item["file_path"])
-        base64_images = []
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap(dpi=150)  # convertimos a imagen
-
-            # Convertimos el pixmap a imagen PIL
-            img = Image.open(io.BytesIO(pix.tobytes("png")))
-
-            # Guardamos en memoria y convertimos a base64
-            buffer = io.BytesIO()
-            img.save(buffer, format="PNG")
-            img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            base64_images.append(img_base64)
-
-        image_messages = [
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{img_b64}"},
-            }
-            for img_b64 in base64_images
-        ]
-
-        response = await self.tool_handler(
-            tools=[tool["data"] for tool in tools_standard],
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        *image_messages,
-                        {"type": "text", "text": tools_standard[0]["prompt"]},
-                    ],
-                }
-            ],
-            tool_name=tools_standard[0]["data"]["function"]["name"],
-            process_id=item["process_id"],
-        )
-
-        # Procesa con resto de herramientas en paralelo
-        tasks = []
-        for tool in tools_standard[1:]:
-            tool_res = self.tool_handler(
-                tools=[tool["data"] for tool in tools_standard],
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            *image_messages,
-                            {"type": "text", "text": tool["prompt"]},
-                        ],
-                    }
-                ],
-                tool_name=tool["data"]["function"]["name"],
-                process_id=item["process_id"],
+        # Cache antes de renderizar -- ver run_image_toolchain.
+        clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, tools_standard)
+        async with extraction_cache.reservar(clave) as cacheado:
+            if cacheado is not None:
+                item["data"] = respuestas_desde_cache(cacheado)
+                item.update(campos_item(cacheado))
+                item["tool_timings"] = {"cache": True}
+                return item
+
+            # Casi-duplicados -- ver run_image_toolchain.
+            huella_doc, reusado = await self._casi_duplicado(item)
+            if reusado is not None:
+                item["data"] = respuestas_desde_cache(reusado)
+                item["tool_timings"] = {"duplicado": True}
+                return item
+
+            # QR de AFIP leído localmente (ver utils/afip_qr.py): va como
+            # pista en el prompt de emisor/receptor y después corrige y
+            # verifica esa salida.
+            qr, tools_con_qr = await preparar_qr(item, tools_standard)
+            # Pico de RSS del render + extracción (ver utils/memoria.py).
+            async with MedidorMemoria() as memoria:
+                armar_contenido, paginas = await self._contenido_pdf(item)
+                respuestas, tiempos = await self._extraer(
+                    tools_con_qr, armar_contenido, item["process_id"], paginas
+                )
+            item["memoria"] = memoria.resumen(item["process_id"], paginas=paginas)
+            item["qr_afip"] = resumen_qr(
+                qr, aplicar_qr(respuestas, qr, item["process_id"])
+            )
+            extraction_cache.guardar(clave, self.formatear_factura(respuestas)["data"], item)
+            indice_duplicados.registrar(
+                huella_doc, id_documento(item["process_id"], item["file_name"]), item["process_id"], clave
             )
-            tasks.append(tool_res)
-        results = await asyncio.gather(*tasks)
-        respuestas = [response] + results
         item["data"] = respuestas
+        item["tool_timings"] = tiempos
         return item
 
     # Guarda los datos de la factura en Google Sheets
@@ -1300,20 +1850,22 @@ class InvoiceOrchestrator:
         factura_data: dict,
         process_id: str,
         tab_name: str = None,
-    ) -> bool:
+    ) -> Optional[bool]:
         """
         Guarda los ítems de una factura como filas individuales en una pestaña aparte,
         manteniendo el enlace con la factura (process_id + clave compuesta).
 
         Aislado a propósito: cualquier fallo aquí NO debe afectar el guardado de la
-        factura principal, el email ni el webhook. Devuelve True/False.
+        factura principal, el email ni el webhook. Devuelve True/False, o None si
+        SHEET_ID_2 no está configurado (igual que guardar_factura_completa_en_sheets:
+        no hay nada que reintentar).
         """
         try:
             tab_name = tab_name or os.getenv("SHEET_TAB_ITEMS", "Detalle_Items")
             sheet_id = os.getenv("SHEET_ID_2")
             if not sheet_id:
-                app_logger.error("No se encontró SHEET_ID_2 para guardar los ítems.")
-                return False
+                app_logger.warning("No se encontró SHEET_ID_2: no se guardan los ítems.")
+                return None
 
             timestamp = datetime.datetime.utcnow().isoformat() + "Z"
             filas = self._construir_filas_items(factura_data, process_id, timestamp)
@@ -1597,9 +2149,14 @@ class InvoiceOrchestrator:
                     datos_factura["impuestos"] = tool_content.get("input", {})
 
         app_logger.info("Formateo completado.")
+        # Qué modelo/nivel de la cascada produjo cada sección (ver
+        # utils/model_cascade.py) -- para ajustar los umbrales con datos reales.
+        modelos = modelos_por_seccion(factura_completa)
+        app_logger.info(f"📊 Modelos por sección: {modelos}")
         return {
             "data": datos_factura,
             "tokens": total_tokens,
+            "modelos": modelos,
         }
 
     def get_file_type_from_url(self, url: str) -> str:
@@ -1762,6 +2319,8 @@ orchestrator = InvoiceOrchestrator(
     queue_check_cooldown=20,
     model="gemini-3.5-flash",
     semaphore=3,
+    combined_schema=os.getenv("GEMINI_COMBINED_SCHEMA", "false").lower()
+    in ("1", "true"),
 )
 
 
@@ -1772,9 +2331,9 @@ async def _procesar_imagen_o_pdf(
     media_type: str,
     process_id: str,
 ) -> dict:
-    """Procesa sincrónicamente una imagen o PDF de factura: extracción Gemini,
-    Sheets, integración BAS (dry_run por default) y persistencia en
-    PocketBase. Compartido por /process-invoice (protegido con secret_key) y
+    """Procesa una imagen o PDF de factura: extracción Gemini, Sheets,
+    integración BAS (dry_run por default) y persistencia en PocketBase, por
+    las etapas de orchestrator.pipeline. Compartido por /process-invoice (protegido con secret_key) y
     /website-upload (público, rate-limited) -- misma lógica de negocio, dos
     puertas de entrada distintas. Borra el archivo local al terminar.
     """
@@ -1828,127 +2387,28 @@ async def _procesar_imagen_o_pdf(
                 f"[{process_id}] PocketBase: error adjuntando archivo original (temprano): {e}"
             )
 
-    # Procesa según tipo
-    if media_type.startswith("image"):
-        app_logger.info("Tenemos una imagen")
-        respuestas = await orchestrator.run_image_toolchain(item)
-    else:
-        app_logger.info("Tenemos un PDF")
-        respuestas = await orchestrator.run_pdf_toolchain(item)
-
-    factura = orchestrator.formatear_factura(respuestas["data"])
-    saved_sheet = orchestrator.guardar_factura_completa_en_sheets(
-        factura["data"]
+    # Extracción, Sheets, PocketBase y BAS: etapas del pipeline (ver
+    # utils/pipeline.py). Una falla en la extracción tira acá y
+    # _procesar_en_background marca el placeholder como "error"; las demás
+    # etapas son best-effort y quedan en ctx["errores"].
+    ctx = await orchestrator.pipeline.procesar(
+        {"canal": "archivo", "process_id": process_id, "item": item}
     )
-    saved_items = orchestrator.guardar_items_en_sheets(factura["data"], process_id)
-
-    # Integración con BAS (ERP): mismo patrón aislado que en worker().
-    resultado_bas = orchestrator.procesar_factura_en_bas(factura["data"], process_id)
-
-    # Persistencia en PocketBase (invoice + items + estado BAS). Mismo
-    # patrón y mismos nombres de campo que worker() (más abajo en esta
-    # clase) -- aislado a propósito, un fallo acá NO debe afectar
-    # Sheets/BAS ni la respuesta al llamador. Necesario para que las
-    # facturas subidas como archivo suelto (el caso real de uso -- a
-    # diferencia del branch ZIP, que encola vía job_queue/worker())
-    # también queden persistidas y visibles en el dashboard. A
-    # diferencia de worker(), este camino no sube a Drive ni manda
-    # email (ver el resto del endpoint), así que no hay drive_file_id
-    # que setear -- status se marca "completed" directo.
-    _pb_invoice_record = None
-    try:
-        _er = factura["data"].get("emisor_receptor", {})
-        _cmp = _er.get("comprobante", {})
-        _emisor = _er.get("emisor", {})
-        _receptor = _er.get("receptor", {})
-        _otros = _er.get("otros", {})
-        _items_info = factura["data"].get("items", {})
-        _detalles = _items_info.get("detalles", []) or []
-
-        _pb_invoice_record = orchestrator._pb_client.upsert_invoice(
-            {
-                "process_id": process_id,
-                "numero_comprobante": _cmp.get("numero"),
-                "fecha_emision": _cmp.get("fecha_emision"),
-                "tipo_comprobante": _cmp.get("tipo"),
-                "subtipo_comprobante": _cmp.get("subtipo"),
-                "moneda": _cmp.get("moneda"),
-                "emisor_nombre": _emisor.get("nombre"),
-                "emisor_cuit": _emisor.get("id_fiscal"),
-                "receptor_nombre": _receptor.get("nombre"),
-                "receptor_cuit": _receptor.get("id_fiscal"),
-                "subtotal": _items_info.get("subtotal"),
-                "total": _items_info.get("total"),
-                "cae": _otros.get("CAE"),
-                "cae_vencimiento": _otros.get("vencimiento_CAE"),
-                "forma_pago": _otros.get("forma_pago"),
-                "sheets_saved": bool(saved_sheet),
-                "status": "completed",
-            }
-        )
-        if _pb_invoice_record and _pb_invoice_record.get("id"):
-            orchestrator._pb_client.bulk_create_invoice_items(
-                _pb_invoice_record["id"],
-                [
-                    {
-                        "process_id": process_id,
-                        "linea": idx,
-                        "descripcion": d.get("descripcion"),
-                        "cantidad": d.get("cantidad"),
-                        "precio_unitario": d.get("precio_unitario"),
-                        "precio_total": d.get("precio_total"),
-                        "categoria": d.get("categoria"),
-                        "bas_codigo_item": codigo_item_de_categoria(
-                            d.get("categoria", "")
-                        ),
-                    }
-                    for idx, d in enumerate(_detalles, 1)
-                ],
-            )
-        else:
-            app_logger.warning(
-                f"[{process_id}] PocketBase: upsert_invoice no devolvió "
-                "un record válido, se omiten los ítems y el estado BAS."
-            )
-    except Exception as e:
-        app_logger.warning(
-            f"[{process_id}] PocketBase: error persistiendo invoice/items: {e}"
-        )
-
-    try:
-        if _pb_invoice_record and _pb_invoice_record.get("id"):
-            _cmp_bas = factura["data"].get("emisor_receptor", {}).get("comprobante", {})
-            _prefijo_ext, _numero_ext = _extraer_prefijo_numero_comprobante_externo(_cmp_bas)
-            _proveedor_info = resultado_bas.get("proveedor") or {}
-            _orden_pago_info = resultado_bas.get("orden_pago")
-            if _orden_pago_info is None:
-                # Schema solo acepta pending/success/failed -- "no
-                # intentado todavía" mapea a "pending".
-                _orden_pago_status = "pending"
-            elif isinstance(_orden_pago_info, dict) and _orden_pago_info.get("_error"):
-                _orden_pago_status = "failed"
-            else:
-                _orden_pago_status = "success"
-            orchestrator._pb_client.upsert_bas_processing_status(
-                process_id,
-                invoice=_pb_invoice_record["id"],
-                proveedor_resuelto=bool(resultado_bas.get("proveedor")),
-                proveedor_codigo=_proveedor_info.get("codigo"),
-                comprobante_prefijo=_prefijo_ext,
-                comprobante_numero=_numero_ext,
-                comprobante_registrado=bool(resultado_bas.get("comprobante")),
-                orden_pago_status=_orden_pago_status,
-                orden_pago_error=resultado_bas.get("error"),
-            )
-    except Exception as e:
-        app_logger.warning(
-            f"[{process_id}] PocketBase: error persistiendo bas_processing_status: {e}"
-        )
+    respuestas = ctx["respuestas"]
+    factura = ctx["factura"]
+    saved_sheet = ctx.get("saved_sheet")
+    saved_items = ctx.get("saved_items")
+    resultado_bas = ctx.get("bas") or {}
 
     factura["id"] = process_id
+    factura["qr_afip"] = respuestas.get("qr_afip")
+    factura["memoria"] = respuestas.get("memoria")
+    factura["duplicado"] = respuestas.get("duplicado")
+    factura["paginas_omitidas"] = respuestas.get("paginas_omitidas")
     factura["saved_sheet"] = bool(saved_sheet)
     factura["saved_items"] = bool(saved_items)
     factura["bas"] = resultado_bas
+    factura["errores"] = ctx["errores"]
     factura["status_code"] = 200
 
     # El archivo original ya se adjuntó al arranque de esta función (ver el
@@ -1959,7 +2419,43 @@ async def _procesar_imagen_o_pdf(
     return factura
 
 
-async def _procesar_en_background(**kwargs) -> None:
+async def _facturas_del_pdf(
+    file_location: str, file_name: str, extension: str, media_type: str, process_id: str
+) -> Optional[list]:
+    """Si el PDF trae varias facturas (ver utils/pdf_split.py), los kwargs de
+    _procesar_en_background para cada una, o None. La primera conserva el
+    process_id (el placeholder de /website-upload/init o el del reintento
+    queda para ella); las demás van como "<process_id>/<n>", igual que los
+    archivos de un ZIP. El PDF original NO se borra acá: lo borra el caller
+    recién cuando las partes quedaron encoladas en la cola durable (si el
+    proceso se cae antes, el trabajo del original se retoma y se vuelve a
+    dividir). Nunca tira: ante cualquier error el PDF va entero, como
+    siempre."""
+    if media_type != "application/pdf":
+        return None
+    try:
+        paths = await pool_render.ejecutar(
+            dividir_pdf, file_location, process_id, process_id=process_id
+        )
+    except Exception as e:
+        app_logger.warning(f"[{process_id}] ✂️ No se pudo dividir el PDF, va entero: {e}")
+        return None
+    if not paths:
+        return None
+    nombre = os.path.splitext(file_name)[0]
+    return [
+        {
+            "file_location": path,
+            "file_name": f"{nombre}-factura{n}.{extension}",
+            "extension": extension,
+            "media_type": media_type,
+            "process_id": process_id if n == 1 else f"{process_id}/{n}",
+        }
+        for n, path in enumerate(paths, 1)
+    ]
+
+
+async def _procesar_en_background(dividir: bool = True, **kwargs) -> None:
     """Corre _procesar_imagen_o_pdf() sin bloquear la respuesta HTTP.
 
     El procesamiento real (Gemini + búsqueda de proveedor en BAS) puede
@@ -1971,7 +2467,34 @@ async def _procesar_en_background(**kwargs) -> None:
     cancela solo porque nginx se desconectó). El cliente veía un error falso
     mientras el backend seguía trabajando -- confuso, y arriesga que alguien
     reintente y duplique el procesamiento de la misma factura.
+
+    Un PDF con varias facturas se parte (ver _facturas_del_pdf) y cada una
+    se procesa como una factura propia, PDF_DIVISION_CONCURRENCIA a la vez:
+    las partes van a cola_archivos como un trabajo nuevo y el original se
+    borra recién después de encolarlas. Si la cola no las pudo guardar, se
+    procesan acá mismo y el original se borra al terminar.
     """
+    if dividir:
+        partes = await _facturas_del_pdf(**kwargs)
+        if partes:
+            try:
+                orchestrator.cola_archivos.encolar(
+                    {
+                        "archivos": [{**parte, "dividir": False} for parte in partes],
+                        "concurrencia": CONCURRENCIA_DIVISION,
+                    }
+                )
+            except Exception as e:
+                app_logger.warning(
+                    f"[{kwargs['process_id']}] ✂️ No se pudieron encolar las partes, "
+                    f"se procesan acá: {e}"
+                )
+                await _procesar_lote(
+                    [{**parte, "dividir": False} for parte in partes],
+                    concurrencia=CONCURRENCIA_DIVISION,
+                )
+            os.remove(kwargs["file_location"])
+            return
     try:
         await _procesar_imagen_o_pdf(**kwargs)
     except Exception as exc:
@@ -1991,6 +2514,68 @@ async def _procesar_en_background(**kwargs) -> None:
             )
 
 
+async def _procesar_lote(
+    archivos: list, lote: Optional[str] = None, concurrencia: Optional[int] = None
+) -> None:
+    """Corre _procesar_en_background para cada archivo, a lo sumo
+    `concurrencia` a la vez si viene (las partes de un PDF dividido). Con
+    `lote` (el id de un ZIP) y el carril bulk activo, primero precarga las
+    extracciones de todos juntas por el endpoint de batch.
+
+    Un archivo que ya no está se saltea: si el trabajo se retoma después de
+    un restart (ver utils/durable_queue.py), los que se terminaron de
+    procesar ya se borraron -- no se reprocesan ni se pisan con un error."""
+    for archivo in archivos:
+        if not os.path.exists(archivo["file_location"]):
+            app_logger.warning(
+                f"[{archivo['process_id']}] {archivo['file_location']} ya no está "
+                "(¿procesado antes de un restart?), se saltea"
+            )
+    archivos = [a for a in archivos if os.path.exists(a["file_location"])]
+    if not archivos:
+        return
+    # Carril bulk (opt-in, ver utils/batch_lane.py): las extracciones del
+    # ZIP van juntas por el endpoint de batch y quedan en el cache, así el
+    # loop de abajo no llama al LLM. Mientras espera el batch, cada archivo
+    # ya figura como "processing" en PocketBase (best-effort).
+    if lote and orchestrator.bulk_lane:
+        for archivo in archivos:
+            try:
+                orchestrator._pb_client.upsert_invoice(
+                    {"process_id": archivo["process_id"], "status": "processing"}
+                )
+            except Exception as e:
+                app_logger.warning(
+                    f"[{archivo['process_id']}] PocketBase: error creando placeholder: {e}"
+                )
+        await orchestrator.precargar_lote(
+            [
+                {
+                    "file_path": a["file_location"],
+                    "media_type": a["media_type"] or "",
+                    "process_id": a["process_id"],
+                }
+                for a in archivos
+            ],
+            nombre=lote,
+        )
+    # Los archivos entran juntos al pipeline: la concurrencia la ponen sus
+    # etapas (ver InvoiceOrchestrator.pipeline), así un ZIP no satura la
+    # única vCPU del Droplet (ver MAX_ARCHIVOS_ZIP en /process-invoice) pero
+    # la extracción de un archivo se solapa con el BAS del anterior. Un
+    # archivo que falla no frena al resto (_procesar_en_background ya loguea
+    # y traga la excepción).
+    semaforo = asyncio.Semaphore(concurrencia) if concurrencia else None
+
+    async def _archivo(archivo):
+        if semaforo is None:
+            return await _procesar_en_background(**archivo)
+        async with semaforo:
+            await _procesar_en_background(**archivo)
+
+    await asyncio.gather(*(_archivo(archivo) for archivo in archivos))
+
+
 @router.post(
     "/process-invoice",
     summary="Procesar factura - GEMINI",
@@ -2059,19 +2644,24 @@ async def process_invoice(
 
         app_logger.info(f"Mime type: {kind.mime}")
 
-        # Procesa imagen o PDF -- en background (ver _procesar_en_background):
-        # esperarlo acá adentro del request original es lo que producía los
-        # 504 con PDFs reales (Gemini + búsqueda de proveedor en BAS puede
-        # superar los 200s del gateway).
+        # Procesa imagen o PDF -- en background, vía la cola durable (ver
+        # worker_archivos / _procesar_en_background): esperarlo acá adentro
+        # del request original es lo que producía los 504 con PDFs reales
+        # (Gemini + búsqueda de proveedor en BAS puede superar los 200s del
+        # gateway).
         if kind.mime.startswith("image") or kind.mime == "application/pdf":
-            asyncio.create_task(
-                _procesar_en_background(
-                    file_location=file_location,
-                    file_name=file.filename,
-                    extension=extension,
-                    media_type=kind.mime,
-                    process_id=id,
-                )
+            orchestrator.cola_archivos.encolar(
+                {
+                    "archivos": [
+                        {
+                            "file_location": file_location,
+                            "file_name": file.filename,
+                            "extension": extension,
+                            "media_type": kind.mime,
+                            "process_id": id,
+                        }
+                    ]
+                }
             )
             return {
                 "success": True,
@@ -2143,21 +2733,17 @@ async def process_invoice(
                         )
                         os.remove(extracted_file_path)
 
-            async def _procesar_zip_en_background(archivos):
-                # Secuencial a propósito (ver comentario de MAX_ARCHIVOS_ZIP):
-                # correr todos los archivos en paralelo saturaría la única
-                # vCPU del Droplet. Un archivo que falla no frena al resto
-                # (_procesar_en_background ya loguea y traga la excepción).
-                for archivo in archivos:
-                    await _procesar_en_background(**archivo)
-
-            # No se espera (await) a propósito -- el endpoint responde 201 de
-            # inmediato y el batch sigue procesándose en background. Antes de
-            # este fix, esta rama llamaba a "orchestrator.task_queue" que no
-            # existe en esta clase (solo existe "job_queue", con una forma de
-            # item distinta) -- cada archivo de cada ZIP subido a este
-            # endpoint fallaba en silencio con AttributeError.
-            asyncio.create_task(_procesar_zip_en_background(archivos_a_procesar))
+            # Un solo trabajo para todo el ZIP: el endpoint responde 201 de
+            # inmediato y worker_archivos procesa sus archivos en paralelo
+            # (ver _procesar_lote; el tope lo ponen las etapas del pipeline). Antes de la cola, esta rama llamaba a
+            # "orchestrator.task_queue" que no existe en esta clase (solo
+            # existe "job_queue", con una forma de item distinta) -- cada
+            # archivo de cada ZIP subido a este endpoint fallaba en silencio
+            # con AttributeError.
+            if archivos_a_procesar:
+                orchestrator.cola_archivos.encolar(
+                    {"archivos": archivos_a_procesar, "lote": id}
+                )
 
         else:
             raise HTTPException(status_code=400, detail="Tipo de archivo no permitido.")
@@ -2273,14 +2859,18 @@ async def website_upload(
             os.remove(file_location)
             raise HTTPException(status_code=400, detail="Tipo de archivo no permitido.")
 
-        asyncio.create_task(
-            _procesar_en_background(
-                file_location=file_location,
-                file_name=file.filename,
-                extension=extension,
-                media_type=kind.mime,
-                process_id=process_id,
-            )
+        orchestrator.cola_archivos.encolar(
+            {
+                "archivos": [
+                    {
+                        "file_location": file_location,
+                        "file_name": file.filename,
+                        "extension": extension,
+                        "media_type": kind.mime,
+                        "process_id": process_id,
+                    }
+                ]
+            }
         )
         return {
             "success": True,
@@ -2308,7 +2898,18 @@ async def get_queue_status():
 
     Returns:
         dict: Contains 'queue_size' key with a dictionary of active processing tasks,
-              where each key is a process ID and value contains file processing details
+              where each key is a process ID and value contains file processing details,
+              'rate_budget' with the per-provider RPM/TPM budget and queue wait
+              metrics (see utils/rate_budget.py), and 'concurrency' with the
+              current adaptive concurrency limit per provider and its history
+              (see utils/adaptive_concurrency.py), and 'hedging' with the
+              hedged-request counters and current thresholds per tool
+              (see utils/hedging.py), 'render_pool' with the PDF render
+              pool size and its queue wait metrics (see utils/render_pool.py),
+              'cola' with the durable queue's job counts by state (see
+              utils/durable_queue.py), and 'pipeline' with the queue, workers
+              and timings of each post-extraction stage (see
+              utils/pipeline.py)
 
     Example response:
         {
@@ -2320,10 +2921,65 @@ async def get_queue_status():
                     "media_type": "application/pdf",
                     "process_id": "process_123"
                 }
+            },
+            "rate_budget": {
+                "generativelanguage.googleapis.com": {
+                    "rpm": 150, "tpm": 1000000, "en_cola": 0, "llamadas": 42,
+                    "esperas": 3, "espera_total_s": 7.5, "espera_max_s": 4.1,
+                    "espera_ultima_s": 0.0
+                }
+            },
+            "concurrency": {
+                "generativelanguage.googleapis.com": {
+                    "limite": 7, "en_vuelo": 3, "p95_s": 12.4,
+                    "historial": [
+                        {"ts": 1760000000.0, "limite": 9, "motivo": "inicio"},
+                        {"ts": 1760000120.5, "limite": 4, "motivo": "status 429"},
+                        {"ts": 1760000300.2, "limite": 7, "motivo": "sube"}
+                    ]
+                }
+            },
+            "hedging": {
+                "activa": true, "coberturas": 12, "ganadas": 9,
+                "descartadas_por_tope": 0,
+                "umbrales_s": {"detalle_de_items_facturados:gemini-3.5-flash": 18.2}
+            },
+            "render_pool": {
+                "workers": 2, "tipo": "thread", "tareas": 57, "en_cola": 0,
+                "espera_total_s": 3.2, "espera_max_s": 1.4,
+                "espera_ultima_s": 0.0, "trabajo_total_s": 41.7
+            },
+            "cola": [
+                {"cola": "gemini2_email", "pendiente": 0, "en_curso": 1, "hecho": 37,
+                 "fallido": 0, "espera_max_s": 0.0, "max_intentos": 3},
+                {"cola": "gemini2_archivos", "pendiente": 4, "en_curso": 3, "hecho": 212,
+                 "fallido": 1, "espera_max_s": 95.2, "max_intentos": 3}
+            ],
+            "pipeline": {
+                "extraer": {
+                    "workers": 2, "capacidad": 4, "en_cola": 3, "en_vuelo": 2,
+                    "procesadas": 40, "fallidas": 1, "reintentos": 0,
+                    "espera_total_s": 310.4, "trabajo_total_s": 1205.1,
+                    "espera_media_s": 7.57, "trabajo_medio_s": 29.39
+                },
+                "erp": {
+                    "workers": 1, "capacidad": 16, "en_cola": 0, "en_vuelo": 1,
+                    "procesadas": 38, "fallidas": 0, "reintentos": 0,
+                    "espera_total_s": 12.0, "trabajo_total_s": 402.3,
+                    "espera_media_s": 0.32, "trabajo_medio_s": 10.59
+                }
             }
         }
     """
-    return {"queue_size": orchestrator.active_comparisons}
+    return {
+        "queue_size": orchestrator.active_comparisons,
+        "rate_budget": metricas_presupuestos(),
+        "concurrency": estado_limitadores(),
+        "hedging": cobertura_llm.estado(),
+        "render_pool": pool_render.estado(),
+        "cola": [orchestrator.job_queue.estado(), orchestrator.cola_archivos.estado()],
+        "pipeline": orchestrator.pipeline.estado(),
+    }
 
 
 @router.post(
@@ -2478,7 +3134,8 @@ async def webhook_endpoint(request: Request):
         app_logger.info(f"   ✅ Archivos para procesar: {len(files_to_process)}")
         app_logger.info(f"   ⚠️ Archivos omitidos: {len(files_skipped)}")
 
-        # Preparar items para el job
+        # Preparar items para el job. Los PDFs con varias facturas se parten
+        # en el worker (ver _dividir_items), no acá: el webhook responde ya.
         items_to_process = []
         app_logger.info(f"🔧 Preparando items para el job...")
         for file_info in files_to_process:
@@ -2506,7 +3163,7 @@ async def webhook_endpoint(request: Request):
         app_logger.info(
             f"📤 Encolando job {process_id} con {len(items_to_process)} items"
         )
-        await orchestrator.job_queue.put(job)
+        orchestrator.job_queue.encolar(job)
         app_logger.info(f"✅ Job {process_id} encolado exitosamente")
 
         # Respuesta inmediata
@@ -2860,14 +3517,18 @@ async def reintentar_extraccion(
     with open(file_location, "wb") as f:
         f.write(upstream.content)
 
-    asyncio.create_task(
-        _procesar_en_background(
-            file_location=file_location,
-            file_name=file_name,
-            extension=extension,
-            media_type=media_type,
-            process_id=process_id,
-        )
+    orchestrator.cola_archivos.encolar(
+        {
+            "archivos": [
+                {
+                    "file_location": file_location,
+                    "file_name": file_name,
+                    "extension": extension,
+                    "media_type": media_type,
+                    "process_id": process_id,
+                }
+            ]
+        }
     )
     return {
         "success": True,
@@ -0,0 +1,201 @@
+"""
+Servidor local que imita el Files API de Anthropic (POST/GET/DELETE
+/v1/files) y un /v1/messages que resuelve bloques {"type": "file"}, para
+probar la subida única (utils/file_refs.py) sin red ni API key.
+
+/v1/messages devuelve 400 si un bloque referencia un file_id que no existe
+(borrado o nunca subido) y si no, una llamada a la tool pedida con
+argumentos válidos contra su schema (mismo generador que
+scripts/batch_standin_server.py). No lee el documento.
+
+Uso (desde la raíz de Invoicy, con el venv):
+    venv/bin/python scripts/anthropic_files_standin.py
+        # levanta el servidor en http://127.0.0.1:8090; para usarlo desde
+        # la app: LLM_FILE_REFS=true
+        #         ANTHROPIC_FILES_BASE_URL=http://127.0.0.1:8090/v1
+
+    venv/bin/python scripts/anthropic_files_standin.py --probar downloads/factura.pdf
+        # levanta el servidor, deja un archivo "huérfano" viejo, y corre las
+        # 3 tools reales contra el stand-in con el PDF subido una vez por
+        # AnthropicFiles.referencia(); al final verifica que no quedó nada
+        # en el store (ni el PDF ni el huérfano)
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# Permite correr el script tal cual ("python scripts/archivo.py") sin
+# necesidad de invocarlo como módulo -- agrega la raíz de Invoicy a sys.path.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiohttp import web  # noqa: E402
+
+from batch_standin_server import _instancia_de  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+def _ahora(menos_min: float = 0) -> str:
+    return (datetime.now(timezone.utc) - timedelta(minutes=menos_min)).isoformat().replace("+00:00", "Z")
+
+
+def crear_app(store: dict) -> web.Application:
+    async def subir(request: web.Request) -> web.Response:
+        form = await request.post()
+        archivo = form["file"]
+        file_id = f"file_standin{next(_ids):04d}"
+        datos = archivo.file.read()
+        store[file_id] = {
+            "id": file_id,
+            "type": "file",
+            "filename": archivo.filename,
+            "mime_type": archivo.content_type,
+            "size_bytes": len(datos),
+            "created_at": _ahora(),
+            "downloadable": False,
+        }
+        print(f"subido {file_id}: {archivo.filename} ({len(datos)} bytes)")
+        return web.json_response(store[file_id])
+
+    async def listar(request: web.Request) -> web.Response:
+        archivos = list(store.values())
+        return web.json_response(
+            {
+                "data": archivos,
+                "has_more": False,
+                "first_id": archivos[0]["id"] if archivos else None,
+                "last_id": archivos[-1]["id"] if archivos else None,
+            }
+        )
+
+    async def borrar(request: web.Request) -> web.Response:
+        file_id = request.match_info["id"]
+        if store.pop(file_id, None) is None:
+            return web.json_response({"type": "error", "error": {"type": "not_found_error"}}, status=404)
+        print(f"borrado {file_id}")
+        return web.json_response({"id": file_id, "type": "file_deleted"})
+
+    async def mensajes(request: web.Request) -> web.Response:
+        cuerpo = await request.json()
+        for mensaje in cuerpo["messages"]:
+            for parte in mensaje["content"] if isinstance(mensaje["content"], list) else []:
+                fuente = parte.get("source") or {}
+                if fuente.get("type") == "file" and fuente.get("file_id") not in store:
+                    return web.json_response(
+                        {
+                            "type": "error",
+                            "error": {"type": "invalid_request_error", "message": "File not found"},
+                        },
+                        status=400,
+                    )
+        nombre_tool = cuerpo["tool_choice"]["name"]
+        tool = next(t for t in cuerpo["tools"] if t["name"] == nombre_tool)
+        return web.json_response(
+            {
+                "id": f"msg_standin{next(_ids)}",
+                "type": "message",
+                "role": "assistant",
+                "model": cuerpo["model"],
+                "content": [
+                    {
+                        "type": "tool_use",
+                        "id": f"toolu_standin{next(_ids)}",
+                        "name": nombre_tool,
+                        "input": _instancia_de(tool["input_schema"]),
+                    }
+                ],
+                "stop_reason": "tool_use",
+                "usage": {
+                    "input_tokens": len(json.dumps(cuerpo)) // 4,
+                    "output_tokens": 50,
+                    "cache_creation_input_tokens": 0,
+                    "cache_read_input_tokens": 0,
+                },
+            }
+        )
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v1/files", subir)
+    app.router.add_get("/v1/files", listar)
+    app.router.add_delete("/v1/files/{id}", borrar)
+    app.router.add_post("/v1/messages", mensajes)
+    return app
+
+
+async def _probar(archivo: str, puerto: int, store: dict) -> None:
+    # Imports locales: no hacen falta para levantar el servidor solo.
+    from tools import tools
+    from utils.file_refs import FILES_API_BETA, AnthropicFiles
+    from utils.http_session import SharedHttpSession, cerrar_sesiones_http
+
+    base_url = f"http://127.0.0.1:{puerto}/v1"
+    store["file_huerfano"] = {
+        "id": "file_huerfano",
+        "type": "file",
+        "filename": "invoicy-proceso-muerto.pdf",
+        "created_at": _ahora(menos_min=180),
+    }
+    archivos = AnthropicFiles(base_url, activo=True, min_bytes=0)
+    http = SharedHttpSession()
+    session = await http.get()
+    headers = {"anthropic-version": "2023-06-01", "anthropic-beta": FILES_API_BETA}
+
+    async def _tool(tool, file_id):
+        data = {
+            "model": "stand-in",
+            "max_tokens": 1024,
+            "tools": [t["data"] for t in tools],
+            "tool_choice": {"type": "tool", "name": tool["data"]["name"]},
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "document", "source": {"type": "file", "file_id": file_id}},
+                        {"type": "text", "text": tool["prompt"]},
+                    ],
+                }
+            ],
+        }
+        async with session.post(f"{base_url}/messages", headers=headers, json=data) as response:
+            return response.status, await response.json()
+
+    async with archivos.referencia(archivo, "application/pdf", "prueba") as file_id:
+        assert file_id, "no se subió el archivo"
+        resultados = await asyncio.gather(*(_tool(tool, file_id) for tool in tools))
+        for tool, (status, respuesta) in zip(tools, resultados):
+            print(f"{tool['data']['name']}: {status} {respuesta['content'][0]['name'] if status == 200 else respuesta}")
+    await archivos._limpieza
+    status, _ = await _tool(tools[0], file_id)
+    print(f"request con el file_id ya borrado: {status} (esperado 400)")
+    print(f"archivos que quedaron en el store: {list(store)} (esperado [])")
+    print(f"estado: {archivos.estado()}")
+    await cerrar_sesiones_http()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--puerto", type=int, default=8090)
+    parser.add_argument("--probar", metavar="ARCHIVO", help="Prueba la subida única con ARCHIVO y sale.")
+    args = parser.parse_args()
+
+    store = {}
+    runner = web.AppRunner(crear_app(store))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.puerto).start()
+    print(f"stand-in del Files API escuchando en http://127.0.0.1:{args.puerto}/v1")
+    try:
+        if args.probar:
+            await _probar(args.probar, args.puerto, store)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,217 @@
+"""
+Servidor local que imita el endpoint de batch de Gemini
+(models/{model}:batchGenerateContent + batches/{id}) para probar el carril
+bulk (utils/batch_lane.py) sin red ni API key.
+
+Cada batch queda "corriendo" --demora segundos y después devuelve, por cada
+request, una llamada a la función pedida con argumentos armados a partir del
+JSON Schema de la tool: válidos contra el schema y con montos consistentes
+(los chequeos de utils/model_cascade.py pasan). No lee las imágenes -- sirve
+para probar el circuito (armado, polling, validación, cache), no la calidad
+de la extracción.
+
+Uso (desde la raíz de Invoicy, con el venv):
+    venv/bin/python scripts/batch_standin_server.py
+        # levanta el servidor en http://127.0.0.1:8089; para usarlo desde
+        # la app: GEMINI_BULK_LANE=true
+        #         GEMINI_BATCH_BASE_URL=http://127.0.0.1:8089/v1beta
+        #         BULK_POLL_SEGUNDOS=1
+
+    venv/bin/python scripts/batch_standin_server.py --probar downloads/factura.pdf
+        # levanta el servidor, manda ese archivo por GeminiBatchClient con
+        # las tools reales (categorías fijas, no le pega a PocketBase) e
+        # imprime lo que devolvió el batch
+
+    venv/bin/python scripts/batch_standin_server.py --fallar-cada 3
+        # una de cada 3 requests vuelve con error individual (para ver el
+        # fallback al camino síncrono)
+"""
+
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import mimetypes
+import os
+import sys
+from pathlib import Path
+
+# Permite correr el script tal cual ("python scripts/archivo.py") sin
+# necesidad de invocarlo como módulo -- agrega la raíz de Invoicy a sys.path.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiohttp import web  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+def _instancia_de(schema: dict, nombre: str = ""):
+    """Instancia mínima válida para `schema` (subset de JSON Schema que usan
+    tools_standard.py y tools.py)."""
+    if "enum" in schema:
+        return schema["enum"][0]
+    tipo = schema.get("type")
+    if isinstance(tipo, list):
+        tipo = next((t for t in tipo if t != "null"), "null")
+    if tipo == "object" or "properties" in schema:
+        return {
+            clave: _instancia_de(sub, clave)
+            for clave, sub in schema.get("properties", {}).items()
+            if clave in schema.get("required", [])
+        }
+    if tipo == "array":
+        return [_instancia_de(schema["items"], nombre)] if schema.get("minItems") else []
+    if tipo in ("number", "integer"):
+        return 0
+    if tipo == "boolean":
+        return False
+    if tipo == "null":
+        return None
+    if nombre == "id_fiscal":
+        return "20-12345678-6"  # CUIT con dígito verificador válido
+    if schema.get("format") == "date":
+        return "2026-01-01"
+    return "stand-in"
+
+
+def _respuesta_para(request: dict) -> dict:
+    nombre_tool = request["toolConfig"]["functionCallingConfig"]["allowedFunctionNames"][0]
+    declaracion = next(
+        d
+        for tool in request["tools"]
+        for d in tool["functionDeclarations"]
+        if d["name"] == nombre_tool
+    )
+    return {
+        "candidates": [
+            {
+                "content": {
+                    "role": "model",
+                    "parts": [
+                        {
+                            "functionCall": {
+                                "name": nombre_tool,
+                                "args": _instancia_de(declaracion["parametersJsonSchema"]),
+                            }
+                        }
+                    ],
+                }
+            }
+        ],
+        "usageMetadata": {
+            "promptTokenCount": len(json.dumps(request)) // 4,
+            "candidatesTokenCount": 50,
+        },
+    }
+
+
+def crear_app(demora: float, fallar_cada: int) -> web.Application:
+    batches = {}
+    contador = itertools.count(1)
+
+    async def crear(request: web.Request) -> web.Response:
+        cuerpo = await request.json()
+        entradas = cuerpo["batch"]["input_config"]["requests"]["requests"]
+        nombre = f"batches/standin-{next(_ids)}"
+        respuestas = []
+        for entrada in entradas:
+            if fallar_cada and next(contador) % fallar_cada == 0:
+                respuestas.append(
+                    {"metadata": entrada.get("metadata"), "error": {"code": 500, "message": "stand-in"}}
+                )
+                continue
+            respuestas.append(
+                {"metadata": entrada.get("metadata"), "response": _respuesta_para(entrada["request"])}
+            )
+        batches[nombre] = {
+            "listo_en": asyncio.get_running_loop().time() + demora,
+            "respuestas": respuestas,
+            "cancelado": False,
+        }
+        print(f"creado {nombre} con {len(entradas)} requests ({request.match_info['modelo']})")
+        return web.json_response({"name": nombre, "metadata": {"state": "BATCH_STATE_PENDING"}})
+
+    async def consultar(request: web.Request) -> web.Response:
+        nombre = f"batches/{request.match_info['id']}"
+        batch = batches.get(nombre)
+        if batch is None:
+            return web.json_response({"error": {"code": 404}}, status=404)
+        if batch["cancelado"]:
+            return web.json_response(
+                {"name": nombre, "done": True, "metadata": {"state": "BATCH_STATE_CANCELLED"}}
+            )
+        if asyncio.get_running_loop().time() < batch["listo_en"]:
+            return web.json_response({"name": nombre, "metadata": {"state": "BATCH_STATE_RUNNING"}})
+        return web.json_response(
+            {
+                "name": nombre,
+                "done": True,
+                "metadata": {"state": "BATCH_STATE_SUCCEEDED"},
+                "response": {"inlinedResponses": {"inlinedResponses": batch["respuestas"]}},
+            }
+        )
+
+    async def cancelar(request: web.Request) -> web.Response:
+        batch = batches.get(f"batches/{request.match_info['id']}")
+        if batch is not None:
+            batch["cancelado"] = True
+        return web.json_response({})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v1beta/models/{modelo}:batchGenerateContent", crear)
+    app.router.add_get("/v1beta/batches/{id}", consultar)
+    app.router.add_post("/v1beta/batches/{id}:cancel", cancelar)
+    return app
+
+
+async def _probar(archivo: str, puerto: int) -> None:
+    os.environ.setdefault("BULK_POLL_SEGUNDOS", "1")
+    # Imports locales: BULK_POLL_SEGUNDOS se lee al importar utils.batch_lane.
+    from tools_standard import build_tools
+    from utils.bas_config import CATEGORIAS_ITEM_BAS
+    from utils.batch_lane import GeminiBatchClient, armar_request_nativa
+    from utils.http_session import cerrar_sesiones_http
+
+    media_type = mimetypes.guess_type(archivo)[0] or "application/octet-stream"
+    datos = base64.b64encode(Path(archivo).read_bytes()).decode()
+    contenido = [{"type": "image_url", "image_url": {"url": f"data:{media_type};base64,{datos}"}}]
+    tools_standard = build_tools(CATEGORIAS_ITEM_BAS)
+    tools = [t["data"] for t in tools_standard]
+    requests_lote = {
+        t["data"]["function"]["name"]: armar_request_nativa(
+            tools,
+            t["data"]["function"]["name"],
+            [*contenido, {"type": "text", "text": t["prompt"]}],
+        )
+        for t in tools_standard
+    }
+    cliente = GeminiBatchClient("stand-in", f"http://127.0.0.1:{puerto}/v1beta")
+    salidas = await cliente.ejecutar_lote("gemini-stand-in", requests_lote, "prueba")
+    await cerrar_sesiones_http()
+    print(json.dumps(salidas, indent=2, ensure_ascii=False))
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--puerto", type=int, default=8089)
+    parser.add_argument("--demora", type=float, default=3.0, help="Segundos hasta que un batch termina.")
+    parser.add_argument("--fallar-cada", type=int, default=0, help="Una de cada N requests falla.")
+    parser.add_argument("--probar", metavar="ARCHIVO", help="Manda ARCHIVO por el batch y sale.")
+    args = parser.parse_args()
+
+    runner = web.AppRunner(crear_app(args.demora, args.fallar_cada))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.puerto).start()
+    print(f"stand-in de batch escuchando en http://127.0.0.1:{args.puerto}/v1beta")
+    try:
+        if args.probar:
+            await _probar(args.probar, args.puerto)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,185 @@
+"""
+Benchmark de formatos de imagen para las páginas rasterizadas de los PDFs
+(utils/pdf_text.imagen_pagina): bytes del payload, tiempo de render+encode y,
+opcionalmente, precisión de la extracción, sobre un corpus de PDFs.
+
+Cada configuración es formato[:calidad][:color] -- p.ej. "png", "jpeg:60",
+"webp:75:color", "auto". "anterior" es el camino de antes (pixmap color ->
+PNG -> PIL -> PNG). Se rasterizan TODAS las páginas, tengan o no capa de
+texto: el formato solo importa para las que van como imagen.
+
+Precisión (--precision): cada PDF se extrae con cada configuración por el
+orquestador de BAS (mismo _extraer que run_pdf_toolchain; usa GEMINI_API_KEY
+y GEMINI_MODEL del .env y CONSUME CUOTA) y se compara campo a campo contra
+la referencia: <pdf>.esperado.json al lado del PDF si existe (la salida de
+formatear_factura corregida a mano), o si no la extracción con "anterior".
+
+Uso (desde la raíz de Invoicy, con el venv):
+    venv/bin/python scripts/bench_codecs_pdf.py downloads/*.pdf
+    venv/bin/python scripts/bench_codecs_pdf.py downloads/ --config png jpeg:60 webp:60 auto
+    venv/bin/python scripts/bench_codecs_pdf.py downloads/ --precision
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import sys
+import time
+from pathlib import Path
+
+# Permite correr el script tal cual ("python scripts/archivo.py") sin
+# necesidad de invocarlo como módulo -- agrega la raíz de Invoicy a sys.path.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fitz  # noqa: E402
+from dotenv import load_dotenv  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from utils.pdf_text import DPI, imagen_pagina, seleccionar_paginas  # noqa: E402
+
+CONFIGS_DEFAULT = ["anterior", "png", "jpeg:75", "jpeg:60", "webp:75", "webp:60", "auto"]
+
+
+def _anterior(page: "fitz.Page"):
+    """El camino de antes de imagen_pagina, tal cual."""
+    pix = page.get_pixmap(dpi=DPI)
+    img = Image.open(io.BytesIO(pix.tobytes("png")))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return "image/png", buffer.getvalue()
+
+
+def _renderizar(config: str, page: "fitz.Page"):
+    if config == "anterior":
+        return _anterior(page)
+    partes = config.split(":")
+    formato = partes[0]
+    calidad = next((int(p) for p in partes[1:] if p.isdigit()), None)
+    return imagen_pagina(page, formato, calidad, grises="color" not in partes)
+
+
+def _paginas(config: str, pdf: Path):
+    """(partes de content OpenAI-compat, bytes base64, segundos)."""
+    partes, total, inicio = [], 0, time.perf_counter()
+    with fitz.open(pdf) as doc:
+        for page in doc:
+            media_type, datos = _renderizar(config, page)
+            b64 = base64.b64encode(datos).decode()
+            total += len(b64)
+            partes.append(
+                {"type": "image_url", "image_url": {"url": f"data:{media_type};base64,{b64}"}}
+            )
+    return partes, total, time.perf_counter() - inicio
+
+
+def _hojas(valor, ruta=""):
+    """{ruta: valor} de las hojas de un JSON."""
+    if isinstance(valor, dict):
+        return {k: v for clave, sub in valor.items() for k, v in _hojas(sub, f"{ruta}.{clave}").items()}
+    if isinstance(valor, list):
+        return {k: v for i, sub in enumerate(valor) for k, v in _hojas(sub, f"{ruta}[{i}]").items()}
+    return {ruta: valor}
+
+
+def _igual(a, b) -> bool:
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return abs(a - b) <= 0.01 * max(abs(a), abs(b), 1)
+    return str(a).strip().lower() == str(b).strip().lower()
+
+
+def precision(referencia: dict, extraccion: dict) -> float:
+    """Fracción de las hojas de la referencia que la extracción reproduce."""
+    esperadas = _hojas(referencia)
+    obtenidas = _hojas(extraccion)
+    if not esperadas:
+        return 1.0
+    return sum(
+        1 for ruta, valor in esperadas.items() if ruta in obtenidas and _igual(valor, obtenidas[ruta])
+    ) / len(esperadas)
+
+
+async def _extraer(orquestador, tools_standard, partes, nombre: str) -> dict:
+    def armar_contenido(prompt, idx, tool_name=None, paginas=None):
+        return [*seleccionar_paginas(partes, tool_name, paginas), {"type": "text", "text": prompt}]
+
+    respuestas, _ = await orquestador._extraer(tools_standard, armar_contenido, nombre, len(partes))
+    datos = orquestador.formatear_factura(respuestas)["data"]
+    # Solo las secciones extraídas: el resto (tokens, modelos) no es precisión.
+    return {k: datos.get(k) for k in ("emisor_receptor", "items", "impuestos")}
+
+
+async def _medir_precision(pdfs, configs) -> dict:
+    # Imports locales: el orquestador carga FastAPI, Sheets, BAS, etc., y
+    # solo hace falta con --precision.
+    from routes.process_invoice_google_2 import orchestrator
+    from tools_standard import build_tools
+    from utils.bas_config import CATEGORIAS_ITEM_BAS
+    from utils.http_session import cerrar_sesiones_http
+
+    tools_standard = build_tools(CATEGORIAS_ITEM_BAS)
+    resultados = {config: [] for config in configs}
+    try:
+        for pdf in pdfs:
+            esperado = pdf.with_suffix(".esperado.json")
+            referencia = json.loads(esperado.read_text()) if esperado.exists() else None
+            extracciones = {}
+            for config in configs:
+                partes, _, _ = _paginas(config, pdf)
+                try:
+                    extracciones[config] = await _extraer(
+                        orchestrator, tools_standard, partes, f"bench-{pdf.stem}-{config}"
+                    )
+                except Exception as e:
+                    print(f"  {pdf.name} [{config}]: falló la extracción: {e}")
+            if referencia is None:
+                referencia = extracciones.get("anterior")
+            if referencia is None:
+                print(f"  {pdf.name}: sin referencia (ni .esperado.json ni 'anterior'), se saltea")
+                continue
+            for config, extraccion in extracciones.items():
+                resultados[config].append(precision(referencia, extraccion))
+    finally:
+        await cerrar_sesiones_http()
+    return resultados
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("corpus", nargs="+", help="PDFs o directorios con PDFs.")
+    parser.add_argument("--config", nargs="+", default=CONFIGS_DEFAULT)
+    parser.add_argument("--precision", action="store_true", help="Medir precisión (consume cuota).")
+    args = parser.parse_args()
+
+    pdfs = []
+    for entrada in map(Path, args.corpus):
+        pdfs.extend(sorted(entrada.glob("*.pdf")) if entrada.is_dir() else [entrada])
+    if not pdfs:
+        parser.error("no hay PDFs en el corpus")
+
+    print(f"{len(pdfs)} PDFs, {DPI} DPI")
+    print(f"{'config':<16}{'páginas':>8}{'KB base64':>12}{'KB/página':>11}{'ms/página':>11}")
+    for config in args.config:
+        paginas = total = segundos = 0
+        for pdf in pdfs:
+            partes, bytes_b64, tiempo = _paginas(config, pdf)
+            paginas += len(partes)
+            total += bytes_b64
+            segundos += tiempo
+        print(
+            f"{config:<16}{paginas:>8}{total / 1024:>12.0f}{total / 1024 / max(paginas, 1):>11.1f}"
+            f"{1000 * segundos / max(paginas, 1):>11.1f}"
+        )
+
+    if args.precision:
+        load_dotenv()
+        resultados = asyncio.run(_medir_precision(pdfs, args.config))
+        print(f"\n{'config':<16}{'precisión':>10}{'PDFs':>6}")
+        for config, valores in resultados.items():
+            media = sum(valores) / len(valores) if valores else float("nan")
+            print(f"{config:<16}{100 * media:>9.1f}%{len(valores):>6}")
+
+
+if __name__ == "__main__":
+    main()
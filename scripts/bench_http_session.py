@@ -0,0 +1,115 @@
+"""
+Benchmark: sesión HTTP nueva por request (comportamiento anterior de
+make_api_request) vs. sesión pooled compartida (utils/http_session.py).
+
+Simula N facturas de 3 llamadas cada una (una por tool, igual que
+run_image_toolchain / run_pdf_toolchain) contra el host del proveedor y mide,
+con un TraceConfig de aiohttp, cuánto tiempo se va en abrir conexiones
+(DNS + TCP + handshake TLS) en cada modo. No manda API key ni payload real:
+hace un GET liviano al host, así que no consume cuota.
+
+Uso (desde la raíz de Invoicy, con el venv):
+    venv/bin/python scripts/bench_http_session.py
+    venv/bin/python scripts/bench_http_session.py --facturas 20 \
+        --url https://api.anthropic.com/
+"""
+
+import argparse
+import asyncio
+import ssl
+import sys
+import time
+from pathlib import Path
+
+# Permite correr el script tal cual ("python scripts/archivo.py") sin
+# necesidad de invocarlo como módulo -- agrega la raíz de Invoicy a sys.path.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiohttp  # noqa: E402
+import certifi  # noqa: E402
+
+from utils.http_session import SharedHttpSession  # noqa: E402
+
+TOOLS_POR_FACTURA = 3
+
+
+def _trace_config(metricas: dict) -> aiohttp.TraceConfig:
+    """Acumula en `metricas` cuántas conexiones se abrieron y cuánto tardaron."""
+
+    async def on_start(session, ctx, params):
+        ctx.inicio = time.perf_counter()
+
+    async def on_end(session, ctx, params):
+        metricas["conexiones"] += 1
+        metricas["segundos_conexion"] += time.perf_counter() - ctx.inicio
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_start.append(on_start)
+    trace.on_connection_create_end.append(on_end)
+    return trace
+
+
+async def _modo_sesion_nueva(url: str, facturas: int) -> dict:
+    metricas = {"conexiones": 0, "segundos_conexion": 0.0}
+    inicio = time.perf_counter()
+    for _ in range(facturas):
+        for _ in range(TOOLS_POR_FACTURA):
+            ssl_context = ssl.create_default_context(cafile=certifi.where())
+            connector = aiohttp.TCPConnector(ssl=ssl_context)
+            async with aiohttp.ClientSession(
+                connector=connector, trace_configs=[_trace_config(metricas)]
+            ) as session:
+                async with session.get(url) as response:
+                    await response.read()
+    metricas["segundos_total"] = time.perf_counter() - inicio
+    return metricas
+
+
+async def _modo_sesion_compartida(url: str, facturas: int) -> dict:
+    metricas = {"conexiones": 0, "segundos_conexion": 0.0}
+    http = SharedHttpSession()
+    session = await http.get()
+    session.trace_configs.append(_trace_config(metricas))
+    for trace in session.trace_configs:
+        trace.freeze()
+    inicio = time.perf_counter()
+    try:
+        for _ in range(facturas):
+            for _ in range(TOOLS_POR_FACTURA):
+                async with session.get(url) as response:
+                    await response.read()
+    finally:
+        await http.close()
+    metricas["segundos_total"] = time.perf_counter() - inicio
+    return metricas
+
+
+def _imprimir(nombre: str, metricas: dict, facturas: int) -> None:
+    print(
+        f"{nombre:<20} conexiones={metricas['conexiones']:>4}  "
+        f"handshake/factura={1000 * metricas['segundos_conexion'] / facturas:8.1f} ms  "
+        f"total/factura={1000 * metricas['segundos_total'] / facturas:8.1f} ms"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--url",
+        default="https://generativelanguage.googleapis.com/",
+        help="Host del proveedor contra el que medir (GET liviano, sin API key).",
+    )
+    parser.add_argument("--facturas", type=int, default=10)
+    args = parser.parse_args()
+
+    nueva = await _modo_sesion_nueva(args.url, args.facturas)
+    compartida = await _modo_sesion_compartida(args.url, args.facturas)
+
+    _imprimir("sesión nueva", nueva, args.facturas)
+    _imprimir("sesión compartida", compartida, args.facturas)
+    ahorro_ms = 1000 * (nueva["segundos_conexion"] - compartida["segundos_conexion"]) / args.facturas
+    print(f"\nHandshake ahorrado por factura ({TOOLS_POR_FACTURA} tools): {ahorro_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
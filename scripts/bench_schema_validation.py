@@ -0,0 +1,114 @@
+"""
+Micro-benchmark: validación de la salida de una tool como se hacía antes en
+tool_handler (buscar el schema recorriendo `tools` + jsonschema.validate() en
+cada intento) vs. validadores compilados y cacheados
+(utils/schema_validators.py).
+
+Usa las tools reales de tools_standard.build_tools() con una lista fija de
+categorías (no le pega a PocketBase) y una salida de ítems sintética, válida
+o con errores (--invalida). Con --nuevas-tools cada iteración arma tools
+nuevas con build_tools(), como pasa en producción con cada factura.
+
+Uso (desde la raíz de Invoicy, con el venv):
+    venv/bin/python scripts/bench_schema_validation.py
+    venv/bin/python scripts/bench_schema_validation.py --iteraciones 2000 --invalida
+    venv/bin/python scripts/bench_schema_validation.py --nuevas-tools
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# Permite correr el script tal cual ("python scripts/archivo.py") sin
+# necesidad de invocarlo como módulo -- agrega la raíz de Invoicy a sys.path.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from jsonschema import ValidationError, validate  # noqa: E402
+
+from tools_standard import build_tools  # noqa: E402
+from utils.bas_config import CATEGORIAS_ITEM_BAS  # noqa: E402
+from utils.schema_validators import schema_de_tool, validar  # noqa: E402
+
+TOOL_NAME = "detalle_de_items_facturados"
+
+
+def _salida_items(cantidad: int, invalida: bool) -> dict:
+    item = {
+        "descripcion": "Lavandina 5L",
+        "cantidad": 2,
+        "precio_unitario": 1500.0,
+        "precio_total": 3000.0,
+        "categoria": CATEGORIAS_ITEM_BAS[0],
+    }
+    items = [dict(item) for _ in range(cantidad)]
+    if invalida:
+        items[0]["categoria"] = "no existe"
+        items[-1]["cantidad"] = "dos"
+    total = 3000.0 * cantidad
+    return {"detalles": items, "subtotal": total, "total": total}
+
+
+def _camino_anterior(tools: list, salida: dict) -> None:
+    schema = next(
+        (
+            tool["function"]["parameters"]
+            for tool in tools
+            if tool["function"]["name"] == TOOL_NAME
+        ),
+        None,
+    )
+    try:
+        validate(instance=salida, schema=schema)
+    except ValidationError:
+        pass
+
+
+def _camino_nuevo(tools: list, salida: dict) -> None:
+    try:
+        validar(schema_de_tool(tools, TOOL_NAME), salida)
+    except ValidationError:
+        pass
+
+
+def _medir(camino, args, salida, tools_fijas) -> float:
+    inicio = time.perf_counter()
+    for _ in range(args.iteraciones):
+        tools = (
+            [t["data"] for t in build_tools(CATEGORIAS_ITEM_BAS)]
+            if args.nuevas_tools
+            else tools_fijas
+        )
+        camino(tools, salida)
+    return (time.perf_counter() - inicio) / args.iteraciones
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iteraciones", type=int, default=500)
+    parser.add_argument("--items", type=int, default=20, help="Ítems en la salida sintética.")
+    parser.add_argument("--invalida", action="store_true", help="Salida con 2 errores.")
+    parser.add_argument(
+        "--nuevas-tools",
+        action="store_true",
+        help="Armar tools nuevas con build_tools() en cada iteración.",
+    )
+    args = parser.parse_args()
+
+    tools_fijas = [t["data"] for t in build_tools(CATEGORIAS_ITEM_BAS)]
+    salida = _salida_items(args.items, args.invalida)
+
+    # El schema sintético tiene que coincidir con el real -- si no, se estaría
+    # midiendo otra cosa.
+    if not args.invalida:
+        validar(schema_de_tool(tools_fijas, TOOL_NAME), salida)
+
+    anterior = _medir(_camino_anterior, args, salida, tools_fijas)
+    nuevo = _medir(_camino_nuevo, args, salida, tools_fijas)
+    print(f"anterior (validate)   {1e6 * anterior:10.1f} µs/validación")
+    print(f"cacheado (validar)    {1e6 * nuevo:10.1f} µs/validación")
+    print(f"speedup               {anterior / nuevo:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,9 @@ from routes.process_invoice import router as process_invoice_router
 from routes.process_invoice_google import router as process_invoice_google_router
 from routes.process_invoice_google_2 import router as process_invoice_google_router_2
 from routes.webhook import router as webhook_router
+from utils.durable_queue import liberar_arriendos
+from utils.http_session import cerrar_sesiones_http
+from utils.render_pool import pool_render
 
 # Configuración del logger
 logging.basicConfig(
@@ -76,6 +79,17 @@ async def startup_event():
         asyncio.create_task(google_orchestrator.worker())
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Cierra las sesiones HTTP pooled de los orquestadores (ver utils/http_session.py)
+    await cerrar_sesiones_http()
+    # Y el pool de render compartido (ver utils/render_pool.py)
+    pool_render.cerrar()
+    # Devuelve a la cola los trabajos en curso sin gastarles un intento (ver
+    # utils/durable_queue.py); el próximo arranque los retoma.
+    liberar_arriendos()
+
+
 # API Endpoints
 @app.get(
     "/",
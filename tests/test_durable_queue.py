@@ -0,0 +1,74 @@
+"""
+Progreso de utils/durable_queue.py: lo que un worker anotó sobrevive a una
+nueva entrega del trabajo, para no repetir efectos que no son idempotentes.
+
+Uso (desde la raíz de Invoicy, con el venv):
+    venv/bin/python -m pytest tests/
+"""
+
+import asyncio
+import sqlite3
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.durable_queue import ColaDurable, pasos_hechos  # noqa: E402
+
+
+def test_el_progreso_vuelve_con_la_nueva_entrega(tmp_path):
+    async def _correr():
+        cola = ColaDurable("test", path=str(tmp_path / "cola.sqlite3"))
+        cola.encolar({"items": ["a.pdf", "b.pdf"]})
+
+        trabajo = await cola.tomar()
+        assert trabajo["progreso"] == {}
+        assert await cola.anotar(trabajo, "item-1", {"email_enviado": True})
+        # El segundo item manda el email pero falla el webhook: se anota
+        # solo lo que salió bien.
+        ctx = pasos_hechos(trabajo, "item-2")
+        ctx.update(email_enviado=True, webhook_enviado=False)
+        assert await cola.anotar_pasos(
+            trabajo, "item-2", ctx, ("email_enviado", "webhook_enviado")
+        )
+        # Se cae a la mitad del segundo item: el trabajo vuelve a la cola.
+        await cola.devolver(trabajo, "restart", demora_s=0)
+
+        trabajo = await cola.tomar()
+        assert trabajo["intentos"] == 2
+        assert trabajo["progreso"] == {
+            "item-1": {"email_enviado": True},
+            "item-2": {"email_enviado": True},
+        }
+        assert pasos_hechos(trabajo, "item-3") == {}
+        await cola.confirmar(trabajo)
+        # Con el lease ya suelto, anotar no pisa nada.
+        assert not await cola.anotar(trabajo, "item-2", {"email_enviado": True})
+
+    asyncio.run(_correr())
+
+
+def test_base_sin_columna_progreso(tmp_path):
+    path = tmp_path / "cola.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE trabajos (id INTEGER PRIMARY KEY AUTOINCREMENT, cola TEXT NOT NULL, "
+        "payload TEXT NOT NULL, estado TEXT NOT NULL, intentos INTEGER NOT NULL DEFAULT 0, "
+        "visible_desde REAL NOT NULL, dueno TEXT, ultimo_error TEXT, creado_en REAL NOT NULL, "
+        "actualizado_en REAL NOT NULL)"
+    )
+    conn.execute(
+        "INSERT INTO trabajos (cola, payload, estado, visible_desde, creado_en, actualizado_en) "
+        "VALUES ('test', '{}', 'pendiente', 0, 0, 0)"
+    )
+    conn.commit()
+    conn.close()
+
+    async def _correr():
+        cola = ColaDurable("test", path=str(path))
+        trabajo = await cola.tomar()
+        assert trabajo["progreso"] == {}
+        assert await cola.anotar(trabajo, "item-1", {"saved_sheet": True})
+        await cola.confirmar(trabajo)
+
+    asyncio.run(_correr())
@@ -0,0 +1,137 @@
+"""
+Circuit breaker de utils/retry_policy.py: la llamada de prueba del estado
+semiabierto tiene que liberar su lugar aunque la cancelen o se cuelgue.
+
+Uso (desde la raíz de Invoicy, con el venv):
+    venv/bin/python -m pytest tests/
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import retry_policy  # noqa: E402
+from utils.retry_policy import (  # noqa: E402
+    RetryPolicy,
+    UpstreamUnavailableError,
+    breaker_para,
+)
+
+
+class _SesionColgada:
+    """Sesión de aiohttp cuyo POST nunca responde."""
+
+    def __init__(self):
+        self.entro = asyncio.Event()
+
+    def post(self, url, headers=None, data=None):
+        sesion = self
+
+        class _Respuesta:
+            async def __aenter__(self):
+                sesion.entro.set()
+                await asyncio.Event().wait()
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Respuesta()
+
+
+def _semiabierto(url: str):
+    breaker = breaker_para(url)
+    breaker.fallas_seguidas = breaker.umbral
+    breaker.abierto_hasta = 0.0
+    breaker._sondeando = False
+    assert breaker.estado == "semiabierto"
+    return breaker
+
+
+def test_sondeo_cancelado_libera_el_breaker():
+    url = "https://sondeo-cancelado.test/v1"
+    breaker = _semiabierto(url)
+
+    async def main():
+        sesion = _SesionColgada()
+        tarea = asyncio.create_task(
+            RetryPolicy(max_intentos=1).post_json(sesion, url, {}, {})
+        )
+        await sesion.entro.wait()
+        # Mientras la prueba está en vuelo, el resto se rechaza.
+        assert breaker._sondeando
+        tarea.cancel()
+        try:
+            await tarea
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    assert not breaker._sondeando
+    assert breaker.estado == "semiabierto"
+    # La próxima llamada puede volver a ser la de prueba.
+    assert breaker.verificar() is True
+    breaker.liberar_sondeo()
+
+
+def test_sondeo_colgado_vence_y_reabre(monkeypatch):
+    url = "https://sondeo-colgado.test/v1"
+    breaker = _semiabierto(url)
+    monkeypatch.setattr(retry_policy, "TIMEOUT_SONDEO", 0.05)
+
+    async def main():
+        try:
+            await RetryPolicy(max_intentos=1).post_json(_SesionColgada(), url, {}, {})
+        except UpstreamUnavailableError:
+            return
+        raise AssertionError("tenía que vencer el timeout de la prueba")
+
+    asyncio.run(main())
+    assert not breaker._sondeando
+    assert breaker.estado == "abierto"
+
+
+def test_el_deadline_acota_cada_intento():
+    url = "https://post-colgado.test/v1"
+
+    async def main():
+        inicio = time.monotonic()
+        try:
+            await RetryPolicy(max_intentos=3, deadline=0.2).post_json(
+                _SesionColgada(), url, {}, {}
+            )
+        except UpstreamUnavailableError:
+            return time.monotonic() - inicio
+        raise AssertionError("tenía que vencer el deadline")
+
+    assert asyncio.run(main()) < 1
+
+
+def test_circuito_abierto_no_gasta_presupuesto():
+    url = "https://circuito-abierto.test/v1"
+    breaker = breaker_para(url)
+    breaker.fallas_seguidas = breaker.umbral
+    breaker.abierto_hasta = time.monotonic() + 60
+
+    class _Presupuesto:
+        pedidos = 0
+
+        async def adquirir(self, data, process_id):
+            self.pedidos += 1
+            return 0
+
+    presupuesto = _Presupuesto()
+
+    async def main():
+        try:
+            await RetryPolicy(max_intentos=1).post_json(
+                _SesionColgada(), url, {}, {}, presupuesto=presupuesto
+            )
+        except UpstreamUnavailableError:
+            return
+        raise AssertionError("el circuito abierto tenía que rechazar")
+
+    asyncio.run(main())
+    assert presupuesto.pedidos == 0
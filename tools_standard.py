@@ -357,6 +357,48 @@ def build_tools(categorias=None):
     return tools
 
 
+# Nombre de la función "combinada" (modo de una sola request por factura, ver
+# build_combined_tool() y utils/toolchain.extraer_con_schema_combinado()).
+COMBINED_TOOL_NAME = "extraccion_completa_de_la_factura"
+
+
+def build_combined_tool(tools_standard):
+    """Funde las 3 tools de `tools_standard` (salida de build_tools()) en UNA
+    sola function con una propiedad por tool -- {nombre_tool: parameters} --
+    para pedir emisor/receptor, ítems e impuestos en una única llamada.
+
+    Los schemas de cada sección se copian tal cual (incluido el enum de
+    categorías ya parcheado), así cada sección de la respuesta se puede
+    validar contra el schema de su tool original y, si falla, pedir SOLO esa
+    sección con su tool de siempre. Los prompts se concatenan en el mismo
+    orden, cada uno bajo el nombre de su sección.
+    """
+    nombres = [tool["data"]["function"]["name"] for tool in tools_standard]
+    prompt = "Completá TODAS las secciones de la función en una sola respuesta.\n\n" + "\n\n".join(
+        f"Sección '{nombre}': {tool['prompt']}"
+        for nombre, tool in zip(nombres, tools_standard)
+    )
+    return {
+        "prompt": prompt,
+        "data": {
+            "type": "function",
+            "function": {
+                "name": COMBINED_TOOL_NAME,
+                "description": "Extrae en una sola llamada los datos del emisor y receptor, el detalle de ítems y los impuestos y retenciones de un comprobante fiscal.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        nombre: copy.deepcopy(tool["data"]["function"]["parameters"])
+                        for nombre, tool in zip(nombres, tools_standard)
+                    },
+                    "required": nombres,
+                    "additionalProperties": False,
+                },
+            },
+        },
+    }
+
+
 # Alias retrocompatible -- routes/process_invoice_google.py (invoice-api-wa,
 # el servicio de WhatsApp) todavía importa "tools" a la manera vieja
 # (`from tools_standard import tools as tools_standard`) y NO se tocó en este
@@ -0,0 +1,181 @@
+"""
+Límite de concurrencia adaptativo (AIMD) para las llamadas de extracción a
+cada proveedor de LLM.
+
+La concurrencia real hacia el proveedor salía de números fijos -- semaphore=3
+por orquestador, 5 workers por orquestador en el startup, 3 tools por
+factura, más las tareas de _procesar_en_background que no pasan por ningún
+semáforo -- sin importar cómo estuviera respondiendo el proveedor en ese
+momento. Acá hay UN límite por host, compartido por todo el proceso, que se
+ajusta solo:
+
+  - Aumento aditivo: cada llamada sana suma 1/limite (≈ +1 por "ronda"
+    completa de llamadas) mientras la latencia se mantenga.
+  - Baja multiplicativa (x0.5) ante un 429/5xx (avisado por
+    utils/retry_policy.py vía al_sobrecarga), un UpstreamUnavailableError, o
+    un p95 de latencia que se dispara respecto de la referencia. Como mucho
+    una baja por ENFRIAMIENTO segundos, para no desplomarlo por una sola
+    ráfaga de errores de llamadas que ya estaban en vuelo.
+
+Cada intento HTTP de utils/retry_policy.post_json (make_api_request de los
+tres orquestadores le pasa el limitador) corre dentro de slot(): las esperas
+del backoff entre intentos no ocupan lugar, y la latencia que alimenta el
+p95 es la de un intento que salió bien -- no la de la llamada entera con
+sus reintentos, que hacía ver como "lenta" una llamada que solo esperó. El
+límite actual y su historial de cambios se ven en GET /queue.
+
+Configuración por variables de entorno (opcionales):
+    LLM_CONCURRENCIA_INICIAL   (default 9 = 3 facturas x 3 tools)
+    LLM_CONCURRENCIA_MIN       (default 1)
+    LLM_CONCURRENCIA_MAX       (default 32)
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict
+from urllib.parse import urlparse
+
+app_logger = logging.getLogger("app_logger")
+
+CONCURRENCIA_INICIAL = float(os.getenv("LLM_CONCURRENCIA_INICIAL", "9"))
+CONCURRENCIA_MIN = float(os.getenv("LLM_CONCURRENCIA_MIN", "1"))
+CONCURRENCIA_MAX = float(os.getenv("LLM_CONCURRENCIA_MAX", "32"))
+
+FACTOR_BAJA = 0.5
+ENFRIAMIENTO = 5.0  # segundos mínimos entre dos bajas
+VENTANA = 50  # latencias recientes para el p95
+P95_TOLERANCIA = 1.5  # p95 > 1.5x la referencia = "se está degradando"
+
+
+def _p95(valores) -> float:
+    ordenados = sorted(valores)
+    return ordenados[int(0.95 * (len(ordenados) - 1))]
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        nombre: str,
+        inicial: float = None,
+        minimo: float = None,
+        maximo: float = None,
+    ):
+        self.nombre = nombre
+        self.minimo = minimo or CONCURRENCIA_MIN
+        self.maximo = maximo or CONCURRENCIA_MAX
+        self.limite = min(self.maximo, inicial or CONCURRENCIA_INICIAL)
+        self.en_vuelo = 0
+        self._condicion = asyncio.Condition()
+        self._latencias = deque(maxlen=VENTANA)
+        self._p95_referencia = None
+        self._ultima_baja = 0.0
+        self.historial = deque(maxlen=50)
+        self._anotar("inicio")
+
+    def _anotar(self, motivo: str) -> None:
+        self.historial.append(
+            {"ts": round(time.time(), 1), "limite": int(self.limite), "motivo": motivo}
+        )
+
+    async def _notificar(self) -> None:
+        async with self._condicion:
+            self._condicion.notify_all()
+
+    def _subir(self) -> None:
+        # Solo sube si el límite de verdad está limitando -- si no, crecería
+        # sin medida en horas tranquilas y no significaría nada.
+        if self.en_vuelo < int(self.limite):
+            return
+        anterior = int(self.limite)
+        self.limite = min(self.maximo, self.limite + 1 / self.limite)
+        if int(self.limite) > anterior:
+            self._anotar("sube")
+
+    def _bajar(self, motivo: str) -> None:
+        ahora = time.monotonic()
+        if ahora - self._ultima_baja < ENFRIAMIENTO:
+            return
+        self._ultima_baja = ahora
+        self.limite = max(self.minimo, self.limite * FACTOR_BAJA)
+        # La referencia de latencia se recalcula con lo que venga después.
+        self._latencias.clear()
+        self._anotar(motivo)
+        app_logger.warning(
+            f"📉 Concurrencia {self.nombre}: baja a {int(self.limite)} ({motivo})"
+        )
+
+    def registrar_sobrecarga(self, status: int) -> None:
+        """Callback para utils/retry_policy.py: el proveedor devolvió un
+        status reintentable (429/5xx/529)."""
+        self._bajar(f"status {status}")
+
+    def registrar_caida(self) -> None:
+        """La llamada terminó en UpstreamUnavailableError (reintentos
+        agotados, deadline, circuito abierto)."""
+        self._bajar("upstream no disponible")
+
+    def _registrar_latencia(self, segundos: float) -> None:
+        self._latencias.append(segundos)
+        if len(self._latencias) < 10:
+            self._subir()
+            return
+        p95 = _p95(self._latencias)
+        if self._p95_referencia is None:
+            self._p95_referencia = p95
+        if p95 > P95_TOLERANCIA * self._p95_referencia:
+            self._bajar(f"p95 {p95:.1f}s > {P95_TOLERANCIA}x {self._p95_referencia:.1f}s")
+            return
+        # La referencia sigue lentamente a la latencia sana (el tamaño de
+        # las facturas cambia a lo largo del día).
+        self._p95_referencia = 0.9 * self._p95_referencia + 0.1 * p95
+        self._subir()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Un lugar para UN intento HTTP. Devuelve sano(): llamarlo cuando la
+        respuesta fue buena registra la latencia hasta ese momento (un 429 o
+        un 5xx rápidos no cuentan como latencia sana)."""
+        async with self._condicion:
+            await self._condicion.wait_for(lambda: self.en_vuelo < int(self.limite))
+            self.en_vuelo += 1
+        inicio = time.perf_counter()
+        registrada = False
+
+        def sano():
+            nonlocal registrada
+            if not registrada:
+                registrada = True
+                self._registrar_latencia(time.perf_counter() - inicio)
+
+        try:
+            yield sano
+        finally:
+            self.en_vuelo -= 1
+            await self._notificar()
+
+    def estado(self) -> dict:
+        return {
+            "limite": int(self.limite),
+            "en_vuelo": self.en_vuelo,
+            "p95_s": round(_p95(self._latencias), 2) if self._latencias else None,
+            "historial": list(self.historial),
+        }
+
+
+_limitadores: Dict[str, AdaptiveLimiter] = {}
+
+
+def limitador_para(url: str) -> AdaptiveLimiter:
+    """Un AdaptiveLimiter por host, compartido por todo el proceso."""
+    host = urlparse(url).netloc or url
+    if host not in _limitadores:
+        _limitadores[host] = AdaptiveLimiter(host)
+    return _limitadores[host]
+
+
+def estado_limitadores() -> dict:
+    return {host: l.estado() for host, l in _limitadores.items()}
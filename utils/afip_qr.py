@@ -0,0 +1,253 @@
+"""
+Lectura local del QR de AFIP para completar y verificar los datos de
+cabecera de la factura sin depender del LLM.
+
+Las facturas electrónicas argentinas llevan (RG 4892) un QR con la URL
+https://www.afip.gob.ar/fe/qr/?p=<base64 de un JSON>, p.ej.:
+
+    {"ver":1,"fecha":"2020-10-13","cuit":30000000007,"ptoVta":10,
+     "tipoCmp":1,"nroCmp":94,"importe":12100,"moneda":"DOL","ctz":65,
+     "tipoDocRec":80,"nroDocRec":20000000001,"tipoCodAut":"E",
+     "codAut":70417054367476}
+
+Antes todo eso salía de datos_del_emisor_y_receptor (LLM), con reintentos
+cuando el CUIT o el número venían mal. Ahora, antes de la extracción:
+
+  1. buscar_qr() intenta leer el QR localmente:
+       - PDF: primero los links del PDF (los facturadores suelen poner la URL
+         del QR como link clickeable sobre la imagen) -- gratis, sin
+         renderizar nada.
+       - Si no hay link (o es una imagen): decodifica el QR de la imagen con
+         zxing-cpp, si está instalado. Sin zxing-cpp ese paso se saltea.
+  2. con_pista_qr() le pasa los datos del QR al prompt de
+     datos_del_emisor_y_receptor, así el modelo los copia en vez de
+     buscarlos.
+  3. aplicar_qr() corrige la salida del modelo con los datos del QR (CUIT
+     del emisor, tipo, subtipo, punto de venta, número, fecha, moneda,
+     CAE) -- el QR es lo que quedó registrado en AFIP -- y devuelve las
+     discrepancias encontradas (incluido el importe total contra la sección
+     de ítems, que NO se pisa) para marcarlas en vez de reintentar a ciegas.
+"""
+
+import base64
+import json
+import logging
+import re
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+try:
+    import zxingcpp
+except ImportError:  # opcional: sin esto solo se leen los QR linkeados en PDFs
+    zxingcpp = None
+
+from utils.render_pool import pool_render
+
+app_logger = logging.getLogger("app_logger")
+
+TOOL_EMISOR_RECEPTOR = "datos_del_emisor_y_receptor"
+DPI_QR = 200
+
+# Código de comprobante AFIP -> (tipo del schema, letra)
+_TIPOS_COMPROBANTE = {
+    1: ("Factura", "A"), 2: ("Nota de Débito", "A"), 3: ("Nota de Crédito", "A"),
+    6: ("Factura", "B"), 7: ("Nota de Débito", "B"), 8: ("Nota de Crédito", "B"),
+    11: ("Factura", "C"), 12: ("Nota de Débito", "C"), 13: ("Nota de Crédito", "C"),
+    51: ("Factura", "M"), 52: ("Nota de Débito", "M"), 53: ("Nota de Crédito", "M"),
+    201: ("Factura", "A"), 202: ("Nota de Débito", "A"), 203: ("Nota de Crédito", "A"),
+    206: ("Factura", "B"), 207: ("Nota de Débito", "B"), 208: ("Nota de Crédito", "B"),
+    211: ("Factura", "C"), 212: ("Nota de Débito", "C"), 213: ("Nota de Crédito", "C"),
+}
+_SUBTIPO_POR_LETRA = {
+    "A": "Para operaciones entre responsables inscriptos",
+    "M": "Para operaciones entre responsables inscriptos",
+    "B": "Para consumidores finales y exentos",
+    "C": "Emitida por monotributistas",
+}
+_MONEDAS = {"PES": "ARS", "DOL": "USD", "060": "EUR", "012": "BRL"}
+
+
+def decodificar_url(url: str) -> Optional[dict]:
+    """Payload JSON de una URL de QR de AFIP, o None si no lo es."""
+    if "afip.gob.ar/fe/qr" not in url:
+        return None
+    try:
+        p = parse_qs(urlparse(url.strip()).query).get("p", [""])[0]
+        p = p.replace(" ", "+")  # el "+" del base64 a veces llega como espacio
+        crudo = base64.urlsafe_b64decode(p.replace("+", "-").replace("/", "_") + "=" * (-len(p) % 4))
+        payload = json.loads(crudo)
+        if not isinstance(payload, dict) or "cuit" not in payload:
+            return None
+        return payload
+    except Exception:
+        return None
+
+
+def _leer_qr_en_imagen(img: Image.Image) -> Optional[dict]:
+    if zxingcpp is None:
+        return None
+    for resultado in zxingcpp.read_barcodes(img):
+        payload = decodificar_url(resultado.text)
+        if payload:
+            return payload
+    return None
+
+
+def qr_de_pagina(page: "fitz.Page", renderizar: bool = False) -> Optional[dict]:
+    """Payload del QR de AFIP de una página de PDF: por link o por la URL en
+    la capa de texto; con renderizar=True (y zxing-cpp), también leyendo la
+    imagen de la página."""
+    for link in page.get_links():
+        payload = decodificar_url(link.get("uri") or "")
+        if payload:
+            return payload
+    url = re.search(r"https?://\S*afip\.gob\.ar/fe/qr/\S+", page.get_text())
+    payload = url and decodificar_url(url.group(0))
+    if payload or not (renderizar and zxingcpp is not None):
+        return payload or None
+    pix = page.get_pixmap(dpi=DPI_QR, colorspace=fitz.csGRAY, alpha=False)
+    # Directo desde los samples, sin encodear/decodificar PNG.
+    img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    return _leer_qr_en_imagen(img)
+
+
+def buscar_qr(file_path: str, media_type: str, process_id: str = "") -> Optional[dict]:
+    """Payload del QR de AFIP del archivo, o None. Nunca tira."""
+    try:
+        if media_type.startswith("image"):
+            with Image.open(file_path) as img:
+                payload = _leer_qr_en_imagen(img)
+        else:
+            payload = None
+            with fitz.open(file_path) as doc:
+                for page in doc:
+                    payload = qr_de_pagina(page)
+                    if payload:
+                        break
+                # El QR va en la primera página; si no estaba linkeado, se
+                # renderiza solo esa (y solo si hay decodificador).
+                if payload is None and len(doc):
+                    payload = qr_de_pagina(doc[0], renderizar=True)
+        if payload:
+            app_logger.info(f"[{process_id}] 🔳 QR AFIP leído localmente: {payload}")
+        return payload
+    except Exception as e:
+        app_logger.warning(f"[{process_id}] 🔳 No se pudo leer el QR AFIP: {e}")
+        return None
+
+
+def _cuit(numero) -> str:
+    digitos = re.sub(r"\D", "", str(numero))
+    if len(digitos) != 11:
+        return digitos
+    return f"{digitos[:2]}-{digitos[2:10]}-{digitos[10]}"
+
+
+def campos_qr(payload: dict) -> dict:
+    """Los datos del QR en los términos del schema de datos_del_emisor_y_receptor
+    (más "total", que se compara contra la sección de ítems)."""
+    campos = {"emisor.id_fiscal": _cuit(payload["cuit"])}
+    tipo = _TIPOS_COMPROBANTE.get(int(payload.get("tipoCmp") or 0))
+    if tipo:
+        campos["comprobante.tipo"] = tipo[0]
+        campos["comprobante.subtipo"] = _SUBTIPO_POR_LETRA[tipo[1]]
+    if payload.get("ptoVta") is not None and payload.get("nroCmp") is not None:
+        pto_vta, nro = int(payload["ptoVta"]), int(payload["nroCmp"])
+        campos["comprobante.punto_de_venta"] = f"{pto_vta:05d}"
+        campos["comprobante.numero"] = f"{pto_vta:05d}-{nro:08d}"
+    if payload.get("fecha"):
+        campos["comprobante.fecha_emision"] = str(payload["fecha"])[:10]
+    if payload.get("moneda"):
+        campos["comprobante.moneda"] = _MONEDAS.get(payload["moneda"], payload["moneda"])
+    if payload.get("codAut") and payload.get("tipoCodAut", "E") == "E":
+        campos["otros.CAE"] = str(payload["codAut"])
+    if payload.get("importe") is not None:
+        campos["total"] = float(payload["importe"])
+    return campos
+
+
+def con_pista_qr(tools_standard: list, payload: Optional[dict]) -> list:
+    """Copia de tools_standard con los datos del QR agregados al prompt de
+    datos_del_emisor_y_receptor (el resto, igual)."""
+    if not payload:
+        return tools_standard
+    datos = "\n".join(
+        f"- {campo}: {valor}" for campo, valor in campos_qr(payload).items() if campo != "total"
+    )
+    pista = (
+        "\n\nDatos ya verificados desde el QR de AFIP del comprobante (usalos tal "
+        f"cual, no hace falta buscarlos en el documento):\n{datos}"
+    )
+    return [
+        {**tool, "prompt": tool["prompt"] + pista}
+        if tool["data"]["function"]["name"] == TOOL_EMISOR_RECEPTOR
+        else tool
+        for tool in tools_standard
+    ]
+
+
+def _mismo_valor(campo: str, modelo, qr) -> bool:
+    if modelo is None:
+        return False
+    if campo in ("emisor.id_fiscal", "otros.CAE", "comprobante.punto_de_venta"):
+        return re.sub(r"\D", "", str(modelo)).lstrip("0") == re.sub(r"\D", "", str(qr)).lstrip("0")
+    if campo == "comprobante.numero":
+        # "0003-00012345", "00012345", "3-12345": se compara el número final.
+        numeros = re.findall(r"\d+", str(modelo))
+        return bool(numeros) and int(numeros[-1]) == int(str(qr).split("-")[-1])
+    return str(modelo).strip().upper() == str(qr).strip().upper()
+
+
+def aplicar_qr(respuestas: list, payload: Optional[dict], process_id: str = "") -> List[str]:
+    """Corrige in-place la salida de datos_del_emisor_y_receptor con los datos
+    del QR y devuelve las discrepancias (texto) que hubo. El total del QR solo
+    se compara contra la sección de ítems, no se pisa."""
+    if not payload:
+        return []
+    campos = campos_qr(payload)
+    discrepancias = []
+    for respuesta in respuestas:
+        for contenido in respuesta.get("content") or []:
+            salida = contenido.get("input")
+            if not isinstance(salida, dict):
+                continue
+            if contenido.get("name") == TOOL_EMISOR_RECEPTOR:
+                for campo, valor in campos.items():
+                    if campo == "total":
+                        continue
+                    seccion, clave = campo.split(".")
+                    destino = salida.setdefault(seccion, {})
+                    actual = destino.get(clave)
+                    if not _mismo_valor(campo, actual, valor):
+                        if actual not in (None, ""):
+                            discrepancias.append(f"{campo}: modelo {actual!r} vs QR {valor!r}")
+                        destino[clave] = valor
+            elif "total" in salida and "total" in campos:
+                total = salida.get("total") or 0
+                if abs(total - campos["total"]) > max(1.0, 0.01 * abs(campos["total"])):
+                    discrepancias.append(f"total: modelo {total} vs QR {campos['total']}")
+    if discrepancias:
+        app_logger.warning(f"[{process_id}] 🔳 Discrepancias con el QR AFIP: {discrepancias}")
+    return discrepancias
+
+
+def resumen_qr(payload: Optional[dict], discrepancias: List[str]) -> Optional[dict]:
+    """Lo que queda en factura["qr_afip"]."""
+    if not payload:
+        return None
+    return {"payload": payload, "discrepancias": discrepancias}
+
+
+async def preparar_qr(item: dict, tools_standard: list) -> Tuple[Optional[dict], list]:
+    """(payload del QR, tools con la pista) para un item de toolchain. La
+    lectura (que puede renderizar la primera página) corre en el pool de
+    render, fuera del event loop (ver utils/render_pool.py)."""
+    process_id = item.get("process_id", "")
+    payload = await pool_render.ejecutar(
+        buscar_qr, item["file_path"], item.get("media_type") or "", process_id,
+        process_id=process_id,
+    )
+    return payload, con_pista_qr(tools_standard, payload)
@@ -0,0 +1,327 @@
+"""
+Carril "bulk": extracción de muchos archivos a través del endpoint de batch
+asíncrono de Gemini (batchGenerateContent), a mitad de precio y sin competir
+con las subidas interactivas por RPM/TPM ni por concurrencia.
+
+Los ZIP de /gemini2/process-invoice y los jobs de email de
+InvoiceOrchestrator.worker no son urgentes, pero pasaban por el mismo camino
+síncrono que una subida desde el dashboard. Con GEMINI_BULK_LANE activado:
+
+  1. InvoiceOrchestrator.precargar_lote(items) arma las 3 requests de
+     extracción de cada archivo (mismo contenido, prompts y tools que
+     run_image_toolchain / run_pdf_toolchain) y las va sumando a un
+     LoteEnArmado, de a un archivo: cada batch de hasta BULK_MAX_MB se manda
+     apenas se llena, y el contenido de sus archivos se suelta al mandarlo.
+     En memoria hay a lo sumo un batch en armado, no el ZIP entero (el
+     mismo criterio de presupuesto por job que utils/pdf_text.py). Una
+     request que sola pasa BULK_MAX_MB va por el camino síncrono. El worker
+     de email no espera el batch: cada job con carril bulk corre en su
+     propia tarea y el worker sigue con el próximo job, hasta BULK_MAX_JOBS
+     en vuelo (pasado eso no toma más de la cola durable: los jobs quedan
+     ahí, sin lease ni heartbeat).
+  2. ejecutar_lote() hace polling del batch hasta que termina (o hasta
+     BULK_TIMEOUT_MIN; pasado eso lo cancela) y devuelve la salida de cada
+     request, por clave.
+  3. Cada sección se valida como en tool_handler (schema + reparación local
+     + chequeo de consistencia). Los archivos con las 3 secciones bien
+     quedan guardados en utils/extraction_cache.py.
+  4. El procesamiento de siempre (Sheets, PocketBase, BAS, Drive, email)
+     corre después archivo por archivo y encuentra la extracción en el
+     cache; el que no esté (batch caído, sección inválida) se extrae por el
+     camino síncrono normal. O sea: el carril bulk solo puede ahorrar, nunca
+     perder una factura.
+
+Para probarlo offline hay un servidor local que imita el endpoint de batch:
+scripts/batch_standin_server.py (apuntar GEMINI_BATCH_BASE_URL ahí).
+
+Configuración por variables de entorno (opcionales):
+    GEMINI_BULK_LANE          (default false) activa el carril bulk
+    GEMINI_BATCH_BASE_URL     (default https://generativelanguage.googleapis.com/v1beta)
+    BULK_POLL_SEGUNDOS        (default 30) intervalo de polling
+    BULK_TIMEOUT_MIN          (default 60) espera máxima por batch
+    BULK_MAX_MB               (default 15) tamaño máximo de cada batch
+                              (las requests van inline, el tope del
+                              proveedor es 20MB)
+    BULK_MAX_JOBS             (default 4) jobs de email esperando su batch a
+                              la vez
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from utils.http_session import SharedHttpSession
+from utils.retry_policy import politica_llm
+
+app_logger = logging.getLogger("app_logger")
+
+BULK_LANE_ACTIVO = os.getenv("GEMINI_BULK_LANE", "false").lower() in ("1", "true")
+BATCH_BASE_URL = os.getenv(
+    "GEMINI_BATCH_BASE_URL", "https://generativelanguage.googleapis.com/v1beta"
+).rstrip("/")
+POLL_SEGUNDOS = float(os.getenv("BULK_POLL_SEGUNDOS", "30"))
+TIMEOUT_SEGUNDOS = float(os.getenv("BULK_TIMEOUT_MIN", "60")) * 60
+MAX_BYTES_BATCH = int(float(os.getenv("BULK_MAX_MB", "15")) * 1024 * 1024)
+MAX_JOBS = max(int(os.getenv("BULK_MAX_JOBS", "4")), 1)
+
+# El proveedor a veces devuelve los estados como BATCH_STATE_* y a veces como
+# JOB_STATE_* -- se compara solo el sufijo.
+_ESTADOS_FINALES = ("SUCCEEDED", "FAILED", "CANCELLED", "EXPIRED")
+
+
+def _parte_nativa(parte: dict) -> dict:
+    """Parte de un mensaje OpenAI-compat (lo que arman los toolchains) ->
+    parte de la API nativa de Gemini."""
+    if parte.get("type") == "image_url":
+        url = parte["image_url"]["url"]
+        cabecera, datos = url.split(",", 1)
+        mime_type = cabecera[len("data:"):].split(";")[0]
+        return {"inline_data": {"mime_type": mime_type, "data": datos}}
+    return {"text": parte.get("text", "")}
+
+
+def armar_request_nativa(tools: list, tool_name: str, contenido: list) -> dict:
+    """GenerateContentRequest equivalente a la request de tool_handler:
+    mismas tools (el JSON Schema va tal cual en parametersJsonSchema) y
+    llamada forzada a `tool_name`."""
+    return {
+        "contents": [
+            {"role": "user", "parts": [_parte_nativa(p) for p in contenido]}
+        ],
+        "tools": [
+            {
+                "functionDeclarations": [
+                    {
+                        "name": tool["function"]["name"],
+                        "description": tool["function"].get("description", ""),
+                        "parametersJsonSchema": tool["function"]["parameters"],
+                    }
+                    for tool in tools
+                ]
+            }
+        ],
+        "toolConfig": {
+            "functionCallingConfig": {
+                "mode": "ANY",
+                "allowedFunctionNames": [tool_name],
+            }
+        },
+    }
+
+
+def _salida_de_respuesta(respuesta: dict) -> Optional[dict]:
+    """GenerateContentResponse -> {"name", "input", "usage"} de la llamada a
+    la función, o None si el modelo no llamó a ninguna."""
+    for candidato in respuesta.get("candidates") or []:
+        for parte in (candidato.get("content") or {}).get("parts") or []:
+            llamada = parte.get("functionCall")
+            if llamada:
+                uso = respuesta.get("usageMetadata") or {}
+                return {
+                    "name": llamada.get("name"),
+                    "input": llamada.get("args") or {},
+                    "usage": {
+                        "input_tokens": uso.get("promptTokenCount", 0),
+                        "cache_creation_input_tokens": 0,
+                        "cache_read_input_tokens": 0,
+                        "output_tokens": uso.get("candidatesTokenCount", 0),
+                        "service_tier": "batch",
+                    },
+                }
+    return None
+
+
+def _respuestas_inline(operacion: dict) -> list:
+    """Lista de {"metadata": {"key"}, "response" | "error"} de un batch
+    terminado -- viene en response o en metadata.output según la versión."""
+    for contenedor in (
+        operacion.get("response") or {},
+        (operacion.get("metadata") or {}).get("output") or {},
+    ):
+        inline = contenedor.get("inlinedResponses")
+        if isinstance(inline, dict):
+            inline = inline.get("inlinedResponses")
+        if inline:
+            return inline
+    return []
+
+
+class GeminiBatchClient:
+    def __init__(self, api_key: str, base_url: str = None):
+        self.api_key = api_key
+        self.base_url = (base_url or BATCH_BASE_URL).rstrip("/")
+        self._http = SharedHttpSession()
+
+    @property
+    def _headers(self) -> dict:
+        return {"Content-Type": "application/json", "x-goog-api-key": self.api_key or ""}
+
+    async def _crear(self, model: str, requests: Dict[str, dict], nombre: str) -> str:
+        session = await self._http.get()
+        operacion = await politica_llm.post_json(
+            session,
+            f"{self.base_url}/models/{model}:batchGenerateContent",
+            self._headers,
+            {
+                "batch": {
+                    "display_name": nombre,
+                    "input_config": {
+                        "requests": {
+                            "requests": [
+                                {"request": request, "metadata": {"key": clave}}
+                                for clave, request in requests.items()
+                            ]
+                        }
+                    },
+                }
+            },
+            process_id=nombre,
+        )
+        return operacion["name"]
+
+    async def _consultar(self, nombre_batch: str) -> dict:
+        session = await self._http.get()
+        async with session.get(
+            f"{self.base_url}/{nombre_batch}", headers=self._headers
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _cancelar(self, nombre_batch: str) -> None:
+        try:
+            session = await self._http.get()
+            async with session.post(
+                f"{self.base_url}/{nombre_batch}:cancel", headers=self._headers
+            ) as response:
+                app_logger.info(f"📦 Batch {nombre_batch} cancelado ({response.status})")
+        except Exception as e:
+            app_logger.warning(f"📦 No se pudo cancelar el batch {nombre_batch}: {e}")
+
+    async def _esperar(self, nombre_batch: str) -> dict:
+        limite = time.monotonic() + TIMEOUT_SEGUNDOS
+        while True:
+            try:
+                operacion = await self._consultar(nombre_batch)
+                estado = (operacion.get("metadata") or {}).get("state", "")
+                if operacion.get("done") or estado.endswith(_ESTADOS_FINALES):
+                    return operacion
+            except Exception as e:
+                # Un poll fallido no es motivo para abandonar el batch.
+                app_logger.warning(f"📦 Error consultando el batch {nombre_batch}: {e}")
+            if time.monotonic() + POLL_SEGUNDOS > limite:
+                await self._cancelar(nombre_batch)
+                raise TimeoutError(
+                    f"El batch {nombre_batch} no terminó en {TIMEOUT_SEGUNDOS / 60:.0f} min"
+                )
+            await asyncio.sleep(POLL_SEGUNDOS)
+
+    async def _ejecutar_grupo(
+        self, model: str, requests: Dict[str, dict], nombre: str
+    ) -> Dict[str, dict]:
+        claves = set(requests)
+        nombre_batch = await self._crear(model, requests, nombre)
+        # El contenido (páginas en base64) ya está del lado del proveedor: no
+        # se retiene durante el polling, que puede durar BULK_TIMEOUT_MIN.
+        requests.clear()
+        app_logger.info(f"📦 [{nombre}] Batch {nombre_batch} creado con {len(claves)} requests")
+        operacion = await self._esperar(nombre_batch)
+        estado = (operacion.get("metadata") or {}).get("state", "")
+        if operacion.get("error") or estado.endswith(("FAILED", "CANCELLED", "EXPIRED")):
+            raise ValueError(
+                f"El batch {nombre_batch} terminó en {estado or 'error'}: {operacion.get('error')}"
+            )
+
+        salidas = {}
+        for entrada in _respuestas_inline(operacion):
+            clave = (entrada.get("metadata") or {}).get("key")
+            if clave not in claves:
+                continue
+            if entrada.get("error"):
+                app_logger.warning(f"📦 [{nombre}] Request {clave} falló en el batch: {entrada['error']}")
+                continue
+            salida = _salida_de_respuesta(entrada.get("response") or {})
+            if salida is not None:
+                salidas[clave] = salida
+        return salidas
+
+    def lote(self, model: str, nombre: str = "invoicy-bulk") -> "LoteEnArmado":
+        """Un lote para ir armando de a una request (ver LoteEnArmado)."""
+        return LoteEnArmado(self, model, nombre)
+
+    async def ejecutar_lote(
+        self, model: str, requests: Dict[str, dict], nombre: str = "invoicy-bulk"
+    ) -> Dict[str, dict]:
+        """Manda `requests` ({clave: GenerateContentRequest}) por el endpoint
+        de batch y devuelve {clave: {"name", "input", "usage"}} de las que
+        salieron bien. Las que faltan en el resultado (error individual,
+        batch fallido, timeout) quedan para el camino síncrono."""
+        lote = self.lote(model, nombre)
+        for clave, request in requests.items():
+            lote.agregar(clave, request)
+        return await lote.resultados()
+
+
+class LoteEnArmado:
+    """Batches que se arman de a una request: cuando la próxima no entra en
+    el grupo actual sin pasar MAX_BYTES_BATCH, el grupo se manda ya (en su
+    propia tarea) y se arranca otro. Así el caller puede construir el
+    contenido de cada archivo, agregarlo y soltarlo."""
+
+    def __init__(self, cliente: GeminiBatchClient, model: str, nombre: str):
+        self.cliente = cliente
+        self.model = model
+        self.nombre = nombre
+        self.total = 0
+        self._actual: Dict[str, dict] = {}
+        self._tamano = 0
+        self._tareas: List[asyncio.Task] = []
+
+    def agregar(self, clave: str, request: dict) -> bool:
+        """Suma la request al batch en armado. False si sola ya pasa
+        MAX_BYTES_BATCH (el batch la rechazaría entera, con todas las demás
+        del grupo): esa se extrae por el camino síncrono."""
+        peso = len(json.dumps(request))
+        if peso > MAX_BYTES_BATCH:
+            app_logger.info(
+                f"📦 Request {clave} ({peso / 1024 / 1024:.1f}MB) no entra en un batch, va por el camino síncrono"
+            )
+            return False
+        if self._actual and self._tamano + peso > MAX_BYTES_BATCH:
+            self._mandar()
+        self._actual[clave] = request
+        self._tamano += peso
+        self.total += 1
+        return True
+
+    def _mandar(self) -> None:
+        grupo, self._actual, self._tamano = self._actual, {}, 0
+        self._tareas.append(
+            asyncio.create_task(
+                self.cliente._ejecutar_grupo(
+                    self.model, grupo, f"{self.nombre}-{len(self._tareas) + 1}"
+                )
+            )
+        )
+
+    async def resultados(self) -> Dict[str, dict]:
+        """Manda lo que quedó en armado, espera todos los batches y devuelve
+        {clave: {"name", "input", "usage"}} de las requests que salieron bien."""
+        if self._actual:
+            self._mandar()
+        resultados = await asyncio.gather(*self._tareas, return_exceptions=True)
+        salidas = {}
+        for resultado in resultados:
+            if isinstance(resultado, BaseException):
+                app_logger.error(f"📦 [{self.nombre}] Batch fallido, esas requests van por el camino síncrono: {resultado}")
+                continue
+            salidas.update(resultado)
+        uso = [s["usage"] for s in salidas.values()]
+        app_logger.info(
+            f"📦 [{self.nombre}] {len(salidas)}/{self.total} requests resueltas por batch "
+            f"({len(self._tareas)} batch(es), {sum(u['input_tokens'] for u in uso)} tokens de entrada, "
+            f"{sum(u['output_tokens'] for u in uso)} de salida)"
+        )
+        return salidas
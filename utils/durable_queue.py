@@ -0,0 +1,544 @@
+"""
+Cola de trabajos durable (SQLite en modo WAL) para los workers de los
+orquestadores.
+
+Hasta ahora el trabajo pendiente vivía solo en memoria: task_queue (Claude),
+job_queue (jobs de email) y los asyncio.create_task(_procesar_en_background(...))
+de /gemini2. Un deploy o un OOM kill en el droplet perdía en silencio todas
+las facturas encoladas, y sus archivos quedaban para siempre en ./downloads.
+Acá cada trabajo es una fila que sobrevive al proceso:
+
+    trabajo_id = cola.encolar({"file_path": ..., "process_id": ...})
+
+    trabajo = await cola.tomar()     # lease: queda "en_curso" a nombre de
+    try:                             # este proceso por COLA_VISIBILIDAD_S
+        ...procesar trabajo["payload"]...
+    finally:
+        await cola.confirmar(trabajo)  # ack: "hecho"
+
+  - Lease con timeout de visibilidad: mientras el worker procesa, tomar()
+    deja corriendo un heartbeat que renueva el lease; si el proceso muere o
+    el event loop se cuelga más de COLA_VISIBILIDAD_S, el trabajo vuelve a
+    ser visible y lo toma otro worker.
+  - Contador de intentos: cada tomar() suma uno. Un trabajo que ya agotó
+    COLA_MAX_INTENTOS (p.ej. un PDF que tumba el proceso por OOM cada vez que
+    se lo toma) pasa a "fallido" en vez de hacer caer el proceso en loop.
+  - Recuperación al arrancar: el primer tomar() de cada cola devuelve a
+    "pendiente" los trabajos "en_curso" que dejó un proceso de este host que
+    ya no existe, sin esperar a que venza su lease. En el shutdown,
+    liberar_arriendos() devuelve los del proceso actual sin gastarles un
+    intento (un deploy no es un fallo del trabajo).
+  - Archivos huérfanos: al arrancar se borran los archivos de ./downloads
+    con más de COLA_HUERFANOS_HORAS que ningún trabajo pendiente referencia
+    (restos de trabajos fallidos o de corridas que murieron antes de esta
+    cola).
+
+La entrega es "al menos una vez": un trabajo que se cortó a la mitad se
+vuelve a entregar entero. Para que eso no repita efectos que no son
+idempotentes (filas de Sheets, emails, altas en BAS, webhooks), el worker
+anota lo que ya hizo con anotar(trabajo, clave, valor); el progreso se
+guarda en la fila del trabajo y el próximo tomar() lo devuelve en
+trabajo["progreso"]. Para los pasos de un item, pasos_hechos() y
+anotar_pasos():
+
+    ctx = pasos_hechos(trabajo, "item-1")
+    if not ctx.get("email_enviado"):
+        ctx["email_enviado"] = enviar_email(...)
+        await cola.anotar_pasos(trabajo, "item-1", ctx, ("email_enviado",))
+
+Los archivos de un trabajo viven en ./downloads: para que un redeploy (un
+contenedor nuevo, no solo un restart del proceso) tampoco los pierda, ese
+directorio tiene que ir en un volumen igual que data/.
+
+A diferencia del cache de extracción, encolar() SÍ tira si SQLite falla: un
+trabajo que no se pudo guardar es un trabajo perdido, y el endpoint tiene que
+devolver error en vez de 201. tomar() y confirmar() son best-effort (loguean y
+siguen) para no matar al worker. Del lado del worker (tomar, confirmar,
+devolver, anotar y el heartbeat) SQLite corre en asyncio.to_thread: con la
+base ocupada un connect/UPDATE puede esperar hasta 5s, y no frena el event
+loop mientras tanto.
+
+Configuración por variables de entorno (opcionales):
+    COLA_DURABLE_PATH      (default data/job_queue.sqlite3 -- el directorio
+                           data/ es el volumen persistente, ver Dockerfile)
+    COLA_VISIBILIDAD_S     (default 600) duración del lease; se renueva cada
+                           un tercio mientras el worker sigue vivo
+    COLA_MAX_INTENTOS      (default 3) intentos antes de marcarlo "fallido"
+    COLA_POLL_S            (default 2) cada cuánto un worker ocioso revisa la
+                           cola (trabajos de otro proceso, reintentos diferidos)
+    COLA_RETENCION_HORAS   (default 72) cuánto se guardan los hechos/fallidos
+    COLA_HUERFANOS_HORAS   (default 24) antigüedad mínima de un archivo de
+                           ./downloads sin trabajo para borrarlo. 0 = no borrar
+    COLA_WORKERS           (default 3) consumidores de la cola de archivos de
+                           /gemini2 (ver routes/process_invoice_google_2.py)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+app_logger = logging.getLogger("app_logger")
+
+COLA_PATH = os.getenv("COLA_DURABLE_PATH", "data/job_queue.sqlite3")
+VISIBILIDAD_S = float(os.getenv("COLA_VISIBILIDAD_S", "600"))
+MAX_INTENTOS = max(int(os.getenv("COLA_MAX_INTENTOS", "3")), 1)
+POLL_S = float(os.getenv("COLA_POLL_S", "2"))
+RETENCION_S = float(os.getenv("COLA_RETENCION_HORAS", "72")) * 3600
+HUERFANOS_S = float(os.getenv("COLA_HUERFANOS_HORAS", "24")) * 3600
+WORKERS = max(int(os.getenv("COLA_WORKERS", "3")), 1)
+
+DESCARGAS_DIR = "downloads"
+
+# Dueño de los leases de este proceso: host:pid:token. El token distingue
+# este arranque de uno anterior con el mismo pid (en Docker, uvicorn suele
+# ser siempre el pid 1).
+_HOST = socket.gethostname()
+_DUENO = f"{_HOST}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Colas creadas en este proceso (para liberar_arriendos()).
+_colas = []
+_descargas_revisadas = False
+
+
+def _proceso_vivo(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _dueno_muerto(dueno: Optional[str]) -> bool:
+    """True si el lease es de un proceso de ESTE host que ya no corre (o de
+    un arranque anterior con el mismo pid). Los de otros hosts esperan a que
+    venza el lease."""
+    try:
+        host, pid, _token = (dueno or "").split(":")
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != _HOST or dueno == _DUENO:
+        return False
+    return pid == os.getpid() or not _proceso_vivo(pid)
+
+
+def pasos_hechos(trabajo: dict, clave: str) -> dict:
+    """Copia de lo que una entrega anterior del trabajo anotó para `clave`
+    (ver ColaDurable.anotar_pasos); {} en la primera entrega."""
+    return dict(trabajo.get("progreso", {}).get(clave, {}))
+
+
+def _strings(valor) -> list:
+    if isinstance(valor, str):
+        return [valor]
+    if isinstance(valor, dict):
+        valor = list(valor.values())
+    if isinstance(valor, list):
+        return [s for v in valor for s in _strings(v)]
+    return []
+
+
+class ColaDurable:
+    def __init__(
+        self,
+        nombre: str,
+        path: Optional[str] = None,
+        visibilidad_s: Optional[float] = None,
+        max_intentos: Optional[int] = None,
+    ):
+        self.nombre = nombre
+        self.path = COLA_PATH if path is None else path
+        self.visibilidad_s = VISIBILIDAD_S if visibilidad_s is None else visibilidad_s
+        self.max_intentos = MAX_INTENTOS if max_intentos is None else max_intentos
+        self._inicializado = False
+        self._recuperada = False
+        self._hay_trabajo = asyncio.Event()
+        self._heartbeats = {}
+        # Serializa las escrituras de progreso: el JSON se arma adentro del
+        # lock, así una anotación vieja no pisa una más nueva del mismo
+        # trabajo (los items de un job anotan en paralelo).
+        self._escritura = asyncio.Lock()
+        _colas.append(self)
+
+    def _conectar(self) -> sqlite3.Connection:
+        if not self._inicializado:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # isolation_level=None: las transacciones se abren a mano (BEGIN
+        # IMMEDIATE en _arrendar), el resto es autocommit.
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        if not self._inicializado:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS trabajos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    cola TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    estado TEXT NOT NULL,
+                    intentos INTEGER NOT NULL DEFAULT 0,
+                    visible_desde REAL NOT NULL,
+                    dueno TEXT,
+                    ultimo_error TEXT,
+                    progreso TEXT,
+                    creado_en REAL NOT NULL,
+                    actualizado_en REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS trabajos_cola ON trabajos (cola, estado, visible_desde)"
+            )
+            columnas = {fila[1] for fila in conn.execute("PRAGMA table_info(trabajos)")}
+            if "progreso" not in columnas:  # base creada antes de anotar()
+                conn.execute("ALTER TABLE trabajos ADD COLUMN progreso TEXT")
+            self._inicializado = True
+        return conn
+
+    def encolar(self, payload: dict) -> int:
+        """Guarda el trabajo y despierta a un worker. `payload` tiene que ser
+        serializable a JSON. Tira si no se pudo guardar."""
+        ahora = time.time()
+        conn = self._conectar()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO trabajos (cola, payload, estado, visible_desde, creado_en, actualizado_en) "
+                "VALUES (?, ?, 'pendiente', ?, ?, ?)",
+                (self.nombre, json.dumps(payload, ensure_ascii=False), ahora, ahora, ahora),
+            )
+            trabajo_id = cursor.lastrowid
+        finally:
+            conn.close()
+        app_logger.info(f"📥 Cola {self.nombre}: trabajo {trabajo_id} encolado")
+        self._hay_trabajo.set()
+        return trabajo_id
+
+    def _arrendar(self) -> Optional[dict]:
+        conn = self._conectar()
+        try:
+            while True:
+                ahora = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                fila = conn.execute(
+                    "SELECT id, payload, intentos, estado, progreso FROM trabajos "
+                    "WHERE cola = ? AND estado IN ('pendiente', 'en_curso') AND visible_desde <= ? "
+                    "ORDER BY id LIMIT 1",
+                    (self.nombre, ahora),
+                ).fetchone()
+                if fila is None:
+                    conn.execute("COMMIT")
+                    return None
+                trabajo_id, payload, intentos, estado, progreso = fila
+                if intentos >= self.max_intentos:
+                    # Se lo tomó max_intentos veces y nunca se confirmó: o
+                    # falla siempre, o tumba el proceso. No se reintenta más.
+                    conn.execute(
+                        "UPDATE trabajos SET estado = 'fallido', dueno = NULL, actualizado_en = ?, "
+                        "ultimo_error = COALESCE(ultimo_error, 'sin confirmar tras agotar los intentos') "
+                        "WHERE id = ?",
+                        (ahora, trabajo_id),
+                    )
+                    conn.execute("COMMIT")
+                    app_logger.error(
+                        f"🧱 Cola {self.nombre}: trabajo {trabajo_id} marcado fallido tras "
+                        f"{intentos} intentos: {payload[:300]}"
+                    )
+                    continue
+                conn.execute(
+                    "UPDATE trabajos SET estado = 'en_curso', intentos = ?, visible_desde = ?, "
+                    "dueno = ?, actualizado_en = ? WHERE id = ?",
+                    (intentos + 1, ahora + self.visibilidad_s, _DUENO, ahora, trabajo_id),
+                )
+                conn.execute("COMMIT")
+                if estado == "en_curso":
+                    app_logger.warning(
+                        f"⏰ Cola {self.nombre}: el lease del trabajo {trabajo_id} venció, se retoma"
+                    )
+                return {
+                    "id": trabajo_id,
+                    "payload": json.loads(payload),
+                    "intentos": intentos + 1,
+                    "progreso": json.loads(progreso) if progreso else {},
+                }
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            conn.close()
+
+    async def tomar(self) -> dict:
+        """Espera y arrienda el próximo trabajo visible: {"id", "payload",
+        "intentos", "progreso"}. El lease se renueva solo hasta
+        confirmar()/devolver()."""
+        if not self._recuperada:
+            self._recuperada = True
+            await asyncio.to_thread(self.recuperar)
+        while True:
+            try:
+                trabajo = await asyncio.to_thread(self._arrendar)
+            except Exception as e:
+                app_logger.error(f"Cola {self.nombre}: error tomando trabajo: {e}")
+                trabajo = None
+            if trabajo:
+                self._heartbeats[trabajo["id"]] = asyncio.create_task(self._renovar(trabajo))
+                return trabajo
+            self._hay_trabajo.clear()
+            try:
+                await asyncio.wait_for(self._hay_trabajo.wait(), POLL_S)
+            except asyncio.TimeoutError:
+                pass
+
+    def _actualizar(self, trabajo: dict, sql: str, params: tuple) -> bool:
+        """UPDATE del trabajo solo si el lease sigue siendo nuestro (mismo
+        dueño y mismo intento). False si lo perdimos o si SQLite falló."""
+        try:
+            conn = self._conectar()
+            try:
+                cursor = conn.execute(
+                    f"UPDATE trabajos SET {sql} WHERE id = ? AND dueno = ? AND intentos = ?",
+                    (*params, trabajo["id"], _DUENO, trabajo["intentos"]),
+                )
+                return cursor.rowcount == 1
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.error(f"Cola {self.nombre}: error actualizando trabajo {trabajo['id']}: {e}")
+            return False
+
+    async def _renovar(self, trabajo: dict) -> None:
+        while True:
+            await asyncio.sleep(self.visibilidad_s / 3)
+            if not await asyncio.to_thread(
+                self._actualizar,
+                trabajo,
+                "visible_desde = ?",
+                (time.time() + self.visibilidad_s,),
+            ):
+                app_logger.warning(
+                    f"Cola {self.nombre}: no se pudo renovar el lease del trabajo {trabajo['id']}"
+                )
+                return
+
+    async def anotar(self, trabajo: dict, clave: str, valor) -> bool:
+        """Guarda trabajo["progreso"][clave] = valor (serializable a JSON) en
+        la fila del trabajo, para que una nueva entrega sepa qué ya se hizo.
+        Best-effort: False si el lease ya no es nuestro o si SQLite falló."""
+        progreso = trabajo.setdefault("progreso", {})
+        progreso[clave] = valor
+        async with self._escritura:
+            return await asyncio.to_thread(
+                self._actualizar,
+                trabajo,
+                "progreso = ?",
+                (json.dumps(progreso, ensure_ascii=False),),
+            )
+
+    async def anotar_pasos(self, trabajo: dict, clave: str, ctx: dict, pasos: tuple) -> bool:
+        """anotar() de los `pasos` que ctx ya completó. Lo que falló (False)
+        o no se hizo no se anota: una nueva entrega lo reintenta. Se llama
+        apenas termina cada paso, no al final del item: un restart entre dos
+        pasos no vuelve a hacer el primero."""
+        return await self.anotar(
+            trabajo, clave, {paso: ctx[paso] for paso in pasos if ctx.get(paso)}
+        )
+
+    def _soltar(self, trabajo: dict) -> None:
+        heartbeat = self._heartbeats.pop(trabajo["id"], None)
+        if heartbeat:
+            heartbeat.cancel()
+
+    async def confirmar(self, trabajo: dict) -> None:
+        """Ack: el trabajo terminó (bien o con el error ya notificado)."""
+        self._soltar(trabajo)
+        ahora = time.time()
+        if not await asyncio.to_thread(
+            self._actualizar,
+            trabajo,
+            "estado = 'hecho', dueno = NULL, actualizado_en = ?",
+            (ahora,),
+        ):
+            app_logger.warning(
+                f"Cola {self.nombre}: el trabajo {trabajo['id']} terminó pero su lease ya no era "
+                "de este worker (¿venció y lo tomó otro?)"
+            )
+        await asyncio.to_thread(self._purgar, ahora)
+
+    async def devolver(self, trabajo: dict, error: str, demora_s: Optional[float] = None) -> None:
+        """Nack: el trabajo vuelve a la cola después de `demora_s` (default:
+        backoff de 30s, 60s, 120s...), o queda "fallido" si agotó los
+        intentos."""
+        self._soltar(trabajo)
+        ahora = time.time()
+        if trabajo["intentos"] >= self.max_intentos:
+            estado, visible = "fallido", ahora
+            app_logger.error(f"🧱 Cola {self.nombre}: trabajo {trabajo['id']} fallido: {error}")
+        else:
+            estado = "pendiente"
+            visible = ahora + (30 * 2 ** (trabajo["intentos"] - 1) if demora_s is None else demora_s)
+        await asyncio.to_thread(
+            self._actualizar,
+            trabajo,
+            "estado = ?, visible_desde = ?, dueno = NULL, ultimo_error = ?, actualizado_en = ?",
+            (estado, visible, str(error)[:1000], ahora),
+        )
+
+    def recuperar(self) -> None:
+        """Devuelve a "pendiente" los trabajos en curso de procesos muertos
+        de este host, y limpia ./downloads (una vez por proceso)."""
+        global _descargas_revisadas
+        try:
+            conn = self._conectar()
+            try:
+                filas = conn.execute(
+                    "SELECT id, dueno FROM trabajos WHERE cola = ? AND estado = 'en_curso'",
+                    (self.nombre,),
+                ).fetchall()
+                huerfanos = [trabajo_id for trabajo_id, dueno in filas if _dueno_muerto(dueno)]
+                conn.executemany(
+                    "UPDATE trabajos SET estado = 'pendiente', visible_desde = ?, dueno = NULL "
+                    "WHERE id = ? AND estado = 'en_curso'",
+                    [(time.time(), trabajo_id) for trabajo_id in huerfanos],
+                )
+                pendientes = conn.execute(
+                    "SELECT COUNT(*) FROM trabajos WHERE cola = ? AND estado = 'pendiente'",
+                    (self.nombre,),
+                ).fetchone()[0]
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.error(f"Cola {self.nombre}: error recuperando trabajos: {e}")
+            return
+        if huerfanos or pendientes:
+            app_logger.info(
+                f"♻️ Cola {self.nombre}: {len(huerfanos)} trabajos recuperados de un proceso "
+                f"caído, {pendientes} pendientes en total"
+            )
+        if not _descargas_revisadas:
+            _descargas_revisadas = True
+            limpiar_descargas()
+
+    def liberar(self) -> None:
+        """Devuelve a "pendiente" los trabajos que este proceso tiene en
+        curso, sin contarles el intento (para el shutdown)."""
+        for heartbeat in self._heartbeats.values():
+            heartbeat.cancel()
+        self._heartbeats.clear()
+        try:
+            conn = self._conectar()
+            try:
+                cursor = conn.execute(
+                    "UPDATE trabajos SET estado = 'pendiente', intentos = intentos - 1, "
+                    "visible_desde = ?, dueno = NULL WHERE cola = ? AND dueno = ? AND estado = 'en_curso'",
+                    (time.time(), self.nombre, _DUENO),
+                )
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.error(f"Cola {self.nombre}: error liberando trabajos: {e}")
+            return
+        if cursor.rowcount:
+            app_logger.info(
+                f"Cola {self.nombre}: {cursor.rowcount} trabajos en curso devueltos a la cola"
+            )
+
+    def _purgar(self, ahora: float) -> None:
+        try:
+            conn = self._conectar()
+            try:
+                conn.execute(
+                    "DELETE FROM trabajos WHERE cola = ? AND estado IN ('hecho', 'fallido') "
+                    "AND actualizado_en < ?",
+                    (self.nombre, ahora - RETENCION_S),
+                )
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.warning(f"Cola {self.nombre}: error purgando trabajos viejos: {e}")
+
+    def estado(self) -> dict:
+        """Trabajos por estado y antigüedad del pendiente más viejo, para /queue."""
+        estado = {"pendiente": 0, "en_curso": 0, "hecho": 0, "fallido": 0}
+        try:
+            conn = self._conectar()
+            try:
+                for nombre, cantidad in conn.execute(
+                    "SELECT estado, COUNT(*) FROM trabajos WHERE cola = ? GROUP BY estado",
+                    (self.nombre,),
+                ):
+                    estado[nombre] = cantidad
+                mas_viejo = conn.execute(
+                    "SELECT MIN(creado_en) FROM trabajos WHERE cola = ? AND estado = 'pendiente'",
+                    (self.nombre,),
+                ).fetchone()[0]
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.warning(f"Cola {self.nombre}: error leyendo el estado: {e}")
+            return {"cola": self.nombre, "error": str(e)}
+        return {
+            "cola": self.nombre,
+            **estado,
+            "espera_max_s": round(time.time() - mas_viejo, 1) if mas_viejo else 0.0,
+            "max_intentos": self.max_intentos,
+        }
+
+
+def archivos_en_uso() -> set:
+    """Paths absolutos de todos los strings de los payloads (y del progreso)
+    pendientes o en curso (de todas las colas): los archivos que un trabajo
+    todavía va a leer. El progreso cuenta porque un worker puede anotar ahí
+    archivos nuevos (p.ej. las partes de un PDF dividido)."""
+    if not _colas:
+        return set()
+    conn = _colas[0]._conectar()
+    try:
+        filas = conn.execute(
+            "SELECT payload, progreso FROM trabajos WHERE estado IN ('pendiente', 'en_curso')"
+        ).fetchall()
+    finally:
+        conn.close()
+    return {
+        os.path.abspath(s)
+        for fila in filas
+        for columna in fila
+        if columna
+        for s in _strings(json.loads(columna))
+    }
+
+
+def limpiar_descargas(directorio: str = DESCARGAS_DIR) -> None:
+    """Borra los archivos de `directorio` con más de COLA_HUERFANOS_HORAS que
+    ningún trabajo pendiente referencia. Nunca tira."""
+    if HUERFANOS_S <= 0 or not os.path.isdir(directorio):
+        return
+    try:
+        en_uso = archivos_en_uso()
+        limite = time.time() - HUERFANOS_S
+        borrados = 0
+        for path in sorted(Path(directorio).rglob("*"), reverse=True):
+            if path.is_dir():
+                if not any(path.iterdir()):
+                    path.rmdir()
+                continue
+            if os.path.abspath(path) in en_uso or path.stat().st_mtime > limite:
+                continue
+            path.unlink()
+            borrados += 1
+    except Exception as e:
+        app_logger.warning(f"No se pudo limpiar {directorio}: {e}")
+        return
+    if borrados:
+        app_logger.info(f"🧹 {borrados} archivos huérfanos borrados de {directorio}")
+
+
+def liberar_arriendos() -> None:
+    """liberar() de todas las colas del proceso. Para el shutdown de la app."""
+    for cola in _colas:
+        cola.liberar()
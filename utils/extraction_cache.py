@@ -0,0 +1,268 @@
+"""
+Cache persistente (SQLite) de resultados de extracción, direccionado por
+contenido.
+
+El mismo archivo nos llega más de una vez: mails de recordatorio que lo
+reenvían, doble submit desde el dashboard, /invoices/{process_id}/retry-extraction
+después de un error de BAS/Sheets, ZIPs que se pisan. Cada vez era una corrida
+completa contra el LLM. Acá se guarda la salida YA FORMATEADA de
+formatear_factura()["data"] ({emisor_receptor, items, impuestos}) bajo la
+clave:
+
+    sha256(bytes del archivo) + modelos de la cascada + versión del schema de las tools
+
+Los modelos son la lista entera de la cascada (ver utils/model_cascade.py),
+no solo el primero: cambiar GEMINI_MODEL_CASCADE / CLAUDE_MODEL_CASCADE
+invalida lo extraído con la configuración anterior. La "versión del schema"
+es un hash de las tools tal cual se mandan (prompts, schemas, enum de
+categorías incluido), así que cambiar un prompt o agregar una categoría en
+/category-map invalida solo -- no hay que acordarse de bumpear nada.
+
+Junto con los datos se guardan los CAMPOS_ITEM que la extracción deja en el
+item (QR de AFIP, memoria, páginas omitidas) y que después leen el webhook y
+PocketBase; un hit los restaura con campos_item().
+
+Uso desde un toolchain (ver run_image_toolchain / run_pdf_toolchain):
+
+    clave = extraction_cache.clave(item["file_path"], self.cascada.modelos, tools_standard)
+    async with extraction_cache.reservar(clave) as cacheado:
+        if cacheado is not None:
+            item["data"] = respuestas_desde_cache(cacheado)
+            item.update(campos_item(cacheado))
+            return item
+        ...extracción normal...
+        extraction_cache.guardar(clave, self.formatear_factura(respuestas)["data"], item)
+
+reservar() es además el single-flight: mientras una extracción de esa clave
+está en vuelo, las demás esperan el lock y al entrar encuentran el resultado
+ya guardado (si la primera falló, la siguiente extrae por su cuenta).
+
+Todo es best-effort, mismo criterio que PocketBase: si SQLite falla, se loguea
+y se extrae normalmente -- el cache nunca debe tirar abajo una factura.
+
+Configuración por variables de entorno (opcionales):
+    EXTRACTION_CACHE_PATH       (default data/extraction_cache.sqlite3 -- el
+                                directorio data/ es el volumen persistente,
+                                ver Dockerfile). Vacío = cache deshabilitado.
+    EXTRACTION_CACHE_TTL_HOURS  (default 720 = 30 días)
+    EXTRACTION_CACHE_MAX_MB     (default 100) tope de tamaño; al pasarlo se
+                                desalojan las entradas menos usadas.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, Optional, Union
+
+app_logger = logging.getLogger("app_logger")
+
+CACHE_PATH = os.getenv("EXTRACTION_CACHE_PATH", "data/extraction_cache.sqlite3")
+TTL_SEGUNDOS = float(os.getenv("EXTRACTION_CACHE_TTL_HOURS", "720")) * 3600
+MAX_BYTES = int(float(os.getenv("EXTRACTION_CACHE_MAX_MB", "100")) * 1024 * 1024)
+
+# Versión del FORMATO de lo que se guarda (no del schema de las tools, que
+# entra solo en la clave). Bumpear si cambia la forma de formatear_factura.
+# 2: la clave lleva la cascada entera y se guardan los CAMPOS_ITEM.
+_FORMATO_VERSION = 2
+
+# Lo que la extracción deja en el item además de las respuestas y que leen
+# los pasos de después (webhook, PocketBase): se guarda con la entrada.
+CAMPOS_ITEM = ("qr_afip", "memoria", "paginas_omitidas")
+
+# Sección de formatear_factura -> nombre de la tool que la produce. Igual en
+# los tres orquestadores (tools.py y tools_standard.py usan los mismos nombres).
+TOOL_POR_SECCION = {
+    "emisor_receptor": "datos_del_emisor_y_receptor",
+    "items": "detalle_de_items_facturados",
+    "impuestos": "impuestos_y_retenciones_de_la_factura",
+}
+
+
+def respuestas_desde_cache(datos: dict) -> list:
+    """Reconstruye la lista de respuestas (una por tool, forma de
+    tool_handler) a partir de los datos cacheados, con usage en cero -- así
+    formatear_factura devuelve los mismos datos y 0 tokens consumidos."""
+    return [
+        {
+            "content": [{"name": tool_name, "input": datos[seccion]}],
+            "usage": {
+                "input_tokens": 0,
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": 0,
+                "output_tokens": 0,
+                "service_tier": "standard",
+            },
+        }
+        for seccion, tool_name in TOOL_POR_SECCION.items()
+        if seccion in datos
+    ]
+
+
+def campos_item(datos: dict) -> dict:
+    """Los CAMPOS_ITEM guardados con la entrada (ver guardar()), para
+    item.update() en un hit."""
+    return dict(datos.get("_item") or {})
+
+
+class ExtractionCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl_segundos: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.path = CACHE_PATH if path is None else path
+        self.ttl_segundos = TTL_SEGUNDOS if ttl_segundos is None else ttl_segundos
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self._locks = {}  # clave -> [asyncio.Lock, cantidad de interesados]
+        self._inicializado = False
+
+    @property
+    def habilitado(self) -> bool:
+        return bool(self.path) and self.ttl_segundos > 0
+
+    def _conectar(self) -> sqlite3.Connection:
+        if not self._inicializado:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._inicializado:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS extracciones (
+                    clave TEXT PRIMARY KEY,
+                    datos TEXT NOT NULL,
+                    tamano INTEGER NOT NULL,
+                    creado_en REAL NOT NULL,
+                    usado_en REAL NOT NULL
+                )
+                """
+            )
+            conn.commit()
+            self._inicializado = True
+        return conn
+
+    def clave(
+        self, file_path: str, modelos: Union[str, List[str]], tools: list
+    ) -> Optional[str]:
+        """sha256 del archivo + modelos de la cascada (o uno solo) + hash de
+        las tools. None si el cache está deshabilitado o no se pudo leer el
+        archivo."""
+        if not self.habilitado:
+            return None
+        if not isinstance(modelos, str):
+            modelos = ",".join(modelos)
+        try:
+            h_archivo = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for bloque in iter(lambda: f.read(1024 * 1024), b""):
+                    h_archivo.update(bloque)
+            h_schema = hashlib.sha256(
+                json.dumps(tools, sort_keys=True, ensure_ascii=False).encode()
+            ).hexdigest()[:16]
+            return f"v{_FORMATO_VERSION}:{modelos}:{h_schema}:{h_archivo.hexdigest()}"
+        except Exception as e:
+            app_logger.warning(f"Cache de extracción: no se pudo calcular la clave: {e}")
+            return None
+
+    def obtener(self, clave: Optional[str]) -> Optional[dict]:
+        if not clave:
+            return None
+        try:
+            conn = self._conectar()
+            try:
+                fila = conn.execute(
+                    "SELECT datos, creado_en FROM extracciones WHERE clave = ?",
+                    (clave,),
+                ).fetchone()
+                if fila is None:
+                    return None
+                if time.time() - fila[1] > self.ttl_segundos:
+                    conn.execute("DELETE FROM extracciones WHERE clave = ?", (clave,))
+                    conn.commit()
+                    return None
+                conn.execute(
+                    "UPDATE extracciones SET usado_en = ? WHERE clave = ?",
+                    (time.time(), clave),
+                )
+                conn.commit()
+                return json.loads(fila[0])
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.warning(f"Cache de extracción: error leyendo: {e}")
+            return None
+
+    def guardar(self, clave: Optional[str], datos: dict, item: Optional[dict] = None) -> None:
+        """Guarda la salida de formatear_factura()["data"], y los CAMPOS_ITEM
+        de `item` que estén. Solo tiene sentido con las 3 secciones -- una
+        extracción parcial no se cachea."""
+        if not clave or not all(s in datos for s in TOOL_POR_SECCION):
+            return
+        try:
+            extras = {c: item[c] for c in CAMPOS_ITEM if item and item.get(c) is not None}
+            if extras:
+                datos = {**datos, "_item": extras}
+            serializado = json.dumps(datos, ensure_ascii=False)
+            ahora = time.time()
+            conn = self._conectar()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO extracciones VALUES (?, ?, ?, ?, ?)",
+                    (clave, serializado, len(serializado), ahora, ahora),
+                )
+                self._desalojar(conn, ahora)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.warning(f"Cache de extracción: error guardando: {e}")
+
+    def _desalojar(self, conn: sqlite3.Connection, ahora: float) -> None:
+        """Borra lo vencido y, si aún se pasa de max_bytes, las entradas
+        menos usadas recientemente (LRU por usado_en)."""
+        conn.execute(
+            "DELETE FROM extracciones WHERE creado_en < ?",
+            (ahora - self.ttl_segundos,),
+        )
+        total = conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM extracciones").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for clave, tamano in conn.execute(
+            "SELECT clave, tamano FROM extracciones ORDER BY usado_en ASC"
+        ).fetchall():
+            conn.execute("DELETE FROM extracciones WHERE clave = ?", (clave,))
+            total -= tamano
+            if total <= self.max_bytes:
+                break
+
+    @contextlib.asynccontextmanager
+    async def reservar(self, clave: Optional[str]):
+        """Single-flight por clave: entra de a una extracción por archivo.
+        Devuelve los datos cacheados (hit) o None (hay que extraer)."""
+        if not clave:
+            yield None
+            return
+        entrada = self._locks.setdefault(clave, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                datos = self.obtener(clave)
+                if datos is not None:
+                    app_logger.info(f"♻️ Cache de extracción: hit ({clave[-12:]})")
+                yield datos
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                self._locks.pop(clave, None)
+
+
+# Instancia compartida por los tres orquestadores -- así el single-flight
+# cubre también un mismo archivo que entra por WhatsApp y por el dashboard.
+extraction_cache = ExtractionCache()
@@ -1,37 +1,33 @@
 from typing import Dict, Optional
-import aiohttp
-import certifi
-import asyncio
-import ssl
 
-WAIT_TIMES = [20, 30, 40, 50, 60]
+from utils.http_session import SharedHttpSession
+from utils.rate_budget import presupuesto_para
+from utils.retry_policy import politica_llm
+
+# Sesión compartida por todas las llamadas de utils/ai.py (ver
+# utils/http_session.py). Antes se armaba un connector nuevo por request --
+# y encima con verify_ssl=False pisando el contexto de certifi.
+_http = SharedHttpSession()
 
 
 async def make_api_request(
     url: str, headers: Dict, data: Dict, process_id: str, retries: int = 5
 ) -> Optional[Dict]:
-    """Alternative helper function to make API requests with retries asynchronously."""
-    # Create an SSL context using the certifi CA bundle
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    # Create a connector with the custom SSL context
-    connector = aiohttp.TCPConnector(ssl=ssl_context)
-    connector = aiohttp.TCPConnector(verify_ssl=False)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        for i in range(retries):
-            try:
-                async with session.post(url, headers=headers, json=data) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    elif response.status in [429, 529, 503]:
-                        print(
-                            f"Service unavailable. Waiting {WAIT_TIMES[i]} seconds before retrying..."
-                        )
-                        await asyncio.sleep(WAIT_TIMES[i])
-                    else:
-                        print(f"Error: {response.status} - {await response.text()}")
-                        raise ValueError(
-                            f"Request failed with status {response.status}"
-                        )
-            except aiohttp.ClientError as e:
-                raise ValueError(f"Request error: {str(e)}")
-    raise ValueError("Max retries exceeded.")
+    """Alternative helper function to make API requests with retries asynchronously.
+
+    Misma política que los orquestadores (utils/retry_policy.py): backoff con
+    jitter que respeta Retry-After, deadline y circuit breaker por host --
+    reemplaza las esperas fijas de WAIT_TIMES.
+    """
+    session = await _http.get()
+    # Presupuesto RPM/TPM del proveedor compartido por todo el proceso
+    # (ver utils/rate_budget.py): post_json lo pide antes de cada intento.
+    return await politica_llm.post_json(
+        session,
+        url,
+        headers,
+        data,
+        process_id=process_id,
+        max_intentos=retries,
+        presupuesto=presupuesto_para(url),
+    )
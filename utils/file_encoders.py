@@ -1,7 +1,14 @@
 import base64
+from pathlib import Path
 from typing import Union
 
 
+def file_to_base64(file_path: str) -> str:
+    # Sin el try/except de pdf_to_base64: el caller (toolchains, vía
+    # utils/render_pool.py) maneja el error.
+    return base64.b64encode(Path(file_path).read_bytes()).decode()
+
+
 def pdf_to_base64(file_path: str) -> Union[str, None]:
     try:
         with open(file_path, "rb") as pdf_file:
@@ -0,0 +1,182 @@
+"""
+Subida única del documento al Files API del proveedor, para referenciarlo
+por id en vez de reenviar el base64 en cada request.
+
+El flujo de Claude (routes/process_invoice.py) manda el PDF nativo como
+bloque "document" en base64: el mismo archivo viaja en las 3 requests de
+cada factura y de nuevo en cada reintento (hasta 6 por tool). Con
+LLM_FILE_REFS activado, run_pdf_toolchain lo sube UNA vez con
+referencia() y las 3 tools (y sus reintentos) lo mandan como
+{"type": "file", "file_id": ...}. Al terminar la factura -- bien o mal --
+el archivo se borra.
+
+  - Archivos de menos de FILE_REFS_MIN_KB van inline como siempre: la
+    subida es una vuelta más y no ahorra nada.
+  - Si la subida falla, la factura sigue inline (nunca se pierde por esto).
+    Si una request con referencia falla, pdf_tool_handler vuelve a inline
+    para los reintentos que queden.
+  - Los archivos se suben con prefijo "invoicy-"; limpiar_huerfanos() (en
+    background, la primera vez que se usa referencia() en el proceso) borra
+    los que hayan quedado de un proceso que murió antes de borrarlos.
+
+Los orquestadores Gemini van por el endpoint OpenAI-compat, que solo acepta
+datos inline -- y sus PDFs ya viajan casi siempre como texto (ver
+utils/pdf_text.py) --, así que esto aplica al flujo de Claude.
+
+Para probar offline: scripts/anthropic_files_standin.py (apuntar
+ANTHROPIC_FILES_BASE_URL ahí).
+
+Configuración por variables de entorno (opcionales):
+    LLM_FILE_REFS              (default false) activa la subida única
+    ANTHROPIC_FILES_BASE_URL   (default https://api.anthropic.com/v1)
+    FILE_REFS_MIN_KB           (default 256) tamaño mínimo para subir
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+from utils.http_session import SharedHttpSession
+
+app_logger = logging.getLogger("app_logger")
+
+FILE_REFS_ACTIVO = os.getenv("LLM_FILE_REFS", "false").lower() in ("1", "true")
+FILES_BASE_URL = os.getenv("ANTHROPIC_FILES_BASE_URL", "https://api.anthropic.com/v1").rstrip("/")
+MIN_BYTES = int(float(os.getenv("FILE_REFS_MIN_KB", "256")) * 1024)
+
+FILES_API_BETA = "files-api-2025-04-14"
+PREFIJO = "invoicy-"
+
+
+class AnthropicFiles:
+    def __init__(self, base_url: str = None, activo: bool = None, min_bytes: int = None):
+        self.base_url = (base_url or FILES_BASE_URL).rstrip("/")
+        self.activo = FILE_REFS_ACTIVO if activo is None else activo
+        self.min_bytes = MIN_BYTES if min_bytes is None else min_bytes
+        self._http = SharedHttpSession()
+        self.subidos = 0
+        self.bytes_subidos = 0
+        self._limpieza = None  # tarea de limpiar_huerfanos()
+
+    @property
+    def _headers(self) -> dict:
+        return {
+            "x-api-key": os.getenv("ANTHROPIC_API_KEY") or "",
+            "anthropic-version": "2023-06-01",
+            "anthropic-beta": FILES_API_BETA,
+        }
+
+    async def subir(self, file_path: str, media_type: str, process_id: str = "") -> str:
+        """Sube el archivo y devuelve su file_id."""
+        session = await self._http.get()
+        form = aiohttp.FormData()
+        with open(file_path, "rb") as archivo:
+            form.add_field(
+                "file",
+                archivo,
+                filename=f"{PREFIJO}{process_id or 'doc'}{Path(file_path).suffix}",
+                content_type=media_type,
+            )
+            inicio = time.perf_counter()
+            async with session.post(
+                f"{self.base_url}/files", headers=self._headers, data=form
+            ) as response:
+                response.raise_for_status()
+                subido = await response.json()
+        self.subidos += 1
+        self.bytes_subidos += os.path.getsize(file_path)
+        app_logger.info(
+            f"[{process_id}] 📎 Archivo subido como {subido['id']} "
+            f"({os.path.getsize(file_path) / 1024:.0f}KB, {time.perf_counter() - inicio:.2f}s)"
+        )
+        return subido["id"]
+
+    async def borrar(self, file_id: str, process_id: str = "") -> None:
+        """Best-effort: un archivo que no se pudo borrar lo levanta
+        limpiar_huerfanos() la próxima vez que corra."""
+        try:
+            session = await self._http.get()
+            async with session.delete(
+                f"{self.base_url}/files/{file_id}", headers=self._headers
+            ) as response:
+                if response.status >= 400 and response.status != 404:
+                    raise ValueError(f"status {response.status}")
+        except Exception as e:
+            app_logger.warning(f"[{process_id}] 📎 No se pudo borrar {file_id}: {e}")
+
+    @asynccontextmanager
+    async def referencia(
+        self, file_path: str, media_type: str, process_id: str = ""
+    ) -> AsyncIterator[Optional[str]]:
+        """
+        async with archivos.referencia(path, "application/pdf", pid) as file_id:
+            ...  # file_id None = mandar inline
+
+        Sube el archivo si corresponde y lo borra al salir.
+        """
+        if self.activo and self._limpieza is None:
+            self._limpieza = asyncio.create_task(self.limpiar_huerfanos())
+        file_id = None
+        if self.activo and os.path.getsize(file_path) >= self.min_bytes:
+            try:
+                file_id = await self.subir(file_path, media_type, process_id)
+            except Exception as e:
+                app_logger.warning(f"[{process_id}] 📎 Falló la subida, se manda inline: {e}")
+        try:
+            yield file_id
+        finally:
+            if file_id:
+                await self.borrar(file_id, process_id)
+
+    async def limpiar_huerfanos(self, max_edad_min: float = 60) -> int:
+        """Borra los archivos "invoicy-*" de más de max_edad_min minutos.
+        Devuelve cuántos borró. Nunca tira."""
+        if not self.activo:
+            return 0
+        borrados = 0
+        try:
+            session = await self._http.get()
+            params = {"limit": "100"}
+            ahora = time.time()
+            while True:
+                async with session.get(
+                    f"{self.base_url}/files", headers=self._headers, params=params
+                ) as response:
+                    response.raise_for_status()
+                    pagina = await response.json()
+                for archivo in pagina.get("data") or []:
+                    creado = datetime.fromisoformat(
+                        archivo["created_at"].replace("Z", "+00:00")
+                    ).timestamp()
+                    if (
+                        archivo.get("filename", "").startswith(PREFIJO)
+                        and ahora - creado > max_edad_min * 60
+                    ):
+                        await self.borrar(archivo["id"])
+                        borrados += 1
+                if not pagina.get("has_more"):
+                    break
+                params["after_id"] = pagina["last_id"]
+        except Exception as e:
+            app_logger.warning(f"📎 No se pudieron limpiar archivos huérfanos: {e}")
+        if borrados:
+            app_logger.info(f"📎 {borrados} archivos huérfanos borrados del Files API")
+        return borrados
+
+    def estado(self) -> dict:
+        return {
+            "activo": self.activo,
+            "subidos": self.subidos,
+            "bytes_subidos": self.bytes_subidos,
+        }
+
+
+# Instancia compartida (una sesión HTTP y contadores para todo el proceso).
+archivos_anthropic = AnthropicFiles()
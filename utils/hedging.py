@@ -0,0 +1,192 @@
+"""
+Requests "con cobertura" (hedged requests) para recortar la cola de latencia
+de las llamadas de extracción.
+
+Algunas llamadas a Gemini en tool_handler tardan varias veces la mediana
+para facturas del mismo tamaño, y esa cola es la que termina en los 504 del
+gateway (ver _procesar_en_background en routes/process_invoice_google_2.py).
+Con la cobertura activada:
+
+  - Se lleva, por tool, una ventana de las latencias recientes de las
+    llamadas exitosas: la de UN intento HTTP (la mide post_json, ver
+    utils/retry_policy.py), sin el backoff de los reintentos.
+  - Si una llamada no volvió dentro del p90 de su tool, se dispara una
+    segunda request IDÉNTICA; gana la que termine primero y la otra se
+    cancela. Si la primera en terminar falló, se espera a la otra.
+  - Un tope de coberturas por minuto (compartido por todo el proceso) acota
+    el gasto extra de tokens: pasado el tope, la llamada sigue sola.
+
+Las muestras no pueden salir sesgadas hacia abajo: si el umbral baja, se
+cubre más, y el umbral vuelve a bajar hasta que solo frena el tope por
+minuto. Por eso, cuando hay cobertura, la que gana se registra con el tiempo
+desde que arrancó la ORIGINAL (no desde que arrancó la cobertura), y la
+perdedora cancelada cuenta como mínimo ese mismo tiempo -- la lenta que se
+canceló es justo la muestra de la cola que más importa.
+
+Hasta juntar MIN_MUESTRAS latencias de una tool no se cubre nada (sin p90
+confiable, cubrir sería disparar a ciegas). La segunda request pasa por
+make_api_request como cualquier otra, así que respeta el presupuesto de
+RPM/TPM (utils/rate_budget.py) y el límite de concurrencia
+(utils/adaptive_concurrency.py).
+
+Configuración por variables de entorno (opcionales):
+    LLM_HEDGING               (default false) activa la cobertura
+    LLM_HEDGING_PERCENTIL     (default 0.9) percentil de latencia que dispara
+    LLM_HEDGING_POR_MINUTO    (default 10) tope de coberturas por minuto
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict
+
+app_logger = logging.getLogger("app_logger")
+
+HEDGING_ACTIVO = os.getenv("LLM_HEDGING", "false").lower() in ("1", "true")
+PERCENTIL = float(os.getenv("LLM_HEDGING_PERCENTIL", "0.9"))
+COBERTURAS_POR_MINUTO = int(os.getenv("LLM_HEDGING_POR_MINUTO", "10"))
+
+VENTANA = 100  # latencias recientes por tool
+MIN_MUESTRAS = 20
+
+
+class HedgePolicy:
+    def __init__(
+        self,
+        activa: bool = None,
+        percentil: float = None,
+        por_minuto: int = None,
+    ):
+        self.activa = HEDGING_ACTIVO if activa is None else activa
+        self.percentil = percentil or PERCENTIL
+        self.por_minuto = COBERTURAS_POR_MINUTO if por_minuto is None else por_minuto
+        self._latencias: Dict[str, deque] = {}
+        self._disparadas = deque()  # timestamps de coberturas del último minuto
+        self.coberturas = 0
+        self.ganadas = 0  # coberturas que terminaron antes que la original
+        self.descartadas_por_tope = 0
+
+    def umbral(self, clave: str):
+        """Segundos tras los cuales se cubre una llamada de `clave`, o None
+        si todavía no hay muestras suficientes."""
+        latencias = self._latencias.get(clave)
+        if not latencias or len(latencias) < MIN_MUESTRAS:
+            return None
+        ordenadas = sorted(latencias)
+        return ordenadas[int(self.percentil * (len(ordenadas) - 1))]
+
+    def _registrar(self, clave: str, segundos: float) -> None:
+        self._latencias.setdefault(clave, deque(maxlen=VENTANA)).append(segundos)
+
+    def _hay_cupo(self) -> bool:
+        ahora = time.monotonic()
+        while self._disparadas and ahora - self._disparadas[0] > 60:
+            self._disparadas.popleft()
+        if len(self._disparadas) >= self.por_minuto:
+            return False
+        self._disparadas.append(ahora)
+        return True
+
+    @staticmethod
+    async def _medida(hacer_request: Callable[[Callable[[float], None]], Awaitable]):
+        """(resultado, segundos del intento que respondió). Si hacer_request
+        no llama a medir(), el tiempo total."""
+        inicio = time.perf_counter()
+        medidas = []
+        resultado = await hacer_request(medidas.append)
+        return resultado, medidas[-1] if medidas else time.perf_counter() - inicio
+
+    async def ejecutar(
+        self,
+        clave: str,
+        hacer_request: Callable[[Callable[[float], None]], Awaitable],
+        process_id: str = "",
+    ):
+        """Corre hacer_request(medir) (una fábrica de corutinas: se llama una
+        vez por request; medir(segundos) es para la latencia de un intento,
+        ver post_json) con cobertura si corresponde. `clave` agrupa las
+        latencias -- el nombre de la tool."""
+        if not self.activa:
+            resultado, segundos = await self._medida(hacer_request)
+            self._registrar(clave, segundos)
+            return resultado
+
+        inicio = time.perf_counter()
+        original = asyncio.create_task(self._medida(hacer_request))
+        tareas = {original}
+        try:
+            umbral = self.umbral(clave)
+            if umbral is None:
+                resultado, segundos = await original
+                self._registrar(clave, segundos)
+                return resultado
+
+            hechas, _ = await asyncio.wait({original}, timeout=umbral)
+            sola = bool(hechas) or not self._hay_cupo()
+            if sola:
+                if not hechas:
+                    self.descartadas_por_tope += 1
+                resultado, segundos = await original
+                self._registrar(clave, segundos)
+                return resultado
+
+            self.coberturas += 1
+            app_logger.info(
+                f"[{process_id}] 🪁 '{clave}' sin respuesta tras {umbral:.1f}s (p{int(100 * self.percentil)}), se dispara una request de cobertura"
+            )
+            desfase = time.perf_counter() - inicio
+            cobertura = asyncio.create_task(self._medida(hacer_request))
+            tareas.add(cobertura)
+            pendientes = set(tareas)
+            while pendientes:
+                hechas, pendientes = await asyncio.wait(
+                    pendientes, return_when=asyncio.FIRST_COMPLETED
+                )
+                # Si terminaron las dos en la misma vuelta, se prefiere la
+                # que salió bien.
+                for tarea in sorted(hechas, key=lambda t: t.exception() is not None):
+                    if tarea.exception() is None:
+                        resultado, segundos = tarea.result()
+                        if tarea is cobertura:
+                            self.ganadas += 1
+                            # Desde el arranque de la original, no de la
+                            # cobertura.
+                            segundos += desfase
+                        self._registrar(clave, segundos)
+                        # La perdedora, si sigue en vuelo, se cancela abajo:
+                        # tardó por lo menos lo mismo que la ganadora.
+                        for perdedora in pendientes:
+                            self._registrar(
+                                clave,
+                                max(segundos, time.perf_counter() - inicio)
+                                if perdedora is original
+                                else segundos,
+                            )
+                        return resultado
+            # Fallaron las dos: se propaga el error de la original.
+            return original.result()[0]
+        finally:
+            # La perdedora (o todas, si cancelaron al que llama) se cancela.
+            for tarea in tareas:
+                if not tarea.done():
+                    tarea.cancel()
+
+    def estado(self) -> dict:
+        return {
+            "activa": self.activa,
+            "coberturas": self.coberturas,
+            "ganadas": self.ganadas,
+            "descartadas_por_tope": self.descartadas_por_tope,
+            "umbrales_s": {
+                clave: round(self.umbral(clave), 2)
+                for clave in self._latencias
+                if self.umbral(clave) is not None
+            },
+        }
+
+
+# Instancia compartida por los orquestadores de Gemini (el tope por minuto
+# es de todo el proceso).
+cobertura_llm = HedgePolicy()
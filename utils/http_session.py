@@ -0,0 +1,96 @@
+"""
+Sesión aiohttp compartida y de larga vida para las llamadas a los LLM
+(Gemini / Anthropic).
+
+Antes cada make_api_request() armaba un SSLContext, un TCPConnector y un
+ClientSession nuevos -- con 3 tools por factura (más reintentos) eso era un
+handshake TLS completo contra el endpoint del proveedor en CADA llamada. Acá
+la sesión se crea una sola vez por orquestador (perezosamente, la primera vez
+que se usa, porque tiene que nacer dentro del event loop que la va a usar) y
+se reutiliza: keep-alive, tope de conexiones por host y cache de DNS.
+
+Cierre: cada SharedHttpSession se registra sola en un WeakSet del módulo, así
+app_factory.py / server.py cierran todas juntas en el shutdown de FastAPI
+(cerrar_sesiones_http()) sin tener que conocer cada orquestador.
+
+Configuración por variables de entorno (opcionales):
+    LLM_HTTP_LIMIT_PER_HOST   (default 10) conexiones simultáneas por host
+    LLM_HTTP_KEEPALIVE        (default 60) segundos que se mantiene viva una
+                              conexión ociosa
+    LLM_HTTP_DNS_TTL          (default 300) segundos de cache de DNS
+"""
+
+import logging
+import os
+import ssl
+import weakref
+from typing import Optional
+
+import aiohttp
+import certifi
+
+app_logger = logging.getLogger("app_logger")
+
+LIMITE_CONEXIONES_POR_HOST = int(os.getenv("LLM_HTTP_LIMIT_PER_HOST", "10"))
+KEEPALIVE_SEGUNDOS = float(os.getenv("LLM_HTTP_KEEPALIVE", "60"))
+TTL_DNS_SEGUNDOS = int(os.getenv("LLM_HTTP_DNS_TTL", "300"))
+
+# Todas las sesiones vivas del proceso -- WeakSet para no impedir que un
+# orquestador descartado (tests, scripts) se libere.
+_sesiones = weakref.WeakSet()
+
+
+class SharedHttpSession:
+    """
+    Envoltorio perezoso de un aiohttp.ClientSession pooled.
+
+    Uso:
+        self._http = SharedHttpSession()
+        session = await self._http.get()
+        async with session.post(url, json=data) as response:
+            ...
+
+    get() no hace ningún await antes de asignar la sesión, así que dos
+    corutinas concurrentes nunca crean dos sesiones distintas (no hace falta
+    lock dentro de un mismo event loop).
+    """
+
+    def __init__(
+        self,
+        limit_per_host: Optional[int] = None,
+        keepalive_timeout: Optional[float] = None,
+        ttl_dns_cache: Optional[int] = None,
+    ):
+        self.limit_per_host = limit_per_host or LIMITE_CONEXIONES_POR_HOST
+        self.keepalive_timeout = keepalive_timeout or KEEPALIVE_SEGUNDOS
+        self.ttl_dns_cache = ttl_dns_cache or TTL_DNS_SEGUNDOS
+        self._session: Optional[aiohttp.ClientSession] = None
+        _sesiones.add(self)
+
+    async def get(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            ssl_context = ssl.create_default_context(cafile=certifi.where())
+            connector = aiohttp.TCPConnector(
+                ssl=ssl_context,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.ttl_dns_cache,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+async def cerrar_sesiones_http() -> None:
+    """Cierra todas las sesiones abiertas del proceso. Pensado para el
+    evento "shutdown" de FastAPI (ver app_factory.py / server.py)."""
+    for sesion in list(_sesiones):
+        try:
+            await sesion.close()
+        except Exception as e:
+            app_logger.warning(f"Error cerrando sesión HTTP compartida: {e}")
@@ -0,0 +1,198 @@
+"""
+Preprocesado de fotos y escaneos (imágenes sueltas, no PDFs) antes de
+mandarlos al modelo.
+
+Las fotos de WhatsApp y de la web llegaban tal cual a run_image_toolchain:
+JPEGs de celular de 4000px, con mucho margen de mesa alrededor, varios MB en
+base64 -- y mandados 3 veces, una por tool. Los modelos las reducen del
+lado del proveedor de todas formas (no "ven" más allá de ~1500-2000px), así
+que esos bytes solo sumaban latencia y TPM. preparar_imagen() aplica, en
+orden:
+
+  1. Orientación EXIF: la foto de celular viene "acostada" con un tag de
+     rotación que no todos los modelos respetan.
+  2. Recorte de márgenes de fondo: lo que difiere poco del color de los
+     bordes (mesa, escritorio, blanco del escáner) se recorta, con un
+     margen de seguridad.
+  3. Tickets largos (térmicos): si la imagen es más de
+     IMAGEN_PROPORCION_TICKET veces más alta que ancha, achicarla entera la
+     deja ilegible -- se parte en tramos superpuestos (IMAGEN_SOLAPAMIENTO)
+     que van como imágenes separadas, en orden, con una nota al modelo.
+  4. Reducción a IMAGEN_MAX_LADO px del lado mayor (por tramo).
+  5. Escala de grises opcional y un solo encode (JPEG, o PNG si la original
+     era PNG -- capturas de pantalla).
+
+Si no hizo falta ningún paso se manda el archivo original sin re-encodear.
+Nunca tira: si PIL no puede abrir el archivo se manda el original.
+
+Configuración por variables de entorno (opcionales):
+    IMAGEN_PREPROCESO          (default true) false = archivo tal cual
+    IMAGEN_MAX_LADO            (default 1600) px del lado mayor
+    IMAGEN_RECORTE             (default true) recorte de márgenes
+    IMAGEN_GRISES              (default false) escala de grises
+    IMAGEN_CALIDAD             (default 85) calidad JPEG
+    IMAGEN_PROPORCION_TICKET   (default 3) alto/ancho desde el que se parte
+    IMAGEN_SOLAPAMIENTO        (default 0.15) solapamiento entre tramos
+"""
+
+import base64
+import io
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageChops, ImageOps
+
+app_logger = logging.getLogger("app_logger")
+
+PREPROCESO_ACTIVO = os.getenv("IMAGEN_PREPROCESO", "true").lower() in ("1", "true")
+MAX_LADO = int(os.getenv("IMAGEN_MAX_LADO", "1600"))
+RECORTE_ACTIVO = os.getenv("IMAGEN_RECORTE", "true").lower() in ("1", "true")
+GRISES = os.getenv("IMAGEN_GRISES", "false").lower() in ("1", "true")
+CALIDAD = int(os.getenv("IMAGEN_CALIDAD", "85"))
+PROPORCION_TICKET = float(os.getenv("IMAGEN_PROPORCION_TICKET", "3"))
+SOLAPAMIENTO = float(os.getenv("IMAGEN_SOLAPAMIENTO", "0.15"))
+
+# Alto de cada tramo de un ticket largo, en anchos.
+_PROPORCION_TRAMO = 2
+# Diferencia (0-255) con el color de fondo a partir de la cual un pixel es
+# "contenido", y margen que se deja alrededor al recortar.
+_UMBRAL_FONDO = 40
+_MARGEN_RECORTE = 0.02
+
+
+def recorte_contenido(img: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+    """Caja del contenido sin los márgenes de fondo, o None si no vale la
+    pena recortar (se sacaría poco, o el "contenido" sería un punto)."""
+    # Sobre una miniatura en grises: alcanza para el bbox y es barato.
+    muestra = img.convert("L")
+    muestra.thumbnail((400, 400))
+    ancho, alto = muestra.size
+    borde = [
+        *(muestra.getpixel((x, 0)) for x in range(ancho)),
+        *(muestra.getpixel((x, alto - 1)) for x in range(ancho)),
+        *(muestra.getpixel((0, y)) for y in range(alto)),
+        *(muestra.getpixel((ancho - 1, y)) for y in range(alto)),
+    ]
+    fondo = sorted(borde)[len(borde) // 2]
+    diferencia = ImageChops.difference(muestra, Image.new("L", muestra.size, fondo))
+    caja = diferencia.point(lambda v: 255 if v > _UMBRAL_FONDO else 0).getbbox()
+    if caja is None:
+        return None
+    x0, y0, x1, y1 = caja
+    if (x1 - x0) < 0.2 * ancho or (y1 - y0) < 0.2 * alto:
+        return None
+    if (x1 - x0) * (y1 - y0) > 0.95 * ancho * alto:
+        return None
+    escala = img.width / ancho
+    margen = _MARGEN_RECORTE * max(img.size)
+    return (
+        max(int(x0 * escala - margen), 0),
+        max(int(y0 * escala - margen), 0),
+        min(int(x1 * escala + margen), img.width),
+        min(int(y1 * escala + margen), img.height),
+    )
+
+
+def _tramos(img: Image.Image) -> List[Image.Image]:
+    """La imagen entera, o tramos superpuestos si es un ticket largo."""
+    if img.height <= PROPORCION_TICKET * img.width:
+        return [img]
+    alto_tramo = _PROPORCION_TRAMO * img.width
+    paso = int(alto_tramo * (1 - SOLAPAMIENTO))
+    tramos, y = [], 0
+    while True:
+        fin = min(y + alto_tramo, img.height)
+        tramos.append(img.crop((0, y, img.width, fin)))
+        if fin >= img.height:
+            return tramos
+        y += paso
+
+
+def _encodear(img: Image.Image, png: bool) -> Tuple[str, bytes]:
+    buffer = io.BytesIO()
+    if png:
+        img.save(buffer, format="PNG", optimize=True)
+        return "image/png", buffer.getvalue()
+    if img.mode not in ("L", "RGB"):
+        img = img.convert("RGB")
+    img.save(buffer, format="JPEG", quality=CALIDAD, optimize=True)
+    return "image/jpeg", buffer.getvalue()
+
+
+def preparar_imagen(file_path: str, media_type: str, process_id: str = "") -> List[Tuple[str, str]]:
+    """[(media type, base64)] listos para mandar: uno por tramo (casi
+    siempre uno solo). Pensado para correr en utils/render_pool.py."""
+    original = Path(file_path).read_bytes()
+    sin_cambios = [(media_type, base64.b64encode(original).decode())]
+    if not PREPROCESO_ACTIVO:
+        return sin_cambios
+    try:
+        with Image.open(io.BytesIO(original)) as abierta:
+            pasos = []
+            img = abierta
+            if abierta.getexif().get(0x0112, 1) != 1:  # tag Orientation
+                img = ImageOps.exif_transpose(abierta)
+                pasos.append("exif")
+
+            if RECORTE_ACTIVO:
+                caja = recorte_contenido(img)
+                if caja:
+                    img = img.crop(caja)
+                    pasos.append("recorte")
+            if GRISES and img.mode != "L":
+                img = img.convert("L")
+                pasos.append("grises")
+
+            tramos = _tramos(img)
+            if len(tramos) > 1:
+                pasos.append(f"{len(tramos)} tramos")
+            for i, tramo in enumerate(tramos):
+                if max(tramo.size) > MAX_LADO:
+                    tramo = tramo.copy()
+                    tramo.thumbnail((MAX_LADO, MAX_LADO), Image.LANCZOS)
+                    tramos[i] = tramo
+                    if "reducción" not in pasos:
+                        pasos.append("reducción")
+
+            if not pasos:
+                return sin_cambios
+            png = media_type == "image/png"
+            salida = [
+                (tipo, base64.b64encode(datos).decode())
+                for tipo, datos in (_encodear(tramo, png) for tramo in tramos)
+            ]
+    except Exception as e:
+        app_logger.warning(f"[{process_id}] 🖼️ No se pudo preprocesar la imagen, va la original: {e}")
+        return sin_cambios
+
+    antes = len(sin_cambios[0][1])
+    despues = sum(len(datos) for _, datos in salida)
+    app_logger.info(
+        f"[{process_id}] 🖼️ Imagen preprocesada ({', '.join(pasos)}): "
+        f"{antes / 1024:.0f}KB -> {despues / 1024:.0f}KB en base64"
+    )
+    return salida
+
+
+def nota_tramos(cantidad: int) -> Optional[str]:
+    """Texto para el modelo cuando la imagen va partida en tramos."""
+    if cantidad < 2:
+        return None
+    return (
+        f"(La imagen es un ticket largo partido en {cantidad} partes, en orden de "
+        "arriba hacia abajo, que se superponen: las líneas repetidas en el borde "
+        "entre dos partes son las mismas y se cuentan una sola vez.)"
+    )
+
+
+def mensajes_imagen_openai(imagenes: List[Tuple[str, str]]) -> list:
+    """Partes de "content" (formato OpenAI-compat) para la salida de
+    preparar_imagen, con la nota de tramos si hace falta."""
+    partes = [
+        {"type": "image_url", "image_url": {"url": f"data:{tipo};base64,{datos}"}}
+        for tipo, datos in imagenes
+    ]
+    nota = nota_tramos(len(imagenes))
+    return [{"type": "text", "text": nota}, *partes] if nota else partes
@@ -0,0 +1,78 @@
+"""
+Pico de memoria (RSS) de cada job, para la telemetría de los toolchains.
+
+En el droplet de 960 MB un PDF escaneado de 40 páginas podía mandar el
+proceso a swap o al OOM killer sin que quedara rastro de cuánto pesó cada
+job. MedidorMemoria muestrea el RSS del proceso mientras corre el job (desde
+el event loop: el render va en el pool, así que el loop sigue libre para
+muestrear) y deja el pico en item["memoria"]:
+
+    async with MedidorMemoria() as memoria:
+        ...  # render + extracción
+    item["memoria"] = memoria.resumen(process_id)
+
+El RSS es del proceso entero: con varios jobs a la vez el pico incluye a los
+demás. "delta_mb" (pico - RSS al arrancar el job) es la mejor cota de lo que
+sumó este job.
+
+Configuración por variables de entorno (opcionales):
+    MEMORIA_MUESTREO_MS   (default 100) intervalo de muestreo del RSS
+"""
+
+import asyncio
+import logging
+import os
+import resource
+
+app_logger = logging.getLogger("app_logger")
+
+MUESTREO_S = max(int(os.getenv("MEMORIA_MUESTREO_MS", "100")), 10) / 1000
+
+_PAGINA = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_mb() -> float:
+    """RSS actual del proceso en MB. Fuera de Linux (sin /proc), el pico
+    histórico del proceso (lo único que da getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGINA / 1024 / 1024
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MedidorMemoria:
+    def __init__(self, muestreo_s: float = None):
+        self.muestreo_s = muestreo_s or MUESTREO_S
+        self.inicial_mb = 0.0
+        self.pico_mb = 0.0
+        self._tarea = None
+
+    async def _muestrear(self) -> None:
+        while True:
+            self.pico_mb = max(self.pico_mb, rss_mb())
+            await asyncio.sleep(self.muestreo_s)
+
+    async def __aenter__(self) -> "MedidorMemoria":
+        self.inicial_mb = self.pico_mb = rss_mb()
+        self._tarea = asyncio.create_task(self._muestrear())
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._tarea.cancel()
+        try:
+            await self._tarea
+        except asyncio.CancelledError:
+            pass
+        self.pico_mb = max(self.pico_mb, rss_mb())
+
+    def resumen(self, process_id: str = "", **extra) -> dict:
+        """{"rss_inicial_mb", "pico_rss_mb", "delta_mb", **extra}, logueado."""
+        resumen = {
+            "rss_inicial_mb": round(self.inicial_mb, 1),
+            "pico_rss_mb": round(self.pico_mb, 1),
+            "delta_mb": round(self.pico_mb - self.inicial_mb, 1),
+            **extra,
+        }
+        app_logger.info(f"[{process_id}] 🧠 Memoria del job: {resumen}")
+        return resumen
@@ -0,0 +1,135 @@
+"""
+Cascada de modelos: cada tool arranca con el modelo más barato/rápido y solo
+escala a uno más fuerte cuando ese falla.
+
+Antes todas las facturas iban al mismo modelo (gemini-3.5-flash fijo como
+default de tool_handler; en el flujo de Claude, claude-sonnet-4 con un salto
+fijo a claude-3-7-sonnet a partir del 4to intento). Ahora la lista de modelos
+es configurable por orquestador y una tool escala de nivel -- SOLO esa tool,
+no la factura entera -- cuando:
+
+  - acumula FALLAS_PARA_ESCALAR fallas de validación del schema en el nivel
+    actual, o
+  - pasa el schema pero falla un chequeo local de consistencia
+    (chequear_consistencia(): suma de ítems vs subtotal/total, cantidad x
+    precio unitario vs total de línea, dígito verificador del CUIT). Esto
+    escala de una; en el último nivel la salida se acepta igual (con warning)
+    -- la consistencia no es motivo para tirar la factura.
+
+Cada respuesta lleva "model" y "tier" (nivel en la cascada, 0 = el más
+barato); formatear_factura los junta en factura["modelos"] por sección para
+poder ajustar los umbrales con datos reales.
+
+Configuración por variables de entorno (opcionales):
+    GEMINI_MODEL_CASCADE   lista separada por comas, del más barato al más
+                           fuerte (ej. "gemini-3.5-flash-lite,gemini-3.5-flash,gemini-3.5-pro").
+                           Default: solo el modelo del orquestador.
+    CLAUDE_MODEL_CASCADE   ídem para el flujo de Claude. Default:
+                           "claude-sonnet-4-20250514,claude-3-7-sonnet-20250219"
+                           (el salto que ya existía).
+    LLM_CASCADA_FALLAS     (default 2) fallas de schema antes de escalar
+"""
+
+import os
+import re
+from typing import List, Tuple
+
+FALLAS_PARA_ESCALAR = int(os.getenv("LLM_CASCADA_FALLAS", "2"))
+
+# Tolerancia de los chequeos de montos: el mayor entre 1 peso y el 1%.
+_TOLERANCIA_ABSOLUTA = 1.0
+_TOLERANCIA_RELATIVA = 0.01
+
+
+class ModelCascade:
+    def __init__(self, modelos: List[str], fallas_para_escalar: int = None):
+        if not modelos:
+            raise ValueError("La cascada necesita al menos un modelo")
+        self.modelos = modelos
+        self.fallas_para_escalar = fallas_para_escalar or FALLAS_PARA_ESCALAR
+
+    @property
+    def ultimo_nivel(self) -> int:
+        return len(self.modelos) - 1
+
+    def modelo(self, fallas: int) -> Tuple[int, str]:
+        """(nivel, modelo) que corresponde después de `fallas` fallas."""
+        nivel = min(fallas // self.fallas_para_escalar, self.ultimo_nivel)
+        return nivel, self.modelos[nivel]
+
+    def fallas_para_nivel(self, nivel: int) -> int:
+        """Cantidad de fallas con la que se entra a `nivel` (para escalar de
+        una tras un chequeo de consistencia)."""
+        return nivel * self.fallas_para_escalar
+
+
+def cascada_desde_env(variable: str, por_defecto: List[str]) -> ModelCascade:
+    valor = os.getenv(variable, "")
+    modelos = [m.strip() for m in valor.split(",") if m.strip()] or por_defecto
+    return ModelCascade(modelos)
+
+
+def _cerca(a: float, b: float) -> bool:
+    return abs(a - b) <= max(_TOLERANCIA_ABSOLUTA, _TOLERANCIA_RELATIVA * max(abs(a), abs(b)))
+
+
+def _cuit_valido(cuit: str) -> bool:
+    digitos = [int(c) for c in re.sub(r"\D", "", cuit)]
+    if len(digitos) != 11:
+        return False
+    pesos = [5, 4, 3, 2, 7, 6, 5, 4, 3, 2]
+    resto = 11 - sum(d * p for d, p in zip(digitos, pesos)) % 11
+    verificador = {11: 0, 10: 9}.get(resto, resto)
+    return verificador == digitos[10]
+
+
+def chequear_consistencia(tool_name: str, salida: dict) -> List[str]:
+    """Problemas de consistencia de una salida YA válida contra el schema.
+    Lista vacía = consistente (o tool sin chequeos)."""
+    problemas = []
+    if tool_name == "detalle_de_items_facturados":
+        detalles = salida.get("detalles") or []
+        for i, item in enumerate(detalles):
+            esperado = item.get("cantidad", 0) * item.get("precio_unitario", 0)
+            total_linea = item.get("precio_total", 0)
+            # Las líneas de descuento/bonificación suelen venir sin cantidad
+            # o sin unitario -- solo se chequean las que tienen ambos.
+            if esperado and total_linea and not _cerca(esperado, total_linea):
+                problemas.append(
+                    f"detalles.{i}: cantidad x precio_unitario = {esperado:.2f} != precio_total {total_linea:.2f}"
+                )
+        if detalles:
+            suma = sum(item.get("precio_total", 0) for item in detalles)
+            subtotal = salida.get("subtotal", 0)
+            total = salida.get("total", 0)
+            # Factura B/C: los ítems ya vienen con IVA y suman el total.
+            if not (_cerca(suma, subtotal) or _cerca(suma, total)):
+                problemas.append(
+                    f"suma de ítems {suma:.2f} no coincide con subtotal {subtotal:.2f} ni total {total:.2f}"
+                )
+    elif tool_name == "datos_del_emisor_y_receptor":
+        cuit = (salida.get("emisor") or {}).get("id_fiscal")
+        if cuit and not _cuit_valido(cuit):
+            problemas.append(f"emisor.id_fiscal {cuit!r}: CUIT con dígito verificador inválido")
+    return problemas
+
+
+def modelos_por_seccion(factura_completa: list) -> dict:
+    """{seccion: {"modelo", "nivel"}} a partir de las respuestas de las tools
+    (para formatear_factura). Respuestas sin "model" -- p.ej. reconstruidas
+    desde utils/extraction_cache.py -- quedan como modelo None."""
+    # Import local: extraction_cache no tiene nada que ver con la cascada
+    # salvo por el mapa sección <-> tool, que vive allá.
+    from utils.extraction_cache import TOOL_POR_SECCION
+
+    seccion_por_tool = {tool: seccion for seccion, tool in TOOL_POR_SECCION.items()}
+    modelos = {}
+    for respuesta in factura_completa:
+        for contenido in respuesta.get("content") or []:
+            seccion = seccion_por_tool.get(contenido.get("name"))
+            if seccion:
+                modelos[seccion] = {
+                    "modelo": respuesta.get("model"),
+                    "nivel": respuesta.get("tier"),
+                }
+    return modelos
@@ -0,0 +1,268 @@
+"""
+Índice de casi-duplicados (SQLite) por hash perceptual, para detectar un
+documento que ya se procesó aunque sus bytes sean otros.
+
+El cache de extracción (utils/extraction_cache.py) va por sha256 del archivo:
+dos fotos del mismo ticket, o el mismo PDF re-guardado por otra herramienta
+(otro productor, otra compresión), son archivos distintos y pasan de nuevo
+por el LLM -- y terminan como dos facturas en el dashboard. Acá se guarda,
+por cada documento procesado, una huella barata:
+
+  - dHash de 64 bits de la primera página (PDF) o de la imagen, en grises y
+    con los márgenes de fondo recortados (ver image_prep.recorte_contenido)
+    -- así dos fotos del mismo ticket sobre otra mesa dan hashes cercanos.
+  - Cantidad de páginas y proporción alto/ancho de la primera página.
+  - En PDFs con capa de texto, un hash del texto sin espacios: el dHash
+    de dos facturas del mismo proveedor (misma plantilla, otros números)
+    es casi igual, el texto no. Un PDF re-guardado conserva el texto.
+
+buscar() compara contra los documentos de los últimos DUPLICADOS_VENTANA_DIAS
+con la misma cantidad de páginas y proporción parecida, por distancia de
+Hamming. Un candidato a DUPLICADOS_MAX_DISTANCIA bits o menos es un
+"posible duplicado": queda marcado en la factura de PocketBase
+(posible_duplicado_de / duplicado_distancia -- campos opcionales de
+"invoices") para revisarlo en el dashboard.
+
+Cada documento va con su propio id (id_documento: process_id + nombre del
+archivo), no solo el process_id: los adjuntos de un mismo email comparten
+el process_id del job, y con ese id como clave el segundo pisaba al
+primero, y un duplicado dentro del mismo email no se veía nunca. buscar()
+excluye solo al documento mismo (un reproceso no es duplicado de sí
+mismo). Con DUPLICADOS_REUSAR, además se
+reusa la extracción del documento anterior (si sigue en el cache de
+extracción) en vez de llamar a Gemini -- opt-in: un casi-duplicado puede ser
+otra factura del mismo proveedor con el mismo layout y casi ningún número
+distinto.
+
+Mismo criterio best-effort que el cache de extracción: si SQLite o la
+huella fallan, se loguea y se extrae normalmente.
+
+Configuración por variables de entorno (opcionales):
+    DUPLICADOS_PATH           (default data/near_duplicates.sqlite3). Vacío
+                              = índice deshabilitado.
+    DUPLICADOS_VENTANA_DIAS   (default 30) antigüedad máxima de los candidatos
+    DUPLICADOS_MAX_DISTANCIA  (default 8) bits distintos (de 64) para
+                              considerarlo casi-duplicado
+    DUPLICADOS_REUSAR         (default false) reusar la extracción anterior
+"""
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageOps
+
+from utils.image_prep import recorte_contenido
+
+app_logger = logging.getLogger("app_logger")
+
+INDICE_PATH = os.getenv("DUPLICADOS_PATH", "data/near_duplicates.sqlite3")
+VENTANA_SEGUNDOS = float(os.getenv("DUPLICADOS_VENTANA_DIAS", "30")) * 86400
+MAX_DISTANCIA = int(os.getenv("DUPLICADOS_MAX_DISTANCIA", "8"))
+REUSAR = os.getenv("DUPLICADOS_REUSAR", "false").lower() in ("1", "true")
+
+# Diferencia relativa máxima de proporción alto/ancho entre candidatos.
+_TOLERANCIA_PROPORCION = 0.1
+# Resolución a la que se renderiza la primera página para la huella: el
+# dHash se calcula sobre 9x8 px, no hace falta más.
+_DPI_HUELLA = 36
+# Caracteres (sin espacios) mínimos para que el hash del texto cuente.
+_MIN_TEXTO = 50
+
+
+def dhash(img: Image.Image) -> int:
+    """dHash de 64 bits: cada bit dice si un pixel es más claro que su
+    vecino de la derecha, en la imagen reducida a 9x8 en grises."""
+    chica = img.convert("L").resize((9, 8), Image.LANCZOS)
+    pixeles = list(chica.getdata())
+    valor = 0
+    for fila in range(8):
+        for col in range(8):
+            valor = (valor << 1) | (pixeles[fila * 9 + col] > pixeles[fila * 9 + col + 1])
+    return valor
+
+
+def huella(file_path: str, media_type: str, process_id: str = "") -> Optional[dict]:
+    """{"dhash", "paginas", "proporcion", "texto"} del documento ("texto" =
+    hash del texto del PDF, o None), o None si no se pudo calcular. Nunca
+    tira. Pensado para correr en utils/render_pool.py."""
+    texto = None
+    try:
+        if media_type.startswith("image"):
+            with Image.open(file_path) as abierta:
+                img = ImageOps.exif_transpose(abierta).convert("L")
+            paginas = 1
+        else:
+            with fitz.open(file_path) as doc:
+                paginas = doc.page_count
+                crudo = re.sub(r"\s+", "", "".join(page.get_text() for page in doc))
+                if len(crudo) >= _MIN_TEXTO:
+                    texto = hashlib.sha256(crudo.encode()).hexdigest()[:16]
+                pix = doc[0].get_pixmap(dpi=_DPI_HUELLA, colorspace=fitz.csGRAY, alpha=False)
+                img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+        caja = recorte_contenido(img)
+        if caja:
+            img = img.crop(caja)
+        return {
+            "dhash": dhash(img),
+            "paginas": paginas,
+            "proporcion": round(img.height / max(img.width, 1), 3),
+            "texto": texto,
+        }
+    except Exception as e:
+        app_logger.warning(f"[{process_id}] 👯 No se pudo calcular la huella: {e}")
+        return None
+
+
+def _con_signo(valor: int) -> int:
+    # SQLite guarda enteros de 64 bits CON signo.
+    return valor - (1 << 64) if valor >= 1 << 63 else valor
+
+
+def id_documento(process_id: str, file_name: str) -> str:
+    """Id de un documento en el índice: los adjuntos de un email comparten
+    el process_id del job, el nombre del archivo los distingue."""
+    return f"{process_id}/{file_name}"
+
+
+def campos_pocketbase(sospecha: Optional[dict]) -> dict:
+    """Campos de "invoices" para marcar un posible duplicado ({} si no hay)."""
+    if not sospecha:
+        return {}
+    return {
+        "posible_duplicado_de": sospecha["documento"],
+        "duplicado_distancia": sospecha["distancia"],
+    }
+
+
+class IndiceDuplicados:
+    def __init__(self, path: Optional[str] = None, ventana_segundos: Optional[float] = None):
+        self.path = INDICE_PATH if path is None else path
+        self.ventana_segundos = VENTANA_SEGUNDOS if ventana_segundos is None else ventana_segundos
+        self.max_distancia = MAX_DISTANCIA
+        self.reusar = REUSAR
+        self._inicializado = False
+
+    @property
+    def habilitado(self) -> bool:
+        return bool(self.path) and self.ventana_segundos > 0
+
+    def _conectar(self) -> sqlite3.Connection:
+        if not self._inicializado:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._inicializado:
+            conn.execute("PRAGMA journal_mode=WAL")
+            columnas = {fila[1] for fila in conn.execute("PRAGMA table_info(documentos)")}
+            if columnas and "documento" not in columnas:
+                # Índice de antes de id_documento (clave = process_id). Son
+                # huellas de DUPLICADOS_VENTANA_DIAS, se vuelve a llenar solo.
+                conn.execute("DROP TABLE documentos")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documentos (
+                    documento TEXT PRIMARY KEY,
+                    process_id TEXT NOT NULL,
+                    dhash INTEGER NOT NULL,
+                    paginas INTEGER NOT NULL,
+                    proporcion REAL NOT NULL,
+                    texto TEXT,
+                    clave_cache TEXT,
+                    creado_en REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS documentos_paginas ON documentos (paginas, creado_en)"
+            )
+            conn.commit()
+            self._inicializado = True
+        return conn
+
+    def buscar(self, huella: Optional[dict], documento: str, process_id: str = "") -> Optional[dict]:
+        """El documento reciente más parecido a `huella` dentro del umbral,
+        sin contar a `documento` (ver id_documento):
+        {"documento", "process_id", "distancia", "clave_cache"}, o None."""
+        if not (huella and self.habilitado):
+            return None
+        try:
+            conn = self._conectar()
+            try:
+                filas = conn.execute(
+                    "SELECT documento, process_id, dhash, proporcion, texto, clave_cache FROM documentos "
+                    "WHERE paginas = ? AND creado_en >= ? AND documento != ?",
+                    (huella["paginas"], time.time() - self.ventana_segundos, documento),
+                ).fetchall()
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.warning(f"[{process_id}] 👯 Índice de duplicados: error leyendo: {e}")
+            return None
+        mejor = None
+        for otro_documento, otro_id, otro_hash, proporcion, texto, clave_cache in filas:
+            if abs(proporcion - huella["proporcion"]) > _TOLERANCIA_PROPORCION * huella["proporcion"]:
+                continue
+            if texto and huella.get("texto") and texto != huella["texto"]:
+                continue
+            distancia = bin((otro_hash ^ _con_signo(huella["dhash"])) & ((1 << 64) - 1)).count("1")
+            if distancia <= self.max_distancia and (mejor is None or distancia < mejor["distancia"]):
+                mejor = {
+                    "documento": otro_documento,
+                    "process_id": otro_id,
+                    "distancia": distancia,
+                    "clave_cache": clave_cache,
+                }
+        if mejor:
+            app_logger.info(
+                f"[{process_id}] 👯 {documento}: posible duplicado de {mejor['documento']} "
+                f"(distancia {mejor['distancia']}/64)"
+            )
+        return mejor
+
+    def registrar(
+        self,
+        huella: Optional[dict],
+        documento: str,
+        process_id: str,
+        clave_cache: Optional[str] = None,
+    ) -> None:
+        """Agrega (o pisa, si se reprocesa el mismo documento) el documento
+        al índice y borra lo que salió de la ventana."""
+        if not (huella and self.habilitado and documento):
+            return
+        try:
+            ahora = time.time()
+            conn = self._conectar()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO documentos VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        documento,
+                        process_id,
+                        _con_signo(huella["dhash"]),
+                        huella["paginas"],
+                        huella["proporcion"],
+                        huella.get("texto"),
+                        clave_cache,
+                        ahora,
+                    ),
+                )
+                conn.execute(
+                    "DELETE FROM documentos WHERE creado_en < ?",
+                    (ahora - self.ventana_segundos,),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            app_logger.warning(f"[{process_id}] 👯 Índice de duplicados: error guardando: {e}")
+
+
+# Instancia compartida (mismo archivo SQLite para todo el proceso).
+indice_duplicados = IndiceDuplicados()
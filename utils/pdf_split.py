@@ -0,0 +1,157 @@
+"""
+División de PDFs que traen varias facturas (p.ej. el escaneo mensual de
+contaduría, o un proveedor que manda todas las facturas del mes en un solo
+archivo) en un PDF por factura.
+
+Hasta ahora ese PDF entraba entero como UNA factura: el modelo mezclaba los
+ítems de todas y la cabecera salía de la primera. detectar_facturas() busca
+los límites localmente, sin LLM, con señales por página:
+
+  - Identidad del comprobante: el número (punto de venta + número, p.ej.
+    "Punto de Venta: 0003  Comp. Nro: 00012345" o "Nro 0003-00012345") y el
+    CAE de la capa de texto, o los del QR de AFIP de la página (link, URL en
+    el texto, o la imagen si hay zxing-cpp -- ver utils/afip_qr.py).
+  - Marca de primera página ("Página 1 de 3", "Hoja 1/2").
+
+Una página empieza una factura nueva si su identidad choca con la de la
+factura en curso (algún dato presente en las dos difiere), o si es una
+"página 1" que trae datos que la factura en curso no tenía. Las páginas sin
+señales (continuación de ítems, escaneos sin QR legible) quedan con la
+anterior -- ante la duda no se parte, que es el comportamiento de siempre.
+Las copias ORIGINAL/DUPLICADO de un mismo comprobante tienen la misma
+identidad y quedan juntas.
+
+partir_pdf() escribe un PDF por rango al lado del original; el orquestador
+los procesa como facturas separadas (ver _procesar_en_background en
+routes/process_invoice_google_2.py).
+
+Configuración por variables de entorno (opcionales):
+    PDF_DIVISION               (default true) false = nunca partir
+    PDF_DIVISION_MAX           (default 20) facturas máximas por PDF; con
+                               más, no se parte (mismo tope que los ZIP)
+    PDF_DIVISION_CONCURRENCIA  (default 2) facturas de un mismo PDF que se
+                               procesan a la vez
+"""
+
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import fitz  # PyMuPDF
+
+from utils.afip_qr import qr_de_pagina
+
+app_logger = logging.getLogger("app_logger")
+
+DIVISION_ACTIVA = os.getenv("PDF_DIVISION", "true").lower() in ("1", "true")
+MAX_FACTURAS = int(os.getenv("PDF_DIVISION_MAX", "20"))
+CONCURRENCIA = max(int(os.getenv("PDF_DIVISION_CONCURRENCIA", "2")), 1)
+
+_NUMERO = [
+    # Plantilla de AFIP: "Punto de Venta: 00003 Comp. Nro: 00012345"
+    re.compile(
+        r"punto\s+de\s+venta\s*:?\s*(\d{1,5})\s+comp(?:robante)?\.?\s*n(?:ro|[°º])\.?\s*:?\s*(\d{1,8})",
+        re.I,
+    ),
+    # "Nro 0003-00012345", "N° 00003-00012345"
+    re.compile(r"\bn(?:ro|[°ºo])\.?\s*:?\s*(\d{4,5})\s*-\s*(\d{8})\b", re.I),
+]
+_CAE = re.compile(r"\bc\.?a\.?e\.?\s*(?:n(?:ro|[°º])\.?)?\s*:?\s*(\d{14})\b", re.I)
+_PRIMERA_PAGINA = re.compile(r"\b(?:p[áa]g(?:ina)?|hoja)\.?\s*:?\s*0*1\s*(?:de|/)\s*\d+", re.I)
+
+
+def identidad_pagina(page: "fitz.Page") -> Dict[str, str]:
+    """{"numero": "3-12345", "cae": "..."} con lo que se encuentre en la
+    página (puede ser vacío)."""
+    identidad = {}
+    texto = page.get_text()
+    # Sin capa de texto, el QR renderizado es la única señal posible.
+    qr = qr_de_pagina(page, renderizar=not texto.strip())
+    if qr:
+        if qr.get("ptoVta") is not None and qr.get("nroCmp") is not None:
+            identidad["numero"] = f"{int(qr['ptoVta'])}-{int(qr['nroCmp'])}"
+        if qr.get("codAut"):
+            identidad["cae"] = str(qr["codAut"])
+    for patron in _NUMERO:
+        encontrado = patron.search(texto)
+        if encontrado and "numero" not in identidad:
+            identidad["numero"] = f"{int(encontrado.group(1))}-{int(encontrado.group(2))}"
+    cae = _CAE.search(texto)
+    if cae and "cae" not in identidad:
+        identidad["cae"] = cae.group(1)
+    return identidad
+
+
+def _choca(a: Dict[str, str], b: Dict[str, str]) -> bool:
+    return any(a[clave] != b[clave] for clave in a.keys() & b.keys())
+
+
+def detectar_facturas(file_path: str, process_id: str = "") -> List[range]:
+    """Rangos de páginas (0-based) de cada factura del PDF, o [] si es una
+    sola (o no se pudo decidir). Nunca tira."""
+    if not DIVISION_ACTIVA:
+        return []
+    try:
+        with fitz.open(file_path) as doc:
+            if doc.page_count < 2:
+                return []
+            inicios, actual = [0], {}
+            for n, page in enumerate(doc):
+                identidad = identidad_pagina(page)
+                # Una "página 1" con datos que la factura en curso no tenía
+                # es otra factura aunque no choque (p.ej. una con solo CAE
+                # seguida de otra con solo número).
+                nueva = (
+                    actual
+                    and _PRIMERA_PAGINA.search(page.get_text())
+                    and not identidad.items() <= actual.items()
+                )
+                if n and (_choca(actual, identidad) or nueva):
+                    inicios.append(n)
+                    actual = {}
+                actual.update(identidad)
+            total = doc.page_count
+    except Exception as e:
+        app_logger.warning(f"[{process_id}] ✂️ No se pudo analizar el PDF para dividirlo: {e}")
+        return []
+    if len(inicios) < 2:
+        return []
+    if len(inicios) > MAX_FACTURAS:
+        app_logger.warning(
+            f"[{process_id}] ✂️ El PDF parece tener {len(inicios)} facturas (máximo "
+            f"{MAX_FACTURAS}): se procesa entero"
+        )
+        return []
+    rangos = [range(a, b) for a, b in zip(inicios, inicios[1:] + [total])]
+    app_logger.info(
+        f"[{process_id}] ✂️ PDF de {total} páginas con {len(rangos)} facturas: "
+        f"{', '.join(f'{r.start + 1}-{r.stop}' for r in rangos)}"
+    )
+    return rangos
+
+
+def partir_pdf(file_path: str, rangos: List[range]) -> List[str]:
+    """Escribe un PDF por rango al lado del original ("<nombre>-factura<n>.pdf")
+    y devuelve sus paths, en orden."""
+    origen = Path(file_path)
+    paths = []
+    with fitz.open(file_path) as doc:
+        for n, rango in enumerate(rangos, 1):
+            destino = origen.with_name(f"{origen.stem}-factura{n}{origen.suffix}")
+            with fitz.open() as parte:
+                parte.insert_pdf(doc, from_page=rango.start, to_page=rango.stop - 1)
+                parte.save(destino, garbage=3, deflate=True)
+            paths.append(str(destino))
+    return paths
+
+
+def dividir_pdf(file_path: str, process_id: str = "") -> Optional[List[str]]:
+    """detectar_facturas + partir_pdf: los paths de los PDFs por factura, o
+    None si el PDF es una sola factura. Pensado para correr en
+    utils/render_pool.py."""
+    rangos = detectar_facturas(file_path, process_id)
+    if not rangos:
+        return None
+    return partir_pdf(file_path, rangos)
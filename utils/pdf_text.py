@@ -0,0 +1,330 @@
+"""
+Camino rápido para PDFs con capa de texto: en vez de rasterizar cada página
+a 150 DPI y mandar PNGs al modelo de visión, se manda el texto de la página
+con el layout reconstruido.
+
+La mayoría de las facturas de proveedores son PDFs generados por sistema
+(AFIP / facturadores) con la capa de texto completa. Una página así como
+PNG a 150 DPI son cientos de KB en base64 (más el CPU de renderizar y
+re-encodear); como texto, pocos KB. Las páginas escaneadas
+(sin texto, o con texto basura) siguen yendo como imagen, página por página
+-- un PDF puede mezclar las dos cosas.
+
+"Layout" = las palabras agrupadas en líneas por su posición vertical y
+ubicadas en una grilla de caracteres según su x, así las columnas de la
+tabla de ítems (cantidad / unitario / total) quedan alineadas y el modelo
+puede asociar cada número a su columna.
+
+Las páginas sin capa de texto se rasterizan y se encodean UNA vez, directo
+desde el pixmap (imagen_pagina): antes iban pixmap -> PNG -> PIL -> PNG otra
+vez, dos compresiones y una decodificación por página para nada. El formato
+es configurable; en "auto" se elige por página: PNG en grises para páginas
+vectoriales (texto y líneas, que PNG comprime muy bien y JPEG ensucia) y
+JPEG/WebP en grises para escaneos y fotos (páginas cubiertas por una imagen).
+scripts/bench_codecs_pdf.py compara tamaño, tiempo y precisión por formato.
+
+Memoria acotada (iterar_paginas): las páginas se generan de a una -- cada
+pixmap se libera antes de renderizar la siguiente -- y la generación se corta
+en PDF_MAX_PAGINAS páginas o cuando el payload acumulado del job pasa
+PDF_PRESUPUESTO_MB (siempre va al menos la primera página). Un escaneo de 40
+páginas llevaba al droplet de 960 MB a swap: mejor extraer las primeras
+páginas (chequear_consistencia marca los totales que no cierran) que perder
+el proceso entero. mensajes_pdf arma la parte del mensaje de cada página a
+medida que se genera (no junta primero todas las páginas en una lista y
+después los mensajes). Si se cortó, se agregan igual las últimas
+PDF_PAGINAS_IMPUESTOS páginas reales -- los totales e impuestos van al pie
+del documento, no de la página 40 -- y la cantidad de páginas que no se
+mandaron vuelve en "omitidas": los orquestadores la dejan en el item y en
+la factura (paginas_omitidas), no solo en el log.
+
+Ruteo de páginas (paginas_para_tool): en PDFs de varias páginas cada tool
+recibe solo las páginas que necesita en vez de todas --
+datos_del_emisor_y_receptor la primera, impuestos_y_retenciones_de_la_factura
+las últimas PDF_PAGINAS_IMPUESTOS (las reales del documento, aunque se haya
+cortado), detalle_de_items_facturados todas. Si la
+salida de una tool ruteada no valida, tool_handler reintenta con todas las
+páginas (ver mensajes_completos en tool_handler).
+
+Configuración por variables de entorno (opcionales):
+    PDF_TEXT_LAYER            (default true) false = siempre rasterizar
+    PDF_TEXT_MIN_CARACTERES   (default 200) caracteres útiles mínimos para
+                              considerar que una página tiene capa de texto
+    PDF_RUTEO_PAGINAS         (default true) false = todas las páginas a
+                              todas las tools
+    PDF_PAGINAS_EMISOR        (default 1) primeras páginas para emisor/receptor
+    PDF_PAGINAS_IMPUESTOS     (default 1) últimas páginas para impuestos
+    PDF_IMAGEN_FORMATO        (default auto) auto | png | jpeg | webp
+    PDF_IMAGEN_FORMATO_FOTO   (default jpeg) jpeg | webp: el de "auto" para
+                              escaneos
+    PDF_IMAGEN_CALIDAD        (default 75) calidad JPEG/WebP
+    PDF_IMAGEN_GRISES         (default true) false = color
+    PDF_MAX_PAGINAS           (default 40) páginas máximas por PDF
+    PDF_PRESUPUESTO_MB        (default 48) payload máximo de páginas por job
+"""
+
+import base64
+import io
+import logging
+import os
+import re
+from typing import Iterator, List, Tuple
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+app_logger = logging.getLogger("app_logger")
+
+CAPA_TEXTO_ACTIVA = os.getenv("PDF_TEXT_LAYER", "true").lower() in ("1", "true")
+MIN_CARACTERES = int(os.getenv("PDF_TEXT_MIN_CARACTERES", "200"))
+
+RUTEO_PAGINAS = os.getenv("PDF_RUTEO_PAGINAS", "true").lower() in ("1", "true")
+PAGINAS_EMISOR = int(os.getenv("PDF_PAGINAS_EMISOR", "1"))
+PAGINAS_IMPUESTOS = int(os.getenv("PDF_PAGINAS_IMPUESTOS", "1"))
+
+IMAGEN_FORMATO = os.getenv("PDF_IMAGEN_FORMATO", "auto").lower()
+IMAGEN_FORMATO_FOTO = os.getenv("PDF_IMAGEN_FORMATO_FOTO", "jpeg").lower()
+IMAGEN_CALIDAD = int(os.getenv("PDF_IMAGEN_CALIDAD", "75"))
+IMAGEN_GRISES = os.getenv("PDF_IMAGEN_GRISES", "true").lower() in ("1", "true")
+
+MAX_PAGINAS = max(int(os.getenv("PDF_MAX_PAGINAS", "40")), 1)
+PRESUPUESTO_BYTES = int(float(os.getenv("PDF_PRESUPUESTO_MB", "48")) * 1024 * 1024)
+
+DPI = 150
+# Fracción de la página cubierta por imágenes a partir de la cual se la
+# trata como escaneo/foto en el modo "auto".
+_COBERTURA_ESCANEO = 0.5
+ANCHO_MAXIMO = 180  # columnas de la grilla de texto
+# Proporción mínima de caracteres "normales" (letras, dígitos, puntuación
+# común). Una capa de texto rota (fuentes sin ToUnicode) sale como basura.
+_PROPORCION_LEGIBLE = 0.85
+_LEGIBLE = re.compile(r"[\w\s.,;:$%/()\-+*#°ºª'\"&@]")
+
+
+def _texto_util(texto: str) -> bool:
+    sin_espacios = re.sub(r"\s+", "", texto)
+    if len(sin_espacios) < MIN_CARACTERES:
+        return False
+    legibles = sum(1 for c in sin_espacios if _LEGIBLE.match(c))
+    return legibles / len(sin_espacios) >= _PROPORCION_LEGIBLE
+
+
+def texto_con_layout(page: "fitz.Page") -> str:
+    """Texto de la página con las palabras ubicadas en una grilla de
+    caracteres según su posición (columnas alineadas)."""
+    palabras = page.get_text("words")  # (x0, y0, x1, y1, palabra, bloque, línea, n)
+    if not palabras:
+        return ""
+    ancho_pagina = page.rect.width or 1
+    escala = ANCHO_MAXIMO / ancho_pagina
+
+    # Agrupa por línea visual: palabras cuyo centro vertical cae a menos de
+    # media altura de la línea actual.
+    palabras = sorted(palabras, key=lambda p: ((p[1] + p[3]) / 2, p[0]))
+    lineas, actual, centro_actual, alto_actual = [], [], None, 0
+    for p in palabras:
+        centro, alto = (p[1] + p[3]) / 2, p[3] - p[1]
+        if actual and abs(centro - centro_actual) > max(alto, alto_actual) / 2:
+            lineas.append(actual)
+            actual = []
+        if not actual:
+            centro_actual, alto_actual = centro, alto
+        actual.append(p)
+    if actual:
+        lineas.append(actual)
+
+    margen = min(p[0] for p in palabras)
+    salida = []
+    for linea in lineas:
+        texto, fin_anterior = "", None
+        for p in sorted(linea, key=lambda p: p[0]):
+            if fin_anterior is not None and p[0] - fin_anterior < (p[3] - p[1]) * 0.6:
+                # Palabras de la misma frase: un espacio, sin grilla.
+                texto += " " + p[4]
+            else:
+                columna = int((p[0] - margen) * escala)
+                # Al menos un espacio entre celdas aunque la grilla las junte.
+                texto += " " * max(columna - len(texto), 1 if texto else 0) + p[4]
+            fin_anterior = p[2]
+        salida.append(texto.rstrip())
+    return "\n".join(salida)
+
+
+def es_escaneo(page: "fitz.Page") -> bool:
+    """True si la página está mayormente cubierta por imágenes (escaneo,
+    foto) -- no por texto y vectores."""
+    area_pagina = abs(page.rect) or 1
+    cubierta = 0.0
+    for info in page.get_image_info():
+        cubierta += abs(fitz.Rect(info["bbox"]) & page.rect)
+    return cubierta / area_pagina >= _COBERTURA_ESCANEO
+
+
+def imagen_pagina(
+    page: "fitz.Page",
+    formato: str = None,
+    calidad: int = None,
+    grises: bool = None,
+    dpi: int = DPI,
+) -> Tuple[str, bytes]:
+    """(media type, bytes) de la página rasterizada y encodeada una sola vez,
+    directo desde el pixmap. Sin argumentos usa la configuración del módulo."""
+    formato = formato or IMAGEN_FORMATO
+    calidad = calidad or IMAGEN_CALIDAD
+    grises = IMAGEN_GRISES if grises is None else grises
+    if formato == "auto":
+        formato = IMAGEN_FORMATO_FOTO if es_escaneo(page) else "png"
+
+    pix = page.get_pixmap(
+        dpi=dpi, colorspace=fitz.csGRAY if grises else fitz.csRGB, alpha=False
+    )
+    if formato == "png":
+        return "image/png", pix.tobytes("png")
+    if formato in ("jpeg", "jpg"):
+        return "image/jpeg", pix.tobytes("jpeg", jpg_quality=calidad)
+    if formato == "webp":
+        # PyMuPDF no escribe WebP: PIL directo sobre los samples crudos del
+        # pixmap (sin pasar por un PNG intermedio).
+        img = Image.frombytes("L" if pix.n == 1 else "RGB", (pix.width, pix.height), pix.samples)
+        buffer = io.BytesIO()
+        img.save(buffer, format="WEBP", quality=calidad)
+        return "image/webp", buffer.getvalue()
+    raise ValueError(f"Formato de imagen no soportado: {formato!r}")
+
+
+def _data_url(page: "fitz.Page") -> str:
+    media_type, datos = imagen_pagina(page)
+    return f"data:{media_type};base64,{base64.b64encode(datos).decode()}"
+
+
+def _pagina(page: "fitz.Page") -> Tuple[str, str]:
+    if CAPA_TEXTO_ACTIVA:
+        texto = texto_con_layout(page)
+        if _texto_util(texto):
+            return ("texto", texto)
+    return ("imagen", _data_url(page))
+
+
+def _mensaje(numero: int, tipo: str, valor: str) -> dict:
+    """Parte de "content" (formato OpenAI-compat) de la página `numero`."""
+    if tipo == "texto":
+        return {
+            "type": "text",
+            "text": f"--- Página {numero} (texto extraído del PDF, columnas alineadas) ---\n{valor}",
+        }
+    return {"type": "image_url", "image_url": {"url": valor}}
+
+
+def iterar_paginas(
+    doc: "fitz.Document", max_paginas: int = None, presupuesto_bytes: int = None
+) -> Iterator[Tuple[str, str]]:
+    """Genera las páginas de a una, ("texto", texto con layout) o ("imagen",
+    data URL) -- ver mensajes_pdf --, hasta max_paginas o
+    hasta que la próxima haría pasar el payload acumulado de
+    presupuesto_bytes (la primera va siempre)."""
+    max_paginas = max_paginas or MAX_PAGINAS
+    presupuesto_bytes = presupuesto_bytes or PRESUPUESTO_BYTES
+    acumulado = 0
+    for n, page in enumerate(doc):
+        if n >= max_paginas:
+            return
+        pagina = _pagina(page)
+        acumulado += len(pagina[1])
+        if n and acumulado > presupuesto_bytes:
+            return
+        yield pagina
+
+
+def mensajes_pdf(file_path: str, process_id: str = "") -> dict:
+    """Partes de "content" (formato OpenAI-compat) del PDF, una por página:
+    la página como texto con layout si tiene capa de texto usable, o como
+    data URL de la página rasterizada (ver imagen_pagina) si no. Acotado por
+    PDF_MAX_PAGINAS y PDF_PRESUPUESTO_MB (ver iterar_paginas); las últimas
+    PDF_PAGINAS_IMPUESTOS páginas del documento van siempre.
+
+    Devuelve {"mensajes", "numeros" (número real de página de cada parte),
+    "total" (páginas del documento), "omitidas" (las que no se mandan)}."""
+    mensajes, numeros = [], []
+    en_texto = tamano = 0
+
+    def agregar(numero, tipo, valor):
+        nonlocal en_texto, tamano
+        mensajes.append(_mensaje(numero, tipo, valor))
+        numeros.append(numero)
+        en_texto += tipo == "texto"
+        tamano += len(valor)
+
+    with fitz.open(file_path) as doc:
+        total = doc.page_count
+        for n, (tipo, valor) in enumerate(iterar_paginas(doc), 1):
+            agregar(n, tipo, valor)
+        cortado = len(mensajes)
+        for indice in range(max(total - max(PAGINAS_IMPUESTOS, 1), cortado), total):
+            agregar(indice + 1, *_pagina(doc[indice]))
+    app_logger.info(
+        f"[{process_id}] 📄 PDF: {en_texto}/{len(mensajes)} páginas por capa de texto, "
+        f"{len(mensajes) - en_texto} rasterizadas, {tamano / 1024:.0f}KB"
+    )
+    omitidas = total - len(mensajes)
+    if omitidas:
+        app_logger.warning(
+            f"[{process_id}] 📄 PDF de {total} páginas: se envían las primeras "
+            f"{cortado} y las últimas {len(mensajes) - cortado}, {omitidas} omitidas "
+            f"(PDF_MAX_PAGINAS={MAX_PAGINAS}, "
+            f"PDF_PRESUPUESTO_MB={PRESUPUESTO_BYTES / 1024 / 1024:g})"
+        )
+    return {"mensajes": mensajes, "numeros": numeros, "total": total, "omitidas": omitidas}
+
+
+def paginas_para_tool(tool_name, cantidad: int):
+    """Índices de las páginas que necesita `tool_name`, o None = todas (sin
+    ruteo, tool sin regla, o la regla ya cubre todo el documento)."""
+    if not (RUTEO_PAGINAS and tool_name) or cantidad < 2:
+        return None
+    if tool_name == "datos_del_emisor_y_receptor":
+        seleccion = list(range(min(PAGINAS_EMISOR, cantidad)))
+    elif tool_name == "impuestos_y_retenciones_de_la_factura":
+        seleccion = list(range(max(cantidad - PAGINAS_IMPUESTOS, 0), cantidad))
+    else:
+        return None
+    return seleccion if len(seleccion) < cantidad else None
+
+
+def _rangos(numeros: List[int]) -> str:
+    """[1, 2, 3, 7] -> "1-3, 7"."""
+    tramos = []
+    for numero in numeros:
+        if tramos and numero == tramos[-1][1] + 1:
+            tramos[-1][1] = numero
+        else:
+            tramos.append([numero, numero])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in tramos)
+
+
+def seleccionar_paginas(
+    mensajes: list, tool_name=None, paginas=None, numeros: List[int] = None, total: int = None
+) -> list:
+    """Las partes de `mensajes` (una por página, ver mensajes_pdf) que le
+    tocan a `tool_name` -- o las de `paginas` (índices) si se pasan, p.ej.
+    un bloque de ítems --, con una nota de qué páginas son si no van todas.
+    numeros/total (de mensajes_pdf) son los números reales de página y el
+    total del documento, para que la nota diga la verdad si se cortó."""
+    numeros = numeros or list(range(1, len(mensajes) + 1))
+    total = total or len(mensajes)
+    if paginas is not None:
+        seleccion = list(paginas) if len(paginas) < len(mensajes) else None
+    else:
+        seleccion = paginas_para_tool(tool_name, len(mensajes))
+    if seleccion is None:
+        if len(mensajes) == total:
+            return mensajes
+        seleccion = list(range(len(mensajes)))
+    enviadas = [numeros[i] for i in seleccion]
+    nota = {
+        "type": "text",
+        "text": (
+            f"(Documento de {total} páginas; se envía solo "
+            f"{'la página' if len(enviadas) == 1 else 'las páginas'} "
+            f"{_rangos(enviadas)}.)"
+        ),
+    }
+    return [nota, *(mensajes[i] for i in seleccion)]
@@ -0,0 +1,191 @@
+"""
+Pipeline por etapas para lo que pasa DESPUÉS de la extracción: cada etapa
+con su cola acotada, su pool de workers y su política de reintentos.
+
+worker() y _procesar_imagen_o_pdf (routes/process_invoice_google_2.py)
+corrían Sheets, la pestaña de ítems, PocketBase, la búsqueda de proveedor
+en BAS, Drive, el email y el webhook en fila, en una sola corutina, y casi
+todo con clientes sincrónicos (requests / googleapiclient) dentro del event
+loop: un scan lento de proveedores en BAS frenaba la extracción de la
+factura siguiente (y de paso el loop entero). Ahora cada factura es un
+"contexto" (un dict) que pasa por las etapas:
+
+    extraer -> persistir -> erp -> archivar -> notificar
+
+    pipeline = Pipeline("gemini2", [
+        Etapa("extraer", self._etapa_extraer, workers=2, obligatoria=True),
+        Etapa("persistir", self._etapa_persistir, workers=2, intentos=3),
+        ...
+    ])
+    ctx = await pipeline.procesar({"item": item, ...})
+
+  - Cada etapa tiene `workers` corutinas que toman de su cola (capacidad
+    `capacidad`) y, al terminar, ponen el contexto en la cola de la etapa
+    siguiente. Si esa cola está llena, el worker espera: la presión vuelve
+    hacia atrás en vez de acumular facturas en memoria. Con varias facturas
+    en vuelo, la extracción de una se solapa con el BAS de la anterior y el
+    throughput lo pone la etapa más lenta, no la suma de todas.
+  - Reintentos por etapa con el mismo backoff con jitter que las llamadas a
+    los LLM (ver utils/retry_policy.py). Una etapa que quiere reintentar
+    tira una excepción (p.ej. EtapaIncompleta si un paso devolvió False);
+    las funciones de etapa guardan en el contexto lo que ya hicieron, paso
+    por paso (hasta cada ítem de PocketBase), así un reintento no repite lo
+    que salió bien.
+  - Una etapa "obligatoria" que agota sus intentos corta la factura y
+    procesar() tira la excepción (la extracción: sin datos no hay nada que
+    guardar). Las demás son best-effort, igual que antes de este cambio:
+    el error queda en ctx["errores"][etapa] y la factura sigue.
+
+El trabajo sincrónico de cada etapa va en asyncio.to_thread (lo hace la
+función de la etapa): el pool de workers de la etapa es el límite de
+concurrencia, el event loop queda libre.
+
+estado() (en GET /queue) da, por etapa, la cola, los que están en vuelo y
+los tiempos: la etapa con cola llena y espera alta es el cuello de botella.
+
+Configuración por variables de entorno (opcionales), por etapa (p.ej.
+PIPELINE_ERP_WORKERS); los defaults los pone cada orquestador:
+    PIPELINE_<ETAPA>_WORKERS     workers de la etapa
+    PIPELINE_<ETAPA>_CAPACIDAD   facturas que pueden esperar en su cola
+    PIPELINE_<ETAPA>_INTENTOS    intentos antes de darla por fallida
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, List
+
+from utils.retry_policy import RetryPolicy
+
+app_logger = logging.getLogger("app_logger")
+
+
+class EtapaIncompleta(Exception):
+    """Un paso de la etapa no se pudo hacer (devolvió False/None): reintentar."""
+
+
+class Etapa:
+    def __init__(
+        self,
+        nombre: str,
+        fn: Callable[[dict], Awaitable[None]],
+        workers: int = 1,
+        capacidad: int = 8,
+        intentos: int = 1,
+        obligatoria: bool = False,
+    ):
+        prefijo = f"PIPELINE_{nombre.upper()}_"
+        self.nombre = nombre
+        self.fn = fn
+        self.workers = max(int(os.getenv(prefijo + "WORKERS", workers)), 1)
+        self.capacidad = max(int(os.getenv(prefijo + "CAPACIDAD", capacidad)), 1)
+        self.politica = RetryPolicy(
+            max_intentos=max(int(os.getenv(prefijo + "INTENTOS", intentos)), 1),
+            base=2,
+            tope=30,
+        )
+        self.obligatoria = obligatoria
+        self.cola: asyncio.Queue = None
+        self._metricas = {
+            "en_vuelo": 0,
+            "procesadas": 0,
+            "fallidas": 0,
+            "reintentos": 0,
+            "espera_total_s": 0.0,
+            "trabajo_total_s": 0.0,
+        }
+
+    async def correr(self, ctx: dict) -> None:
+        """fn(ctx) con los reintentos de la etapa."""
+        intentos = self.politica.max_intentos
+        for intento in range(intentos):
+            try:
+                return await self.fn(ctx)
+            except Exception as e:
+                if intento == intentos - 1:
+                    raise
+                espera = self.politica.espera(intento)
+                self._metricas["reintentos"] += 1
+                app_logger.warning(
+                    f"[{ctx.get('process_id')}] Etapa {self.nombre}: {e}. "
+                    f"Reintento {intento + 2}/{intentos} en {espera:.1f}s"
+                )
+                await asyncio.sleep(espera)
+
+    def estado(self) -> dict:
+        metricas = self._metricas
+        terminadas = metricas["procesadas"] + metricas["fallidas"]
+        return {
+            "workers": self.workers,
+            "capacidad": self.capacidad,
+            "en_cola": self.cola.qsize() if self.cola else 0,
+            **{k: round(v, 2) if isinstance(v, float) else v for k, v in metricas.items()},
+            "espera_media_s": round(metricas["espera_total_s"] / terminadas, 2) if terminadas else 0.0,
+            "trabajo_medio_s": round(metricas["trabajo_total_s"] / terminadas, 2) if terminadas else 0.0,
+        }
+
+
+class Pipeline:
+    def __init__(self, nombre: str, etapas: List[Etapa]):
+        self.nombre = nombre
+        self.etapas = etapas
+        self._tareas = []
+
+    def _arrancar(self) -> None:
+        # Las colas y los workers se crean con el primer procesar(), adentro
+        # del event loop que los va a usar.
+        for etapa in self.etapas:
+            etapa.cola = asyncio.Queue(maxsize=etapa.capacidad)
+        for n, etapa in enumerate(self.etapas):
+            for _ in range(etapa.workers):
+                self._tareas.append(asyncio.create_task(self._worker(n)))
+
+    async def procesar(self, ctx: dict) -> dict:
+        """Pasa `ctx` por todas las etapas y lo devuelve. Tira la excepción
+        de una etapa obligatoria que falló."""
+        if not self._tareas:
+            self._arrancar()
+        futuro = asyncio.get_running_loop().create_future()
+        ctx.setdefault("errores", {})
+        await self.etapas[0].cola.put((ctx, futuro, time.monotonic()))
+        return await futuro
+
+    async def _worker(self, n: int) -> None:
+        etapa = self.etapas[n]
+        metricas = etapa._metricas
+        while True:
+            ctx, futuro, encolado = await etapa.cola.get()
+            inicio = time.monotonic()
+            metricas["espera_total_s"] += inicio - encolado
+            metricas["en_vuelo"] += 1
+            error = None
+            try:
+                if not futuro.done():  # el caller se canceló (shutdown)
+                    await etapa.correr(ctx)
+                    metricas["procesadas"] += 1
+            except Exception as e:
+                error = e
+                metricas["fallidas"] += 1
+                app_logger.error(
+                    f"[{ctx.get('process_id')}] Etapa {etapa.nombre} falló: {e}"
+                )
+            finally:
+                metricas["en_vuelo"] -= 1
+                metricas["trabajo_total_s"] += time.monotonic() - inicio
+                etapa.cola.task_done()
+            if futuro.done():
+                continue
+            if error is not None:
+                if etapa.obligatoria:
+                    futuro.set_exception(error)
+                    continue
+                ctx["errores"][etapa.nombre] = str(error)
+            if n + 1 < len(self.etapas):
+                await self.etapas[n + 1].cola.put((ctx, futuro, time.monotonic()))
+            else:
+                futuro.set_result(ctx)
+
+    def estado(self) -> dict:
+        """Métricas por etapa, en orden, para /queue."""
+        return {etapa.nombre: etapa.estado() for etapa in self.etapas}
@@ -30,7 +30,10 @@ integración; este módulo no las crea, solo las consume):
     service_accounts        (auth collection) — email/password del service account.
     invoices                 — process_id (text, único), status (select, REQUERIDO:
                                 pending/processing/completed/error) + resto de campos del
-                                contrato de schema (ver plan de arquitectura).
+                                contrato de schema (ver plan de arquitectura). Opcionales:
+                                posible_duplicado_de (text), duplicado_distancia (number) --
+                                ver utils/near_duplicates.py; paginas_omitidas (number) --
+                                ver utils/pdf_text.mensajes_pdf.
     invoice_items             — invoice (relation a invoices, REQUERIDA -- el id del record,
                                 no el process_id) + campos por ítem (descripcion, cantidad,
                                 precio_unitario, precio_total, categoria, bas_codigo_item, linea).
@@ -56,6 +59,7 @@ import base64
 import datetime
 import json
 import logging
+import threading
 import time
 from typing import Any, Optional
 
@@ -74,6 +78,12 @@ BAS_PAYMENT_METHODS_COLLECTION = "bas_payment_methods"
 PAYMENT_ORDERS_COLLECTION = "payment_orders"
 BAS_CATEGORY_MAP_COLLECTION = "bas_category_map"
 
+# Locks para _upsert, repartidos por (colección, clave): buscar-y-crear no es
+# atómico en PocketBase, y dos upserts concurrentes del mismo process_id (los
+# archivos de un job de email van en paralelo por el pipeline) creaban dos
+# records. Cantidad fija para no guardar un lock por process_id.
+_UPSERT_LOCKS = [threading.Lock() for _ in range(64)]
+
 
 class PocketBaseApiError(Exception):
     """Error de la API de PocketBase. Conserva el código HTTP y el detalle del backend."""
@@ -293,12 +303,13 @@ class PocketBaseClient:
         )
 
     def _upsert(self, collection: str, key_field: str, key_value: str, data: dict) -> dict:
-        existente = self._find_one(collection, _pb_filter_eq(key_field, key_value))
         payload = dict(data)
         payload[key_field] = key_value
-        if existente:
-            return self._update(collection, existente["id"], payload)
-        return self._create(collection, payload)
+        with _UPSERT_LOCKS[hash((collection, key_value)) % len(_UPSERT_LOCKS)]:
+            existente = self._find_one(collection, _pb_filter_eq(key_field, key_value))
+            if existente:
+                return self._update(collection, existente["id"], payload)
+            return self._create(collection, payload)
 
     # ------------------------------------------------------------------ #
     # Métodos tipados (públicos) -- todos defensivos: devuelven None/False
@@ -0,0 +1,261 @@
+"""
+Presupuesto global (token bucket) de requests por minuto y tokens de entrada
+por minuto hacia cada proveedor de LLM.
+
+Los orquestadores de WA, BAS y Claude disparan requests cada uno por su lado
+-- cada uno con su propio semáforo, y las tareas de _procesar_en_background
+(routes/process_invoice_google_2.py) ni siquiera pasan por el semáforo. Todos
+juntos se chocaban con las cuotas RPM/TPM del proveedor y terminaban
+quemando tiempo en reintentos de 429. Acá hay UN bucket por proveedor (por
+host) para todo el proceso: make_api_request (de los tres orquestadores y de
+utils/fetcher.py) se lo pasa a utils/retry_policy.post_json, que pide lugar
+antes de CADA intento HTTP -- no una vez por llamada: un reintento es otra
+request para la cuota del proveedor -- y espera, en orden de llegada, si no
+hay.
+
+  - Requests: 1 por intento.
+  - Tokens: estimados del payload antes de mandar (texto / 4, más un costo
+    fijo por imagen o página de PDF); con la respuesta se corrige contra el
+    usage real (ajustar()).
+
+Opcionalmente el estado se comparte entre procesos (varios uvicorn/servicios
+en el mismo host con la misma API key) vía un archivo JSON con lock fcntl:
+RATE_BUDGET_FILE=data/rate_budget.json. El flock es bloqueante, así que con
+archivo el acceso al estado corre en un thread (asyncio.to_thread) y no
+frena el event loop mientras otro proceso tiene el lock.
+
+Anthropic arranca SIN límite: las cuotas dependen del tier de la cuenta y
+un default chico (el tier más bajo) frenaba el flujo de Claude muy por
+debajo de lo que la cuenta permite. Se activa poniendo ANTHROPIC_RPM /
+ANTHROPIC_TPM con los números del tier contratado.
+
+La espera en cola queda medida en metricas() (se expone en GET /queue).
+
+Configuración por variables de entorno (opcionales; 0 = sin límite):
+    GEMINI_RPM / GEMINI_TPM          (default 150 / 1000000)
+    ANTHROPIC_RPM / ANTHROPIC_TPM    (default 0 / 0 = sin límite)
+    RATE_BUDGET_TOKENS_POR_IMAGEN    (default 1300) estimación por imagen/página
+    RATE_BUDGET_FILE                 (default vacío = solo en memoria)
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows (dev local): sin estado compartido entre procesos
+    fcntl = None
+
+app_logger = logging.getLogger("app_logger")
+
+TOKENS_POR_IMAGEN = int(os.getenv("RATE_BUDGET_TOKENS_POR_IMAGEN", "1300"))
+ARCHIVO_COMPARTIDO = os.getenv("RATE_BUDGET_FILE", "")
+
+# host -> (prefijo de las variables de entorno, rpm default, tpm default)
+_LIMITES_POR_HOST = {
+    "generativelanguage.googleapis.com": ("GEMINI", 150, 1_000_000),
+    "api.anthropic.com": ("ANTHROPIC", 0, 0),
+}
+
+
+def estimar_tokens_entrada(data: Dict) -> int:
+    """Estimación barata de tokens de entrada de un payload (OpenAI-compat de
+    Gemini o Messages de Anthropic): texto / 4 + TOKENS_POR_IMAGEN por cada
+    imagen o página de PDF. No hace falta precisión -- ajustar() corrige."""
+    texto = len(json.dumps(data.get("tools", []), ensure_ascii=False))
+    imagenes = 0
+    for mensaje in data.get("messages", []):
+        contenido = mensaje.get("content")
+        if isinstance(contenido, str):
+            texto += len(contenido)
+            continue
+        for parte in contenido or []:
+            tipo = parte.get("type")
+            if tipo == "text":
+                texto += len(parte.get("text", ""))
+            elif tipo in ("image", "image_url"):
+                imagenes += 1
+            elif tipo == "document":
+                imagenes += _contar_paginas_pdf(parte.get("source", {}).get("data", ""))
+    return texto // 4 + imagenes * TOKENS_POR_IMAGEN
+
+
+def _contar_paginas_pdf(b64: str) -> int:
+    try:
+        return max(1, len(re.findall(rb"/Type\s*/Page(?!s)", base64.b64decode(b64))))
+    except Exception:
+        return 1
+
+
+def _tokens_reales(respuesta: Optional[Dict]) -> Optional[int]:
+    usage = (respuesta or {}).get("usage") or {}
+    if "prompt_tokens" in usage:  # OpenAI-compat (Gemini)
+        return usage["prompt_tokens"]
+    if "input_tokens" in usage:  # Anthropic
+        return (
+            usage["input_tokens"]
+            + usage.get("cache_creation_input_tokens", 0)
+            + usage.get("cache_read_input_tokens", 0)
+        )
+    return None
+
+
+class RateBudget:
+    """Dos token buckets (requests y tokens, ambos por minuto) de un
+    proveedor. rpm/tpm en 0 = sin límite en esa dimensión."""
+
+    def __init__(self, nombre: str, rpm: int, tpm: int, archivo: str = ""):
+        self.nombre = nombre
+        self.rpm = rpm
+        self.tpm = tpm
+        self.archivo = archivo if fcntl else ""
+        self._estado = {"req": float(rpm), "tok": float(tpm), "ts": time.time()}
+        self._lock = asyncio.Lock()  # FIFO: el primero que llega, primero pasa
+        self._en_cola = 0
+        self._metricas = {
+            "llamadas": 0,
+            "esperas": 0,
+            "espera_total_s": 0.0,
+            "espera_max_s": 0.0,
+            "espera_ultima_s": 0.0,
+        }
+
+    @property
+    def habilitado(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def _recargar(self, estado: dict, ahora: float) -> None:
+        transcurrido = max(0.0, ahora - estado["ts"])
+        estado["req"] = min(self.rpm, estado["req"] + transcurrido * self.rpm / 60)
+        estado["tok"] = min(self.tpm, estado["tok"] + transcurrido * self.tpm / 60)
+        estado["ts"] = ahora
+
+    def _consumir(self, estado: dict, tokens: int) -> float:
+        """Descuenta si hay lugar y devuelve 0; si no, devuelve cuántos
+        segundos faltan para que lo haya (sin descontar nada)."""
+        self._recargar(estado, time.time())
+        falta = 0.0
+        if self.rpm > 0 and estado["req"] < 1:
+            falta = max(falta, (1 - estado["req"]) * 60 / self.rpm)
+        if self.tpm > 0 and estado["tok"] < tokens:
+            falta = max(falta, (tokens - estado["tok"]) * 60 / self.tpm)
+        if falta > 0:
+            return falta
+        if self.rpm > 0:
+            estado["req"] -= 1
+        if self.tpm > 0:
+            estado["tok"] -= tokens
+        return 0.0
+
+    def _con_estado(self, operacion):
+        """Corre operacion(estado) sobre el estado en memoria o, si hay
+        RATE_BUDGET_FILE, sobre el compartido (lock fcntl exclusivo)."""
+        if not self.archivo:
+            return operacion(self._estado)
+        try:
+            with open(self.archivo, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    contenido = f.read()
+                    todos = json.loads(contenido) if contenido.strip() else {}
+                    estado = todos.get(self.nombre) or dict(self._estado)
+                    resultado = operacion(estado)
+                    todos[self.nombre] = estado
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(todos))
+                    return resultado
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except OSError as e:
+            app_logger.warning(f"RateBudget: no se pudo usar {self.archivo} ({e}), sigo en memoria")
+            self.archivo = ""
+            return operacion(self._estado)
+
+    async def _con_estado_async(self, operacion):
+        """_con_estado sin bloquear el loop: con archivo compartido el flock
+        puede esperar a otro proceso, así que va a un thread."""
+        if not self.archivo:
+            return operacion(self._estado)
+        return await asyncio.to_thread(self._con_estado, operacion)
+
+    async def adquirir(self, data: Dict, process_id: str = "") -> int:
+        """Espera hasta que haya presupuesto para una request con este
+        payload y lo descuenta. Devuelve los tokens estimados (para ajustar())."""
+        tokens = estimar_tokens_entrada(data)
+        if not self.habilitado:
+            return tokens
+        # Una request más grande que el bucket entero nunca entraría.
+        tokens_a_pedir = min(tokens, self.tpm) if self.tpm > 0 else tokens
+        self._en_cola += 1
+        inicio = time.perf_counter()
+        try:
+            async with self._lock:
+                while True:
+                    falta = await self._con_estado_async(
+                        lambda e: self._consumir(e, tokens_a_pedir)
+                    )
+                    if falta == 0:
+                        break
+                    await asyncio.sleep(min(falta, 5.0))
+        finally:
+            self._en_cola -= 1
+        espera = time.perf_counter() - inicio
+        self._metricas["llamadas"] += 1
+        self._metricas["espera_ultima_s"] = round(espera, 3)
+        if espera > 0.05:
+            self._metricas["esperas"] += 1
+            self._metricas["espera_total_s"] = round(self._metricas["espera_total_s"] + espera, 3)
+            self._metricas["espera_max_s"] = round(max(self._metricas["espera_max_s"], espera), 3)
+            app_logger.info(
+                f"[{process_id}] ⏳ Presupuesto {self.nombre}: esperó {espera:.1f}s en cola (~{tokens} tokens)"
+            )
+        return tokens_a_pedir
+
+    async def ajustar(self, tokens_estimados: int, respuesta: Optional[Dict]) -> None:
+        """Corrige el bucket de tokens con el usage real de la respuesta."""
+        reales = _tokens_reales(respuesta)
+        if reales is None or self.tpm <= 0:
+            return
+        diferencia = reales - tokens_estimados
+
+        def _corregir(estado):
+            estado["tok"] = min(self.tpm, estado["tok"] - diferencia)
+
+        await self._con_estado_async(_corregir)
+
+    def metricas(self) -> dict:
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "en_cola": self._en_cola,
+            **self._metricas,
+        }
+
+
+_presupuestos: Dict[str, RateBudget] = {}
+
+
+def presupuesto_para(url: str) -> RateBudget:
+    """Un RateBudget por host, compartido por todo el proceso."""
+    host = urlparse(url).netloc or url
+    if host not in _presupuestos:
+        prefijo, rpm, tpm = _LIMITES_POR_HOST.get(host, (None, 0, 0))
+        if prefijo:
+            rpm = int(os.getenv(f"{prefijo}_RPM", str(rpm)))
+            tpm = int(os.getenv(f"{prefijo}_TPM", str(tpm)))
+        _presupuestos[host] = RateBudget(host, rpm, tpm, ARCHIVO_COMPARTIDO)
+    return _presupuestos[host]
+
+
+def metricas_presupuestos() -> dict:
+    """{host: métricas} de todos los presupuestos usados hasta ahora."""
+    return {host: p.metricas() for host, p in _presupuestos.items()}
@@ -0,0 +1,116 @@
+"""
+Pool acotado para el trabajo de CPU de los toolchains (rasterizar PDFs,
+PIL, base64) fuera del event loop.
+
+run_pdf_toolchain llamaba a fitz.open / get_pixmap / PIL / base64 directo
+dentro de la corutina: mientras se renderizaba un PDF grande el event loop
+quedaba bloqueado, y con él todos los requests HTTP y los demás workers (en
+la VM de 1 vCPU, segundos enteros sin atender nada). Ahora los tres
+orquestadores (Claude, WA y BAS) mandan ese trabajo a UN pool compartido:
+
+    pdf = await pool_render.ejecutar(mensajes_pdf, file_path, process_id,
+                                     process_id=process_id)
+
+Por default es un pool de threads: PyMuPDF y PIL sueltan el GIL mientras
+renderizan/encodean, así que alcanza para liberar el loop sin pagar el
+arranque de procesos ni pickle de resultados de varios MB. Con
+RENDER_POOL_TIPO=process se usa un ProcessPoolExecutor (contexto "spawn":
+nada de fork con el loop y threads vivos) -- solo tiene sentido con más de
+un core. Las funciones que se mandan tienen que ser de nivel de módulo
+(pickleables) en ese modo.
+
+El tiempo que cada tarea espera un worker libre queda medido en estado()
+(se expone en GET /queue): si crece, faltan workers o sobra trabajo.
+
+Configuración por variables de entorno (opcionales):
+    RENDER_POOL_WORKERS   (default 2) workers del pool
+    RENDER_POOL_TIPO      (default thread) thread | process
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+app_logger = logging.getLogger("app_logger")
+
+WORKERS = max(int(os.getenv("RENDER_POOL_WORKERS", "2")), 1)
+TIPO = os.getenv("RENDER_POOL_TIPO", "thread").lower()
+
+
+def _medido(encolado: float, fn: Callable, args: tuple):
+    """Corre en el worker: (resultado, segundos en cola, segundos de trabajo).
+    time.time() y no monotonic: en modo process se compara entre procesos."""
+    inicio = time.time()
+    resultado = fn(*args)
+    return resultado, inicio - encolado, time.time() - inicio
+
+
+class RenderPool:
+    def __init__(self, workers: int = None, tipo: str = None):
+        self.workers = workers or WORKERS
+        self.tipo = tipo or TIPO
+        self._executor: Optional[Executor] = None
+        self._metricas = {
+            "tareas": 0,
+            "en_cola": 0,
+            "espera_total_s": 0.0,
+            "espera_max_s": 0.0,
+            "espera_ultima_s": 0.0,
+            "trabajo_total_s": 0.0,
+        }
+
+    def _pool(self) -> Executor:
+        # Lazy: importar el módulo no levanta threads/procesos (scripts, tests
+        # de import).
+        if self._executor is None:
+            if self.tipo == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="render"
+                )
+            app_logger.info(f"🖨️ Pool de render: {self.workers} workers ({self.tipo})")
+        return self._executor
+
+    async def ejecutar(self, fn: Callable, *args, process_id: str = ""):
+        """Corre fn(*args) en el pool sin bloquear el event loop y devuelve su
+        resultado (las excepciones de fn se propagan tal cual)."""
+        loop = asyncio.get_running_loop()
+        self._metricas["en_cola"] += 1
+        try:
+            resultado, espera, trabajo = await loop.run_in_executor(
+                self._pool(), _medido, time.time(), fn, args
+            )
+        finally:
+            self._metricas["en_cola"] -= 1
+        espera = max(espera, 0.0)
+        self._metricas["tareas"] += 1
+        self._metricas["espera_ultima_s"] = round(espera, 3)
+        self._metricas["espera_total_s"] = round(self._metricas["espera_total_s"] + espera, 3)
+        self._metricas["espera_max_s"] = round(max(self._metricas["espera_max_s"], espera), 3)
+        self._metricas["trabajo_total_s"] = round(self._metricas["trabajo_total_s"] + trabajo, 3)
+        if espera > 1:
+            app_logger.info(
+                f"[{process_id}] 🖨️ '{getattr(fn, '__name__', fn)}' esperó {espera:.1f}s un worker de render"
+            )
+        return resultado
+
+    def cerrar(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def estado(self) -> dict:
+        return {"workers": self.workers, "tipo": self.tipo, **self._metricas}
+
+
+# Instancia compartida por los tres orquestadores (el tope de workers es de
+# todo el proceso).
+pool_render = RenderPool()
@@ -0,0 +1,331 @@
+"""
+Política de reintentos compartida para las llamadas HTTP a los LLM (Gemini /
+Anthropic): backoff exponencial con jitter que respeta Retry-After, deadline
+total por llamada y circuit breaker por host.
+
+Antes cada make_api_request dormía un fijo 15 * (i + 1) segundos ante un
+429/503/529 (o WAIT_TIMES en utils/fetcher.py), ignorando el Retry-After del
+proveedor, y tool_handler envolvía eso en OTRO loop de 6 intentos -- un minuto
+malo del proveedor podía tener tomado un slot de worker durante muchos
+minutos. Ahora:
+
+  - La espera entre intentos es "full jitter" (uniforme entre 0 y
+    min(tope, base * 2**intento)); si el proveedor manda Retry-After, se
+    espera al menos eso.
+  - El deadline de la llamada acota todo: cada intento (la espera del
+    presupuesto más el POST) corre con asyncio.timeout por lo que queda, y
+    si la próxima espera del backoff no entra, se corta ya. Antes solo se
+    miraba antes de dormir, y un POST colgado tenía el timeout de 300s de
+    aiohttp en cada intento.
+  - Al agotarse (o con el circuito abierto) se lanza UpstreamUnavailableError
+    -- subclase de ValueError, así los callers que ya atrapan ValueError y
+    usan el mensaje (error_message en PocketBase) siguen igual. tool_handler
+    NO reintenta esta excepción: los reintentos de transporte ya se hicieron
+    acá.
+  - Circuit breaker por host: tras N fallas seguidas del upstream (5xx, 529,
+    errores de conexión -- un 429 es cuota, no caída, y no cuenta) se abre y
+    las llamadas fallan al instante durante el enfriamiento; después pasa una
+    sola llamada de prueba (half-open) que lo cierra o lo vuelve a abrir.
+    La prueba tiene su propio timeout y, si termina de cualquier otra forma
+    (cancelada por el TaskGroup de las tools o por el hedging, una excepción
+    inesperada), libera el lugar: si no, el breaker quedaba semiabierto para
+    siempre, rechazando todo.
+  - Con `presupuesto` (utils/rate_budget.py) se pide lugar en el bucket
+    RPM/TPM del proveedor antes de CADA intento, no una vez por llamada:
+    cada reintento es una request más para la cuota. Se pide después de
+    consultar al breaker: una llamada que el circuito rechaza no gasta cuota.
+  - El body se serializa UNA vez por llamada (cuerpo_json) y se reusa en
+    cada intento. Con json=data aiohttp hacía json.dumps + encode -- un str
+    y un bytes con todo el base64 de las páginas -- en cada intento.
+
+Configuración por variables de entorno (opcionales):
+    LLM_RETRY_MAX_INTENTOS   (default 5)
+    LLM_RETRY_BASE           (default 2) segundos, base del backoff
+    LLM_RETRY_TOPE           (default 60) segundos, espera máxima por intento
+    LLM_RETRY_DEADLINE       (default 180) segundos totales por llamada
+    LLM_CB_UMBRAL            (default 5) fallas seguidas para abrir
+    LLM_CB_ENFRIAMIENTO      (default 30) segundos con el circuito abierto
+    LLM_CB_TIMEOUT_SONDEO    (default 120) segundos máximos de la llamada de
+                             prueba del estado semiabierto
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+app_logger = logging.getLogger("app_logger")
+
+MAX_INTENTOS = int(os.getenv("LLM_RETRY_MAX_INTENTOS", "5"))
+BASE_SEGUNDOS = float(os.getenv("LLM_RETRY_BASE", "2"))
+TOPE_SEGUNDOS = float(os.getenv("LLM_RETRY_TOPE", "60"))
+DEADLINE_SEGUNDOS = float(os.getenv("LLM_RETRY_DEADLINE", "180"))
+UMBRAL_BREAKER = int(os.getenv("LLM_CB_UMBRAL", "5"))
+ENFRIAMIENTO_BREAKER = float(os.getenv("LLM_CB_ENFRIAMIENTO", "30"))
+TIMEOUT_SONDEO = float(os.getenv("LLM_CB_TIMEOUT_SONDEO", "120"))
+
+# 429 = cuota; 500/502/503/504 = upstream con problemas; 529 = "overloaded"
+# de Anthropic.
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504, 529}
+
+
+def cuerpo_json(data: Dict) -> bytearray:
+    """JSON de `data` encodeado directo a un bytearray, fragmento por
+    fragmento: el pico es el body más un fragmento (p.ej. una página), no el
+    str entero más su copia en bytes."""
+    cuerpo = bytearray()
+    for fragmento in json.JSONEncoder().iterencode(data):
+        cuerpo += fragmento.encode()
+    return cuerpo
+
+
+class UpstreamUnavailableError(ValueError):
+    """El proveedor no respondió bien dentro de la política (reintentos
+    agotados, deadline vencido o circuito abierto)."""
+
+
+class CircuitBreaker:
+    def __init__(self, nombre: str, umbral: int = None, enfriamiento: float = None):
+        self.nombre = nombre
+        self.umbral = umbral or UMBRAL_BREAKER
+        self.enfriamiento = enfriamiento or ENFRIAMIENTO_BREAKER
+        self.fallas_seguidas = 0
+        self.abierto_hasta = 0.0
+        self._sondeando = False
+
+    @property
+    def estado(self) -> str:
+        if self.fallas_seguidas < self.umbral:
+            return "cerrado"
+        if time.monotonic() < self.abierto_hasta:
+            return "abierto"
+        return "semiabierto"
+
+    def verificar(self) -> bool:
+        """Lanza UpstreamUnavailableError si el circuito no deja pasar.
+        Devuelve True si esta llamada es la de prueba (semiabierto): el
+        caller tiene que terminarla con registrar_exito / registrar_falla /
+        liberar_sondeo pase lo que pase."""
+        estado = self.estado
+        if estado == "abierto":
+            restante = self.abierto_hasta - time.monotonic()
+            raise UpstreamUnavailableError(
+                f"Circuit breaker abierto para {self.nombre} (reintenta en {restante:.0f}s)"
+            )
+        if estado == "semiabierto":
+            if self._sondeando:
+                raise UpstreamUnavailableError(
+                    f"Circuit breaker semiabierto para {self.nombre} (llamada de prueba en curso)"
+                )
+            self._sondeando = True
+            return True
+        return False
+
+    def registrar_exito(self) -> None:
+        if self.fallas_seguidas >= self.umbral:
+            app_logger.info(f"🟢 Circuit breaker cerrado para {self.nombre}")
+        self.fallas_seguidas = 0
+        self._sondeando = False
+
+    def registrar_falla(self) -> None:
+        self.fallas_seguidas += 1
+        self._sondeando = False
+        if self.fallas_seguidas >= self.umbral:
+            self.abierto_hasta = time.monotonic() + self.enfriamiento
+            app_logger.warning(
+                f"🔴 Circuit breaker abierto para {self.nombre} durante {self.enfriamiento:.0f}s "
+                f"({self.fallas_seguidas} fallas seguidas)"
+            )
+
+    def liberar_sondeo(self) -> None:
+        """Para respuestas que no dicen nada de la salud del upstream (400,
+        429): no cuentan como falla ni como éxito, pero liberan la prueba."""
+        self._sondeando = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def breaker_para(url: str) -> CircuitBreaker:
+    """Un breaker por host, compartido por todo el proceso (orquestadores y
+    utils/fetcher.py pegándole al mismo proveedor ven el mismo estado)."""
+    host = urlparse(url).netloc or url
+    if host not in _breakers:
+        _breakers[host] = CircuitBreaker(host)
+    return _breakers[host]
+
+
+def _parsear_retry_after(valor: Optional[str]) -> Optional[float]:
+    """Retry-After viene en segundos ("30") o como fecha HTTP."""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def _sin_medicion() -> None:
+    pass
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_intentos: int = None,
+        base: float = None,
+        tope: float = None,
+        deadline: float = None,
+    ):
+        self.max_intentos = max_intentos or MAX_INTENTOS
+        self.base = base or BASE_SEGUNDOS
+        self.tope = tope or TOPE_SEGUNDOS
+        self.deadline = deadline or DEADLINE_SEGUNDOS
+
+    def espera(self, intento: int, retry_after: Optional[float] = None) -> float:
+        espera = random.uniform(0, min(self.tope, self.base * 2**intento))
+        if retry_after is not None:
+            espera = max(espera, retry_after)
+        return espera
+
+    async def post_json(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        headers: Dict,
+        data: Dict,
+        process_id: str = "",
+        max_intentos: int = None,
+        al_sobrecarga: Optional[Callable[[int], None]] = None,
+        presupuesto=None,
+        limitador=None,
+        medir: Optional[Callable[[float], None]] = None,
+    ) -> Dict:
+        """POST con la política aplicada. Devuelve el JSON de un 200; un
+        status no reintentable (400, 401...) lanza ValueError de una.
+        al_sobrecarga(status) se llama ante cada status reintentable (lo usa
+        utils/adaptive_concurrency.py para bajar la concurrencia).
+        presupuesto: el RateBudget del host (utils/rate_budget.py), o None.
+        limitador: el AdaptiveLimiter del host (utils/adaptive_concurrency.py),
+        o None; se toma un lugar por intento, no durante el backoff.
+        medir(segundos) se llama con la latencia del POST que respondió 200,
+        sin backoff ni esperas de cuota (lo usa utils/hedging.py)."""
+        if limitador is None:
+            return await self._intentar(
+                session, url, headers, data, process_id, max_intentos, al_sobrecarga, presupuesto,
+                slot=lambda: contextlib.nullcontext(_sin_medicion), medir=medir,
+            )
+        try:
+            return await self._intentar(
+                session, url, headers, data, process_id, max_intentos,
+                al_sobrecarga or limitador.registrar_sobrecarga, presupuesto,
+                slot=limitador.slot, medir=medir,
+            )
+        except UpstreamUnavailableError:
+            limitador.registrar_caida()
+            raise
+
+    async def _intentar(
+        self, session, url, headers, data, process_id, max_intentos, al_sobrecarga, presupuesto, slot,
+        medir=None,
+    ) -> Dict:
+        breaker = breaker_para(url)
+        intentos = max_intentos or self.max_intentos
+        limite = time.monotonic() + self.deadline
+        ultimo_error = ""
+        cuerpo = cuerpo_json(data)
+        headers = {**headers, "Content-Type": "application/json"}
+        for intento in range(intentos):
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                raise UpstreamUnavailableError(
+                    f"Deadline de {self.deadline:.0f}s agotado para {url} (último error: {ultimo_error})"
+                )
+            sondeo = breaker.verificar()
+            retry_after = None
+            enviado = False
+            try:
+                # El intento entero (presupuesto + POST) entra en lo que queda
+                # del deadline. La llamada de prueba además tiene su propio
+                # tope: mientras dura, todas las demás de este host se
+                # rechazan.
+                async with asyncio.timeout(min(restante, TIMEOUT_SONDEO) if sondeo else restante):
+                    if presupuesto is not None:
+                        tokens_estimados = await presupuesto.adquirir(data, process_id)
+                    async with slot() as sano:
+                        # Ya con lugar en el limitador: desde acá, un
+                        # timeout es del upstream.
+                        enviado = True
+                        inicio = time.perf_counter()
+                        async with session.post(url, headers=headers, data=cuerpo) as response:
+                            if response.status == 200:
+                                breaker.registrar_exito()
+                                resultado = await response.json()
+                                sano()
+                                if medir is not None:
+                                    medir(time.perf_counter() - inicio)
+                                if presupuesto is not None:
+                                    await presupuesto.ajustar(tokens_estimados, resultado)
+                                return resultado
+                            if response.status not in ESTADOS_REINTENTABLES:
+                                breaker.liberar_sondeo()
+                                app_logger.error(
+                                    f"[{process_id}] API request failed with status {response.status} - {await response.text()}"
+                                )
+                                raise ValueError(f"Request failed with status {response.status}")
+                            retry_after = _parsear_retry_after(response.headers.get("Retry-After"))
+                            ultimo_error = f"status {response.status}"
+                            if al_sobrecarga:
+                                al_sobrecarga(response.status)
+                            if response.status == 429:
+                                breaker.liberar_sondeo()
+                            else:
+                                breaker.registrar_falla()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not enviado:
+                    # Se fue el deadline esperando lugar en el presupuesto o
+                    # en el limitador: no dice nada del upstream.
+                    if sondeo:
+                        breaker.liberar_sondeo()
+                    raise UpstreamUnavailableError(
+                        f"Deadline de {self.deadline:.0f}s agotado esperando turno para {url}"
+                    ) from e
+                ultimo_error = f"Request error: {e}" if str(e) else f"Request error: {type(e).__name__}"
+                breaker.registrar_falla()
+            except BaseException:
+                # Cancelación (CancelledError no es Exception) o un error
+                # que no dice nada del upstream: la prueba no se resolvió.
+                if sondeo:
+                    breaker.liberar_sondeo()
+                raise
+
+            if intento == intentos - 1:
+                break
+            espera = self.espera(intento, retry_after)
+            restante = limite - time.monotonic()
+            if espera > restante:
+                raise UpstreamUnavailableError(
+                    f"Deadline de {self.deadline:.0f}s agotado para {url} (último error: {ultimo_error})"
+                )
+            app_logger.warning(
+                f"[{process_id}] API request failed ({ultimo_error}). Retrying in {espera:.1f} seconds..."
+                + (f" (Retry-After: {retry_after:.0f}s)" if retry_after is not None else "")
+            )
+            await asyncio.sleep(espera)
+        raise UpstreamUnavailableError(f"Max retries exceeded. Last error: {ultimo_error}")
+
+
+# Instancia compartida por los tres orquestadores y utils/fetcher.py.
+politica_llm = RetryPolicy()
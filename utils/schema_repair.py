@@ -0,0 +1,185 @@
+"""
+Reparación dirigida de salidas de tools que no pasan la validación del JSON
+Schema, en vez de re-extraer todo a ciegas.
+
+Antes, ante un ValidationError, tool_handler reenviaba la MISMA request
+(todas las imágenes de las páginas + prompt) hasta 6 veces esperando una
+respuesta distinta. Ahora, en orden:
+
+  1. reparar_localmente(): arregla sin llamar a la API lo trivialmente
+     reparable --
+        - enum con otra capitalización / tildes ("limpieza" -> "Limpieza")
+        - número como string ("1.234,56", "$ 1500", "12") -> número
+        - propiedades de más contra additionalProperties: false -> se sacan
+        - null en una propiedad opcional que no admite null -> se saca
+     Si con eso valida, listo: cero requests extra.
+  2. Turno de reparación: se le devuelve al modelo SU propia llamada a la
+     tool junto con la lista concreta de errores (ver
+     utils/schema_validators.validar) como un turno más de la conversación,
+     para que corrija solo eso. Formato OpenAI-compat (Gemini) o Anthropic.
+  3. Recién si el turno de reparación tampoco valida, el tool_handler vuelve
+     a la re-extracción completa de siempre.
+"""
+
+import copy
+import json
+import re
+import unicodedata
+
+from utils.schema_validators import listar_errores
+
+# Cuántos turnos de reparación se intentan antes de volver a re-extraer.
+MAX_TURNOS_REPARACION = 1
+
+
+def _normalizar(texto: str) -> str:
+    sin_tildes = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+    return re.sub(r"\s+", " ", sin_tildes).strip().lower()
+
+
+def _como_numero(valor: str):
+    """"1.234,56" / "1234.56" / "$ 1.500" / "-12" -> float, o None."""
+    limpio = re.sub(r"[^\d,.\-]", "", valor)
+    if not re.search(r"\d", limpio):
+        return None
+    if "," in limpio and "." in limpio:
+        # El separador que aparece último es el decimal.
+        if limpio.rfind(",") > limpio.rfind("."):
+            limpio = limpio.replace(".", "").replace(",", ".")
+        else:
+            limpio = limpio.replace(",", "")
+    elif "," in limpio:
+        limpio = limpio.replace(",", ".")
+    elif limpio.count(".") > 1:
+        limpio = limpio.replace(".", "")
+    elif re.fullmatch(r"-?\d{1,3}\.\d{3}", limpio):
+        # "1.500": ¿mil quinientos (formato argentino) o 1,5? Ambiguo -- no se
+        # adivina, que lo corrija el modelo.
+        return None
+    try:
+        return float(limpio)
+    except ValueError:
+        return None
+
+
+def _tipos(schema: dict) -> list:
+    tipo = schema.get("type")
+    return tipo if isinstance(tipo, list) else [tipo] if tipo else []
+
+
+def _hija(ruta: str, clave) -> str:
+    return f"{ruta}.{clave}" if ruta else str(clave)
+
+
+def _reparar(schema: dict, valor, ruta: str, cambios: list):
+    tipos = _tipos(schema)
+
+    if "enum" in schema and isinstance(valor, str) and valor not in schema["enum"]:
+        candidatos = [
+            opcion
+            for opcion in schema["enum"]
+            if isinstance(opcion, str) and _normalizar(opcion) == _normalizar(valor)
+        ]
+        if len(candidatos) == 1:
+            cambios.append(f"{ruta}: enum {valor!r} -> {candidatos[0]!r}")
+            return candidatos[0]
+
+    if isinstance(valor, str) and ("number" in tipos or "integer" in tipos) and "string" not in tipos:
+        numero = _como_numero(valor)
+        if numero is not None:
+            if "integer" in tipos and "number" not in tipos:
+                if numero != int(numero):
+                    return valor
+                numero = int(numero)
+            cambios.append(f"{ruta}: {valor!r} -> {numero!r}")
+            return numero
+
+    if isinstance(valor, dict) and ("object" in tipos or "properties" in schema):
+        propiedades = schema.get("properties", {})
+        requeridas = set(schema.get("required", []))
+        reparado = {}
+        for clave, sub in valor.items():
+            if clave not in propiedades:
+                if schema.get("additionalProperties") is False:
+                    cambios.append(f"{_hija(ruta, clave)}: propiedad extra eliminada")
+                    continue
+                reparado[clave] = sub
+                continue
+            sub_schema = propiedades[clave]
+            if sub is None and clave not in requeridas and "null" not in _tipos(sub_schema):
+                cambios.append(f"{_hija(ruta, clave)}: null opcional eliminado")
+                continue
+            reparado[clave] = _reparar(sub_schema, sub, _hija(ruta, clave), cambios)
+        return reparado
+
+    if isinstance(valor, list) and isinstance(schema.get("items"), dict):
+        return [
+            _reparar(schema["items"], sub, _hija(ruta, i), cambios)
+            for i, sub in enumerate(valor)
+        ]
+
+    return valor
+
+
+def reparar_localmente(schema: dict, instancia):
+    """Intenta dejar `instancia` válida contra `schema` sin llamar a la API.
+    Devuelve (instancia_reparada, cambios) si quedó válida, o (None, cambios)
+    si no alcanzó. No modifica `instancia`."""
+    cambios = []
+    reparada = _reparar(schema, copy.deepcopy(instancia), "", cambios)
+    if cambios and not listar_errores(schema, reparada):
+        return reparada, cambios
+    return None, cambios
+
+
+def _instrucciones(errores: list) -> str:
+    return (
+        "La llamada anterior NO pasó la validación del schema. Errores:\n"
+        + "\n".join(f"- {e}" for e in errores)
+        + "\n\nVolvé a llamar a la función corrigiendo SOLO esos errores y "
+        "manteniendo igual todo lo demás. No inventes datos que no estén en "
+        "el documento."
+    )
+
+
+def turno_reparacion_openai(
+    tool_call_id: str, tool_name: str, argumentos: dict, errores: list
+) -> list:
+    """Mensajes a agregar al final de la conversación (formato OpenAI-compat
+    de Gemini): la llamada previa del modelo + el resultado con los errores."""
+    return [
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": tool_call_id,
+                    "type": "function",
+                    "function": {
+                        "name": tool_name,
+                        "arguments": json.dumps(argumentos, ensure_ascii=False),
+                    },
+                }
+            ],
+        },
+        {"role": "tool", "tool_call_id": tool_call_id, "content": _instrucciones(errores)},
+    ]
+
+
+def turno_reparacion_anthropic(contenido_asistente: list, tool_use_id: str, errores: list) -> list:
+    """Mensajes a agregar al final de la conversación (formato Messages de
+    Anthropic): la respuesta previa del modelo + tool_result con is_error."""
+    return [
+        {"role": "assistant", "content": contenido_asistente},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": tool_use_id,
+                    "is_error": True,
+                    "content": _instrucciones(errores),
+                }
+            ],
+        },
+    ]
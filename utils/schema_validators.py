@@ -0,0 +1,100 @@
+"""
+Validadores de JSON Schema compilados una sola vez y reutilizados para las
+salidas de las tools.
+
+Antes tool_handler hacía jsonschema.validate(instance=..., schema=...) en cada
+intento: validate() vuelve a chequear el schema contra el metaschema y arma
+una clase de validador nueva cada vez, y encima el schema se buscaba
+recorriendo `tools` en cada llamada. Acá cada schema se compila (check_schema
++ instancia del validador) una vez y queda cacheado:
+
+  - Por identidad del dict (tools.py es estático, así que para el
+    orquestador de Claude es siempre un hit directo).
+  - Por contenido (build_tools() de tools_standard.py devuelve una copia
+    nueva en cada factura, pero el contenido solo cambia cuando cambia el
+    mapa de categorías -- o sea, un validador por tool por versión del mapa).
+
+validar() además junta TODOS los errores (iter_errors) en vez de cortar en
+el primero, para que el reintento pueda listar todo lo que está mal de una.
+
+Micro-benchmark contra el camino anterior: scripts/bench_schema_validation.py.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
+
+_MAX_CACHEADOS = 64
+
+# id(schema) -> (schema, validador). Se guarda el schema para que el id no
+# se recicle mientras la entrada siga en el cache.
+_por_id = OrderedDict()
+# sha256 del schema serializado -> validador
+_por_contenido = OrderedDict()
+
+
+def _recordar(cache: OrderedDict, clave, valor) -> None:
+    cache[clave] = valor
+    cache.move_to_end(clave)
+    while len(cache) > _MAX_CACHEADOS:
+        cache.popitem(last=False)
+
+
+def validador_para(schema: dict):
+    """Validador compilado (y cacheado) para `schema`."""
+    entrada = _por_id.get(id(schema))
+    if entrada is not None and entrada[0] is schema:
+        return entrada[1]
+
+    clave = hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+    validador = _por_contenido.get(clave)
+    if validador is None:
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        validador = cls(schema)
+        _recordar(_por_contenido, clave, validador)
+    _recordar(_por_id, id(schema), (schema, validador))
+    return validador
+
+
+def schema_de_tool(tools: list, tool_name: str):
+    """Schema de parámetros de `tool_name` dentro de `tools`, en cualquiera
+    de los dos formatos del repo: OpenAI/Gemini ({"function": {"parameters"}})
+    o Anthropic ({"name", "input_schema"})."""
+    for tool in tools:
+        if "function" in tool:
+            if tool["function"]["name"] == tool_name:
+                return tool["function"]["parameters"]
+        elif tool.get("name") == tool_name:
+            return tool["input_schema"]
+    return None
+
+
+def _ruta(error) -> str:
+    return ".".join(str(p) for p in error.absolute_path) or "(raíz)"
+
+
+def listar_errores(schema: dict, instancia) -> list:
+    """Todos los errores de `instancia` contra `schema`, como texto
+    "ruta: mensaje", ordenados por ruta. Lista vacía = válido."""
+    errores = sorted(
+        validador_para(schema).iter_errors(instancia),
+        key=lambda e: [str(p) for p in e.absolute_path],
+    )
+    return [f"{_ruta(e)}: {e.message}" for e in errores]
+
+
+def validar(schema: dict, instancia) -> None:
+    """Como jsonschema.validate(), pero con el validador cacheado y un
+    ValidationError cuyo .message lista TODOS los errores (uno por línea);
+    la lista queda además en .errores."""
+    errores = listar_errores(schema, instancia)
+    if errores:
+        error = ValidationError(
+            f"{len(errores)} error(es) de validación:\n" + "\n".join(errores)
+        )
+        error.errores = errores
+        raise error
@@ -0,0 +1,315 @@
+"""
+Helpers compartidos por los toolchains de extracción (run_image_toolchain /
+run_pdf_toolchain) de los tres orquestadores en routes/.
+
+Incluye el modo opcional de "schema combinado" de los orquestadores Gemini
+(extraer_con_schema_combinado): una sola request con las 3 secciones.
+
+Las 3 tools de extracción (emisor/receptor, ítems, impuestos) no dependen
+una de la salida de la otra, así que se lanzan juntas. Antes la primera se
+esperaba sola y recién después se hacía gather de las otras dos: una vuelta
+completa al LLM de más en el camino crítico de cada factura.
+
+También la extracción de ítems por bloques de páginas
+(extraer_items_por_bloques) para facturas largas.
+
+Configuración por variables de entorno (opcionales):
+    ITEMS_PAGINAS_POR_BLOQUE   (default 0 = sin bloques) páginas por request
+                               de ítems en PDFs más largos que eso. Apagado
+                               por defecto: multiplica requests y tokens, y
+                               subtotal/total salen del último bloque -- solo
+                               conviene para facturas realmente largas
+                               (p. ej. 10+ páginas).
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from jsonschema import ValidationError
+
+from utils.model_cascade import chequear_consistencia
+from utils.retry_policy import UpstreamUnavailableError
+from utils.schema_repair import reparar_localmente
+from utils.schema_validators import validar
+
+app_logger = logging.getLogger("app_logger")
+
+ITEMS_PAGINAS_POR_BLOQUE = int(os.getenv("ITEMS_PAGINAS_POR_BLOQUE", "0"))
+
+
+async def ejecutar_tools_en_paralelo(llamadas: dict, process_id: str = ""):
+    """
+    Corre concurrentemente las corutinas de `llamadas` ({tool_name: corutina})
+    dentro de un asyncio.TaskGroup y devuelve (resultados, tiempos):
+
+      - resultados: lista en el mismo orden que `llamadas` (el orden que
+        espera formatear_factura / guardar_factura_completa_en_sheets).
+      - tiempos: {tool_name: segundos} de cada tool, para medir latencia.
+
+    TaskGroup (y no gather) a propósito: si una tool falla de forma fatal
+    (ya agotó sus propios reintentos), se cancelan las hermanas en vuelo en
+    vez de dejarlas gastando tokens para una factura que igual va a fallar.
+    Se relanza la PRIMERA excepción real (no el ExceptionGroup) para que
+    los callers sigan viendo el mismo mensaje que veían con gather -- ese
+    texto termina en error_message de PocketBase.
+    """
+    tiempos = {}
+
+    async def _medir(tool_name, corutina):
+        inicio = time.perf_counter()
+        try:
+            return await corutina
+        finally:
+            tiempos[tool_name] = round(time.perf_counter() - inicio, 3)
+
+    inicio_total = time.perf_counter()
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tareas = [
+                tg.create_task(_medir(tool_name, corutina))
+                for tool_name, corutina in llamadas.items()
+            ]
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0]
+
+    tiempos["total"] = round(time.perf_counter() - inicio_total, 3)
+    app_logger.info(f"[{process_id}] ⏱️ Tiempos por tool: {tiempos}")
+    return [tarea.result() for tarea in tareas], tiempos
+
+
+def _usage_vacio():
+    return {
+        "input_tokens": 0,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 0,
+        "output_tokens": 0,
+        "service_tier": "standard",
+    }
+
+
+async def extraer_con_schema_combinado(
+    tool_handler,
+    tools_standard: list,
+    armar_contenido,
+    process_id: str = "",
+    cascada=None,
+):
+    """
+    Modo "schema combinado" de los orquestadores Gemini: UNA request por
+    factura en vez de 3 (las imágenes y las definiciones de tools se mandan
+    una sola vez -- ver tools_standard.build_combined_tool()).
+
+      - tool_handler: el tool_handler del orquestador (OpenAI-compat).
+      - tools_standard: salida de build_tools() (o el alias `tools`).
+      - armar_contenido(prompt, idx): devuelve el "content" del mensaje de
+        usuario para ese prompt -- cada toolchain conserva su forma (orden
+        texto/imagen, páginas del PDF). idx 0 para la llamada combinada.
+      - cascada: la ModelCascade del orquestador (utils/model_cascade.py).
+
+    Cada sección de la respuesta se valida contra el schema de SU tool
+    original; la que no valida (o falta) se vuelve a pedir sola con su tool
+    de siempre, en paralelo. La que valida pero es inconsistente (sumas,
+    CUIT) se pide sola SOLO si la cascada tiene un modelo más fuerte que el
+    de la llamada combinada: si no, la request sola iría al mismo modelo y
+    la salida se aceptaría igual -- p.ej. facturas con líneas de descuento,
+    que nunca cierran la suma. Si la llamada combinada falla del todo, se cae
+    a las 3 requests normales. Devuelve (respuestas, tiempos) con la misma
+    forma que ejecutar_tools_en_paralelo: una respuesta por tool, en orden,
+    así formatear_factura no cambia. El usage de la llamada combinada se
+    suma a la primera respuesta (no se duplica por sección).
+    """
+    # Import local: tools_standard.py importa utils/bas_config.py y no hace
+    # falta cargarlo para el modo normal de ejecutar_tools_en_paralelo.
+    from tools_standard import COMBINED_TOOL_NAME, build_combined_tool
+
+    combinada = build_combined_tool(tools_standard)
+    salida, usage_combinado, respuesta = {}, _usage_vacio(), {}
+    inicio = time.perf_counter()
+    try:
+        respuesta = await tool_handler(
+            tools=[combinada["data"]],
+            messages=[
+                {"role": "user", "content": armar_contenido(combinada["prompt"], 0)}
+            ],
+            tool_name=COMBINED_TOOL_NAME,
+            process_id=process_id,
+            validar_schema=False,  # se valida por sección, acá abajo
+            max_retries=2,  # hay fallback por tool, no vale la pena insistir
+        )
+        salida = respuesta["content"][0]["input"] or {}
+        usage_combinado = respuesta["usage"]
+    except UpstreamUnavailableError:
+        raise  # proveedor caído: no tiene sentido abrir 3 requests más
+    except Exception as e:
+        app_logger.warning(
+            f"[{process_id}] ⚠️ Falló la extracción combinada, se piden las 3 secciones por separado: {e}"
+        )
+    tiempo_combinada = round(time.perf_counter() - inicio, 3)
+    puede_escalar = cascada is not None and (respuesta.get("tier") or 0) < cascada.ultimo_nivel
+
+    respuestas = {}
+    pendientes = {}
+    for idx, tool in enumerate(tools_standard):
+        nombre = tool["data"]["function"]["name"]
+        seccion = salida.get(nombre) if isinstance(salida, dict) else None
+        schema = tool["data"]["function"]["parameters"]
+        try:
+            try:
+                validar(schema, seccion)
+            except ValidationError:
+                # Antes de pedirla sola, reparación local (ver
+                # utils/schema_repair.py).
+                reparada, _ = reparar_localmente(schema, seccion)
+                if reparada is None:
+                    raise
+                seccion = reparada
+            # Inconsistente (sumas, CUIT) = se pide sola, así el tool_handler
+            # puede escalar de nivel en la cascada (utils/model_cascade.py).
+            # Sin nivel al que escalar se acepta, igual que en tool_handler.
+            problemas = chequear_consistencia(nombre, seccion)
+            if problemas and not puede_escalar:
+                app_logger.warning(
+                    f"[{process_id}] ⚖️ Sección '{nombre}' inconsistente en la respuesta combinada (se acepta): {problemas}"
+                )
+            elif problemas:
+                error = ValidationError("; ".join(problemas))
+                error.errores = problemas
+                raise error
+            respuestas[nombre] = {
+                "content": [{"name": nombre, "input": seccion}],
+                "usage": _usage_vacio(),
+                "model": respuesta.get("model"),
+                "tier": respuesta.get("tier"),
+            }
+        except ValidationError as e:
+            if salida:
+                app_logger.warning(
+                    f"[{process_id}] 🔁 Sección '{nombre}' inválida en la respuesta combinada ({e.message}), se pide sola."
+                )
+            pendientes[nombre] = tool_handler(
+                tools=[t["data"] for t in tools_standard],
+                messages=[
+                    {"role": "user", "content": armar_contenido(tool["prompt"], idx)}
+                ],
+                tool_name=nombre,
+                process_id=process_id,
+            )
+
+    tiempos = {}
+    if pendientes:
+        resultados, tiempos = await ejecutar_tools_en_paralelo(pendientes, process_id)
+        respuestas.update(zip(pendientes.keys(), resultados))
+    tiempos[COMBINED_TOOL_NAME] = tiempo_combinada
+    tiempos["total"] = round(time.perf_counter() - inicio, 3)
+
+    ordenadas = [respuestas[t["data"]["function"]["name"]] for t in tools_standard]
+    for token_type, value in usage_combinado.items():
+        if token_type != "service_tier":
+            ordenadas[0]["usage"][token_type] = ordenadas[0]["usage"].get(token_type, 0) + value
+    app_logger.info(
+        f"[{process_id}] ⏱️ Extracción combinada: {len(tools_standard) - len(pendientes)}/{len(tools_standard)} secciones en 1 request, tiempos {tiempos}"
+    )
+    return ordenadas, tiempos
+
+
+def bloques_de_paginas(cantidad: int) -> list:
+    """Rangos de páginas para los ítems, o [] si el documento entra en una
+    sola request."""
+    tamano = ITEMS_PAGINAS_POR_BLOQUE
+    if tamano <= 0 or cantidad <= tamano:
+        return []
+    return [range(i, min(i + tamano, cantidad)) for i in range(0, cantidad, tamano)]
+
+
+def unir_bloques_items(respuestas: list) -> dict:
+    """Una sola respuesta de detalle_de_items_facturados a partir de las de
+    cada bloque: detalles concatenados en orden de página, subtotal/total (y
+    el resto de los campos) del último bloque que los informó."""
+    detalles = []
+    for respuesta in respuestas:
+        detalles.extend(respuesta["content"][0]["input"].get("detalles") or [])
+    # Los totales van al pie de la última página; si ese bloque no los tiene
+    # (pie cortado, hoja de observaciones al final) se toma el último que sí.
+    final = next(
+        (
+            r["content"][0]["input"]
+            for r in reversed(respuestas)
+            if r["content"][0]["input"].get("total")
+        ),
+        respuestas[-1]["content"][0]["input"],
+    )
+    usage = _usage_vacio()
+    for respuesta in respuestas:
+        for token_type, value in respuesta["usage"].items():
+            if token_type != "service_tier":
+                usage[token_type] = usage.get(token_type, 0) + value
+    return {
+        "content": [
+            {"name": respuestas[0]["content"][0]["name"], "input": {**final, "detalles": detalles}}
+        ],
+        "usage": usage,
+        "model": respuestas[-1].get("model"),
+        "tier": max((r.get("tier") or 0) for r in respuestas),
+    }
+
+
+async def extraer_items_por_bloques(
+    tool_handler,
+    tools: list,
+    tool: dict,
+    idx: int,
+    armar_contenido,
+    bloques: list,
+    process_id: str = "",
+):
+    """
+    detalle_de_items_facturados partido en bloques de páginas que corren en
+    paralelo. Con cientos de líneas una sola request pasa el límite de tokens
+    de salida, el JSON vuelve cortado, no valida y quema todos los
+    reintentos; así cada request devuelve solo los ítems de sus páginas.
+
+    armar_contenido(prompt, idx, tool_name, paginas) arma el contenido con
+    solo esas páginas. Cada bloque se valida contra el schema por separado
+    (parcial=True: sin el chequeo de sumas, que solo tiene sentido sobre el
+    total); el chequeo de consistencia corre sobre el resultado unido.
+    """
+    tool_name = tool["data"]["function"]["name"]
+    cantidad = bloques[-1][-1] + 1
+
+    def _prompt(bloque) -> str:
+        paginas = f"{bloque[0] + 1}" if len(bloque) == 1 else f"{bloque[0] + 1} a {bloque[-1] + 1}"
+        return (
+            f"{tool['prompt']}\n\nEsta request cubre SOLO las páginas {paginas} de "
+            f"{cantidad} del documento: extraé ÚNICAMENTE los ítems que aparecen en "
+            "esas páginas (las columnas de la tabla pueden estar encabezadas en una "
+            "página anterior). Si el subtotal y el total de la factura no figuran en "
+            "estas páginas, devolvé 0 en ambos."
+        )
+
+    llamadas = {
+        f"{tool_name}[{bloque[0] + 1}-{bloque[-1] + 1}]": tool_handler(
+            tools=tools,
+            messages=[
+                {
+                    "role": "user",
+                    "content": armar_contenido(_prompt(bloque), idx, tool_name, bloque),
+                }
+            ],
+            tool_name=tool_name,
+            process_id=process_id,
+            parcial=True,
+        )
+        for bloque in bloques
+    }
+    respuestas, tiempos = await ejecutar_tools_en_paralelo(llamadas, process_id)
+    unida = unir_bloques_items(respuestas)
+    problemas = chequear_consistencia(tool_name, unida["content"][0]["input"])
+    if problemas:
+        app_logger.warning(f"[{process_id}] ⚖️ Ítems unidos de {len(bloques)} bloques inconsistentes: {problemas}")
+    app_logger.info(
+        f"[{process_id}] 🧩 '{tool_name}' en {len(bloques)} bloques: "
+        f"{len(unida['content'][0]['input']['detalles'])} ítems, tiempos {tiempos}"
+    )
+    return unida